@@ -0,0 +1,95 @@
+import gc
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+
+from citydao.snapshot import SnapshotVote, VoteTable
+from citydao.utils import Web3Address
+
+
+CHOICES = ["For", "Against", "Abstain"]
+
+
+@dataclass
+class DictVote(object):
+    # previous SnapshotVote layout, per instance `__dict__`
+    voter: Any
+    created: int
+    choice: str
+    vp: float
+
+
+class DictAddress(object):
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self.ens = None
+
+
+def make_raw_votes(n_votes: int, n_voters: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            "voter": f"0x{i % n_voters:040x}",
+            "created": 1650000000 + i,
+            "choice": 1 + i % len(CHOICES),
+            "vp": float(i % 100),
+        }
+        for i in range(n_votes)
+    ]
+
+
+def build_dict_votes(raw_votes: List[Dict[str, Any]]) -> List[DictVote]:
+    # copy strings as if they were decoded from separate json responses
+    return [
+        DictVote(
+            voter=DictAddress("".join(vote["voter"])),
+            created=vote["created"],
+            choice="".join(CHOICES[vote["choice"] - 1]),
+            vp=vote["vp"]
+        )
+        for vote in raw_votes
+    ]
+
+
+def build_slotted_votes(raw_votes: List[Dict[str, Any]]) -> List[SnapshotVote]:
+    return [
+        SnapshotVote(
+            voter=Web3Address.intern("".join(vote["voter"])),
+            created=vote["created"],
+            choice=CHOICES[vote["choice"] - 1],
+            vp=vote["vp"]
+        )
+        for vote in raw_votes
+    ]
+
+
+def build_vote_table(raw_votes: List[Dict[str, Any]]) -> VoteTable:
+    table = VoteTable(CHOICES)
+    table.extend_raw(raw_votes)
+    return table
+
+
+def measure(name: str, build: Callable, raw_votes: List[Dict[str, Any]]) -> None:
+    gc.collect()
+    tracemalloc.start()
+    votes = build(raw_votes)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<24}{current / 2**20:>10.1f} MiB  ({current / len(raw_votes):.1f} bytes/vote)")
+    del votes
+
+
+def main() -> None:
+    n_votes = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_voters = n_votes // 10
+    raw_votes = make_raw_votes(n_votes, n_voters)
+
+    print(f"{n_votes:,} votes from {n_voters:,} voters")
+    measure("dataclass + __dict__", build_dict_votes, raw_votes)
+    measure("slotted + interned", build_slotted_votes, raw_votes)
+    measure("VoteTable", build_vote_table, raw_votes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from web3 import Web3
+
+from citydao.bot import DEFAULT_CACHE_TTLS, DEFAULT_REPORT_TIMEOUTS, ReportPipeline, ReportSection
+from citydao.calendar import CityDAOCalendar
+from citydao.provider import OfflineProvider, ProviderRegistry
+from citydao.snapshot import (
+    PROPOSALS_BY_STATE_QUERY, PROPOSALS_QUERY, SNAPSHOT_HUB_URL, ProposalStatus, SnapshotProposal,
+    format_active_proposals, parse_proposal
+)
+from citydao.spotify import SPOTIFY_TOKEN_URL, CityDAOSpotify
+from citydao.treasury import CityDAOTreasury
+from citydao.tweets import CityDAOTwitter
+from citydao.utils import escape_markdown_v2, split_markdown_v2
+
+
+class AsyncHTTPClient(object):
+    # one aiohttp session shared by every async client, retried with backoff like the sync transports
+
+    def __init__(
+        self,
+        timeout: float = 30.,
+        limit: int = 100,
+        max_retries: int = 5,
+        backoff_factor: float = 0.5
+    ) -> None:
+        self.timeout = timeout
+        self.limit = limit
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.session = None
+
+    def __repr__(self) -> str:
+        return f"AsyncHTTPClient(limit={self.limit})"
+
+    def get_session(self) -> aiohttp.ClientSession:
+        # created lazily so it belongs to the running event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                headers={"Accept-Encoding": "gzip, deflate"}
+            )
+        return self.session
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[aiohttp.ClientTimeout] = None,
+        **kwargs
+    ) -> Tuple[int, Dict[str, str], Any]:
+        # (status, headers, json payload or None), retried on rate limit and server errors.
+        # `timeout` overrides the session timeout, e.g. for long polling
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        for attempt in range(self.max_retries + 1):
+            async with self.get_session().request(method, url, headers=headers, **kwargs) as response:
+                retryable = response.status == 429 or response.status >= 500
+                if not retryable or attempt == self.max_retries:
+                    payload = None
+                    if response.status != 304 and response.content_type.endswith("json"):
+                        payload = await response.json()
+                    return response.status, dict(response.headers), payload
+                retry_after = response.headers.get("Retry-After")
+
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff_factor * 2**attempt
+            await asyncio.sleep(delay + random.random() * 0.1)
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+
+class AsyncSnapshotAPI(object):
+
+    def __init__(self, client: AsyncHTTPClient, space: str = "daocity.eth") -> None:
+        self.client = client
+        self.space = space
+        self.url = f"https://snapshot.org/#/{self.space}"
+
+    def __repr__(self) -> str:
+        return f"AsyncSnapshotAPI({self.space})"
+
+    async def query_graphql(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        status, _, payload = await self.client.request(
+            "POST", SNAPSHOT_HUB_URL, json={"query": query, "variables": variables or {}}
+        )
+        if payload is None:
+            raise aiohttp.ClientError(f"Snapshot hub returned HTTP {status}")
+        return payload
+
+    async def get_proposals(self, status: Optional[ProposalStatus] = None) -> List[SnapshotProposal]:
+        if status is None:
+            response = await self.query_graphql(PROPOSALS_QUERY, {"space": self.space, "first": 1000})
+        else:
+            response = await self.query_graphql(PROPOSALS_BY_STATE_QUERY, {
+                "space": self.space,
+                "state": status.value,
+                "first": 1000,
+            })
+        return [parse_proposal(proposal, self.space) for proposal in response["data"]["proposals"]]
+
+    async def get_daily_summary(self) -> Optional[str]:
+        return format_active_proposals(await self.get_proposals(ProposalStatus.ACTIVE), self.url)
+
+
+class AsyncCityDAOSpotify(object):
+
+    def __init__(self, client: AsyncHTTPClient, client_id: str, client_credentials: str, refresh_margin: float = 60.) -> None:
+        self.client = client
+        # catalog, etags and formatting are shared with the sync client
+        self.spotify = CityDAOSpotify(client_id, client_credentials, background_refresh=False)
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_at = 0.
+        self.token_lock = asyncio.Lock()
+
+    def __repr__(self) -> str:
+        return f"AsyncCityDAOSpotify({self.spotify.citydao_id})"
+
+    async def get_token(self) -> str:
+        async with self.token_lock:
+            if self.access_token is None or time.time() >= self.expires_at - self.refresh_margin:
+                status, _, response = await self.client.request(
+                    "POST",
+                    SPOTIFY_TOKEN_URL,
+                    headers={
+                        "Authorization": f"Basic {self.spotify.client_credentials}",
+                        "Content-Type": "application/x-www-form-urlencoded"
+                    },
+                    data={"grant_type": "client_credentials"}
+                )
+                if status != 200:
+                    raise aiohttp.ClientError(f"Spotify token request returned HTTP {status}")
+                self.access_token = response["access_token"]
+                self.expires_at = time.time() + response.get("expires_in", 3600)
+            return self.access_token
+
+    async def get_json(self, url: str) -> Any:
+        for _ in range(2):
+            headers = {"Authorization": f"Bearer {await self.get_token()}"}
+            cached = self.spotify.catalog.get_response(url)
+            if cached is not None:
+                headers["If-None-Match"] = cached[0]
+
+            status, response_headers, response = await self.client.request("GET", url, headers=headers)
+            if status == 401:
+                self.access_token = None
+                continue
+            if status == 304 and cached is not None:
+                return cached[1]
+            if status != 200:
+                break
+
+            if "ETag" in response_headers:
+                self.spotify.catalog.set_response(url, response_headers["ETag"], response)
+            return response
+        raise aiohttp.ClientError(f"Spotify request to {url} returned HTTP {status}")
+
+    async def sync_catalog(self, page_size: int = 50) -> int:
+        catalog = self.spotify.catalog
+        latest = catalog.get_latest_release_date()
+        n_episodes = len(catalog)
+        url = f"{self.spotify.base_url}/v1/shows/{self.spotify.citydao_id}/episodes?market=ES&limit={page_size}"
+        while url is not None:
+            response = await self.get_json(url)
+            items = [item for item in response["items"] if item is not None]
+            catalog.add_items(items)
+            if latest is not None and any(item["release_date"] < latest for item in items):
+                break
+            url = response.get("next")
+        return len(catalog) - n_episodes
+
+    async def get_daily_summary(self) -> Optional[str]:
+        await self.sync_catalog()
+        return self.spotify.get_daily_summary(sync=False)
+
+
+class AsyncCityDAOTreasury(object):
+    # the Multicall3 read as a raw eth_call, tried on every RPC endpoint in turn.
+    # the default treasury only builds and decodes calls, token discovery needs one with a sync provider
+
+    def __init__(
+        self,
+        client: AsyncHTTPClient,
+        treasury: Optional[CityDAOTreasury] = None,
+        rpc_urls: Optional[List[str]] = None
+    ) -> None:
+        self.client = client
+        self.treasury = CityDAOTreasury(provider=Web3(OfflineProvider())) if treasury is None else treasury
+        self.rpc_urls = ProviderRegistry.get_rpc_urls() if rpc_urls is None else rpc_urls
+        self.request_id = 0
+
+    def __repr__(self) -> str:
+        return f"AsyncCityDAOTreasury({self.treasury.contract_address.address})"
+
+    async def eth_call(self, transaction: Dict[str, str], block_identifier: str = "latest") -> bytes:
+        last_error = None
+        for url in self.rpc_urls:
+            self.request_id += 1
+            try:
+                status, _, response = await self.client.request("POST", url, json={
+                    "jsonrpc": "2.0",
+                    "method": "eth_call",
+                    "params": [transaction, block_identifier],
+                    "id": self.request_id,
+                })
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = e
+                continue
+            if response is None or "result" not in response:
+                last_error = ValueError(response.get("error") if response is not None else f"HTTP {status}")
+                continue
+            return Web3.toBytes(hexstr=response["result"])
+        raise last_error
+
+    async def get_balance(self) -> Dict[str, float]:
+        if self.treasury.discover:
+            # log scanning stays on the sync provider, off the event loop
+            await asyncio.to_thread(self.treasury.discover_tokens)
+        missing, functions = self.treasury.get_balance_functions()
+        data = await self.eth_call(self.treasury.multicall.encode(functions))
+        outputs = self.treasury.multicall.decode(functions, data)
+        return self.treasury.sum_balances(self.treasury.parse_balances(missing, outputs))
+
+    async def get_daily_summary(self) -> str:
+        return self.treasury.format_balance(await self.get_balance())
+
+
+class AsyncMessageCache(object):
+    # stale-while-revalidate on the event loop, concurrent misses await the same task
+
+    def __init__(self, ttl: float = 60.) -> None:
+        self.ttl = ttl
+        self.values = {}  # key -> (loaded_at, value)
+        self.tasks = {}
+        self.logger = logging.getLogger(__name__)
+
+    def __repr__(self) -> str:
+        return f"AsyncMessageCache(size={len(self.values)})"
+
+    def _start(self, key: str, loader: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self.tasks.get(key)
+        if task is None:
+            async def load() -> Any:
+                try:
+                    value = await loader()
+                    self.values[key] = (time.monotonic(), value)
+                    return value
+                finally:
+                    del self.tasks[key]
+
+            task = self.tasks[key] = asyncio.get_running_loop().create_task(load())
+            task.add_done_callback(self._log_failure)
+        return task
+
+    def _log_failure(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.warning(f"Message refresh failed: {task.exception()!r}")
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: Optional[float] = None) -> Any:
+        ttl = self.ttl if ttl is None else ttl
+        item = self.values.get(key)
+        if item is not None:
+            if time.monotonic() - item[0] >= ttl:
+                self._start(key, loader)
+            return item[1]
+        return await asyncio.shield(self._start(key, loader))
+
+    def refresh(self, key: str, loader: Callable[[], Awaitable[Any]]) -> None:
+        self._start(key, loader)
+
+
+class AsyncTelegramBot(object):
+    # Bot API over the shared aiohttp session, updates come from long polling or a webhook
+
+    def __init__(
+        self,
+        token: str,
+        chat_id: Optional[str] = None,
+        client: Optional[AsyncHTTPClient] = None,
+        cache_ttls: Optional[Dict[str, float]] = None
+    ) -> None:
+        self.token = token
+        self.chat_id = chat_id
+        self.client = AsyncHTTPClient() if client is None else client
+        self.api_url = f"https://api.telegram.org/bot{token}"
+        self.cache_ttls = {**DEFAULT_CACHE_TTLS, **({} if cache_ttls is None else cache_ttls)}
+        self.message_cache = AsyncMessageCache()
+        self.logger = logging.getLogger(__name__)
+
+        self.snapshot = AsyncSnapshotAPI(self.client)
+        self.treasury = AsyncCityDAOTreasury(self.client)
+        self.spotify = None
+        self.twitter = None
+        self.calendar = None
+        self.tasks = set()
+
+    def __repr__(self) -> str:
+        return f"AsyncTelegramBot(chat_id={self.chat_id})"
+
+    def init_spotify(self, client_id: str, client_credentials: str) -> None:
+        self.spotify = AsyncCityDAOSpotify(self.client, client_id, client_credentials)
+
+    def init_twitter(self, apikey: str, api_secret: str) -> None:
+        self.twitter = CityDAOTwitter(apikey, api_secret)
+
+    def init_google(self, apikey: str) -> None:
+        self.calendar = CityDAOCalendar(apikey)
+
+    def get_message_sources(self) -> Dict[str, Callable[[], Awaitable[Optional[str]]]]:
+        # tweepy and the google client have no async api, they run in the default executor
+        sources = [
+            ("tweets", lambda: asyncio.to_thread(self.twitter.get_daily_summary), self.twitter),
+            ("spotify", lambda: self.spotify.get_daily_summary(), self.spotify),
+            ("treasury", self.treasury.get_daily_summary, self.treasury),
+            ("calendar", lambda: asyncio.to_thread(self.calendar.get_daily_summary), self.calendar),
+            ("proposals", self.snapshot.get_daily_summary, self.snapshot),
+        ]
+        return {name: fetch for name, fetch, client in sources if client is not None}
+
+    async def api_call(self, method: str, request_timeout: Optional[aiohttp.ClientTimeout] = None, **params) -> Any:
+        status, _, response = await self.client.request(
+            "POST", f"{self.api_url}/{method}", json=params, timeout=request_timeout
+        )
+        if response is None or not response.get("ok"):
+            raise aiohttp.ClientError(f"Telegram {method} returned HTTP {status}: {response}")
+        return response["result"]
+
+    async def send_message(self, msg: Optional[str], chat_id: Optional[str] = None) -> None:
+        if msg is None or len(msg) == 0:
+            return
+        for text in split_markdown_v2(msg):
+            await self.api_call(
+                "sendMessage",
+                chat_id=self.chat_id if chat_id is None else chat_id,
+                text=text,
+                parse_mode="MarkdownV2"
+            )
+
+    async def reply(self, chat_id: int, name: str) -> None:
+        sources = self.get_message_sources()
+        if name not in sources:
+            msg = f"{escape_markdown_v2(name)} is not configured on this bot"
+        else:
+            try:
+                msg = await self.message_cache.get(name, sources[name], ttl=self.cache_ttls[name])
+                msg = msg or f"Nothing new from {escape_markdown_v2(name)} today"
+            except Exception:
+                self.logger.exception(f"Failed to build the {name} message")
+                msg = f"Could not fetch {escape_markdown_v2(name)} right now, please try again later"
+        await self.send_message(msg, chat_id=chat_id)
+
+    def handle_update(self, update: Dict[str, Any]) -> None:
+        # never awaits the reply, so one slow source does not hold back other chats
+        message = update.get("message") or update.get("channel_post") or {}
+        text = message.get("text") or ""
+        if not text.startswith("/"):
+            return
+        name = text.split()[0][1:].split("@")[0]
+        task = asyncio.get_running_loop().create_task(self.reply(message["chat"]["id"], name))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def warm_message_cache(self) -> None:
+        for name, fetch in self.get_message_sources().items():
+            self.message_cache.refresh(name, fetch)
+
+    async def run_polling(self, timeout: int = 30) -> None:
+        self.warm_message_cache()
+        await self.api_call("deleteWebhook")
+        offset = None
+        while True:
+            try:
+                # the request outlives the long poll, an idle poll returns an empty list instead of timing out
+                updates = await self.api_call(
+                    "getUpdates",
+                    request_timeout=aiohttp.ClientTimeout(total=timeout + 10),
+                    offset=offset,
+                    timeout=timeout
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.logger.warning(f"getUpdates failed: {e!r}")
+                await asyncio.sleep(1.)
+                continue
+            for update in updates:
+                offset = update["update_id"] + 1
+                self.handle_update(update)
+
+    def create_webhook_app(self, path: str = "/telegram", secret_token: Optional[str] = None) -> web.Application:
+        async def webhook(request: web.Request) -> web.Response:
+            if secret_token is not None and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+                return web.Response(status=403)
+            self.handle_update(await request.json())
+            return web.Response()
+
+        async def on_startup(app: web.Application) -> None:
+            self.warm_message_cache()
+
+        async def on_cleanup(app: web.Application) -> None:
+            await self.client.close()
+
+        app = web.Application()
+        app.router.add_post(path, webhook)
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
+        return app
+
+    async def set_webhook(self, url: str, secret_token: Optional[str] = None) -> None:
+        params = {"url": url, "allowed_updates": ["message", "channel_post"]}
+        if secret_token is not None:
+            params["secret_token"] = secret_token
+        await self.api_call("setWebhook", **params)
+
+    def run_webhook(
+        self,
+        url: str,
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        path: str = "/telegram",
+        secret_token: Optional[str] = None
+    ) -> None:
+        # `url` is the public https address telegram posts updates to, proxied to host:port/path
+        app = self.create_webhook_app(path, secret_token)
+
+        async def register(app: web.Application) -> None:
+            await self.set_webhook(url, secret_token)
+
+        app.on_startup.append(register)
+        web.run_app(app, host=host, port=port)
+
+    async def send_daily_report(self, timeouts: Optional[Dict[str, float]] = None) -> List[ReportSection]:
+        # every source at once, sections sent in order as soon as they and the ones before are ready
+        timeouts = {**DEFAULT_REPORT_TIMEOUTS, **({} if timeouts is None else timeouts)}
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        sources = self.get_message_sources()
+        tasks = {name: loop.create_task(fetch()) for name, fetch in sources.items()}
+
+        sections = []
+        for name, task in tasks.items():
+            section = ReportSection(name=name)
+            try:
+                remaining = max(0., started_at + timeouts[name] - loop.time())
+                section.message = await asyncio.wait_for(task, timeout=remaining)
+            except asyncio.TimeoutError:
+                section.error = "timeout"
+            except Exception as e:
+                section.error = repr(e)
+                self.logger.exception(f"Report source {name} failed")
+            section.elapsed = loop.time() - started_at
+            sections.append(section)
+            if section.message is not None:
+                await self.send_message(section.message)
+
+        failures = ReportPipeline.format_failures(sections)
+        if failures is not None:
+            await self.send_message(failures)
+        return sections
@@ -0,0 +1,257 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from citydao.citizen import CitizenId, CitizenNFT
+from citydao.snapshot import SnapshotAPI, SnapshotProposal, SnapshotVote, VoteTable
+
+
+def factorize(values: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    # (unique values in first-seen order, int32 code per value), hashing beats np.unique on strings
+    index = {}
+    codes = np.fromiter((index.setdefault(value, len(index)) for value in values), dtype=np.int32, count=len(values))
+    return np.array(list(index), dtype=str), codes
+
+
+@dataclass
+class VoteArrays(object):
+    voters: np.ndarray  # unique voter addresses, indexed by `voter`
+    voter: np.ndarray
+    created: np.ndarray
+    choice: np.ndarray  # 0-based index of `choices`
+    vp: np.ndarray
+    choices: List[str]
+
+    def __len__(self) -> int:
+        return len(self.voter)
+
+    def __repr__(self) -> str:
+        return f"VoteArrays(n_votes={len(self)}, n_voters={len(self.voters)})"
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Any], choices: List[str]) -> "VoteArrays":
+        voters, voter = factorize(columns["voter"])
+        return cls(
+            voters=voters,
+            voter=voter,
+            created=np.asarray(columns["created"], dtype=np.int64),
+            choice=np.asarray(columns["choice"], dtype=np.int16),
+            vp=np.asarray(columns["vp"], dtype=np.float64),
+            choices=list(choices)
+        )
+
+    @classmethod
+    def from_table(cls, table: VoteTable) -> "VoteArrays":
+        # voters are already factorized by the table
+        return cls(
+            voters=np.array(table.voters, dtype=str),
+            voter=np.asarray(table.voter, dtype=np.int32),
+            created=np.asarray(table.created, dtype=np.int64),
+            choice=np.asarray(table.choice, dtype=np.int16),
+            vp=np.asarray(table.vp, dtype=np.float64),
+            choices=list(table.choices)
+        )
+
+    @classmethod
+    def from_votes(cls, votes: List[SnapshotVote], choices: List[str]) -> "VoteArrays":
+        choice_index = {choice: i for i, choice in enumerate(choices)}
+        voters, voter = factorize([vote.voter.address for vote in votes])
+        return cls(
+            voters=voters,
+            voter=voter,
+            created=np.array([vote.created for vote in votes], dtype=np.int64),
+            choice=np.array([choice_index[vote.choice] for vote in votes], dtype=np.int16),
+            vp=np.array([vote.vp or 0. for vote in votes], dtype=np.float64),
+            choices=list(choices)
+        )
+
+    def tally(self) -> Dict[str, float]:
+        scores = np.bincount(self.choice, weights=self.vp, minlength=len(self.choices))
+        return dict(zip(self.choices, scores.tolist()))
+
+    def count(self) -> Dict[str, int]:
+        counts = np.bincount(self.choice, minlength=len(self.choices))
+        return dict(zip(self.choices, counts.tolist()))
+
+    def _bucketize(self, bucket_sec: int) -> Tuple[np.ndarray, np.ndarray]:
+        start = self.created.min() // bucket_sec * bucket_sec
+        buckets = (self.created - start) // bucket_sec
+        return start + np.arange(buckets.max() + 1) * bucket_sec, buckets
+
+    def score_timeseries(self, bucket_sec: int = 3600) -> Tuple[np.ndarray, np.ndarray]:
+        # (bucket start timestamps, cumulative score of shape [n_buckets, n_choices])
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(self.choices)))
+
+        timestamps, buckets = self._bucketize(bucket_sec)
+        n_choices = len(self.choices)
+        scores = np.bincount(
+            buckets * n_choices + self.choice,
+            weights=self.vp,
+            minlength=len(timestamps) * n_choices
+        ).reshape(len(timestamps), n_choices)
+        return timestamps, np.cumsum(scores, axis=0)
+
+    def share_timeseries(self, bucket_sec: int = 3600) -> Tuple[np.ndarray, np.ndarray]:
+        timestamps, scores = self.score_timeseries(bucket_sec)
+        total = scores.sum(axis=1, keepdims=True)
+        return timestamps, np.divide(scores, total, out=np.zeros_like(scores), where=total > 0)
+
+    def turnout_timeseries(self, bucket_sec: int = 3600) -> Tuple[np.ndarray, np.ndarray]:
+        # cumulative number of voters per bucket, hub only keeps the latest vote of each voter
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        timestamps, buckets = self._bucketize(bucket_sec)
+        return timestamps, np.cumsum(np.bincount(buckets, minlength=len(timestamps)))
+
+    def gini(self) -> float:
+        vp = np.sort(self.vp)
+        n = len(vp)
+        if n == 0 or vp.sum() == 0:
+            return 0.
+        rank = np.arange(1, n + 1)
+        return float(2 * np.sum(rank * vp) / (n * vp.sum()) - (n + 1) / n)
+
+    def nakamoto(self, threshold: float = 0.5) -> int:
+        # smallest number of voters controlling more than `threshold` of voting power
+        if len(self) == 0:
+            return 0
+        cumulative = np.cumsum(np.sort(self.vp)[::-1])
+        if cumulative[-1] == 0:
+            return 0
+        return int(np.searchsorted(cumulative, threshold * cumulative[-1], side="right") + 1)
+
+    def quorum_reached_at(self, quorum: float) -> Optional[int]:
+        order = np.argsort(self.created, kind="stable")
+        cumulative = np.cumsum(self.vp[order])
+        i = np.searchsorted(cumulative, quorum, side="left")
+        if i >= len(cumulative):
+            return None
+        return int(self.created[order][i])
+
+
+@dataclass
+class ParticipationTables(object):
+    # columnar tables, one row per proposal and one row per voter address
+    proposals: Dict[str, np.ndarray]
+    addresses: Dict[str, np.ndarray]
+
+    def __repr__(self) -> str:
+        return f"ParticipationTables(n_proposals={len(self.proposals['id'])}, n_addresses={len(self.addresses['address'])})"
+
+
+def holder_masks(holdings: Dict[str, Dict[int, int]]) -> Tuple[np.ndarray, np.ndarray]:
+    # (sorted lowercase holder addresses, bit mask of held citizen ids in `CitizenId` order)
+    ids = [id.value for id in CitizenId]
+    holders = np.array([address.lower() for address in holdings], dtype=str)
+    masks = np.array([
+        sum(1 << i for i, id in enumerate(ids) if balances.get(id, 0) > 0)
+        for balances in holdings.values()
+    ], dtype=np.int64)
+    order = np.argsort(holders)
+    return holders[order], masks[order]
+
+
+def join_citizen_votes(
+    votes: Dict[str, VoteArrays],
+    holdings: Dict[str, Dict[int, int]],
+    created: Optional[Dict[str, int]] = None
+) -> ParticipationTables:
+    # votes of every proposal joined with citizen holdings on sorted address arrays,
+    # `created` orders proposals for repeat voters and defaults to the first vote of each proposal
+    proposal_ids = list(votes)
+    n_proposals = len(proposal_ids)
+    if created is None:
+        created = {id: int(arrays.created.min()) if len(arrays) > 0 else 0 for id, arrays in votes.items()}
+
+    # global voter codes over all proposals, hashed rather than sorted
+    addresses, inverse = factorize([voter.lower() for arrays in votes.values() for voter in arrays.voters.tolist()])
+    offsets = np.cumsum([0] + [len(arrays.voters) for arrays in votes.values()])
+    voter = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+        inverse[offsets[i]:offsets[i + 1]][arrays.voter] for i, arrays in enumerate(votes.values())
+    ])
+    proposal = np.repeat(np.arange(n_proposals), [len(arrays) for arrays in votes.values()])
+    vp = np.concatenate([np.zeros(0)] + [arrays.vp for arrays in votes.values()])
+
+    # citizen tiers of every address
+    holders, masks = holder_masks(holdings)
+    position = np.clip(np.searchsorted(holders, addresses), 0, max(0, len(holders) - 1))
+    matched = (holders[position] == addresses) if len(holders) > 0 else np.zeros(len(addresses), dtype=bool)
+    address_mask = np.where(matched, masks[position] if len(holders) > 0 else 0, 0)
+    vote_mask = address_mask[voter]
+
+    # repeat voters already voted on an earlier proposal
+    order = np.array([created[id] for id in proposal_ids], dtype=np.int64)
+    rank = np.empty(n_proposals, dtype=np.int64)
+    rank[np.argsort(order, kind="stable")] = np.arange(n_proposals)
+    first_rank = np.full(len(addresses), n_proposals, dtype=np.int64)
+    np.minimum.at(first_rank, voter, rank[proposal])
+    is_repeat = rank[proposal] > first_rank[voter]
+
+    proposals = {
+        "id": np.array(proposal_ids, dtype=str),
+        "created": order,
+        "n_voters": np.bincount(proposal, minlength=n_proposals),
+        "vp": np.bincount(proposal, weights=vp, minlength=n_proposals),
+        "n_repeat_voters": np.bincount(proposal, weights=is_repeat, minlength=n_proposals).astype(np.int64),
+        "n_non_citizen_voters": np.bincount(proposal, weights=vote_mask == 0, minlength=n_proposals).astype(np.int64),
+        "non_citizen_vp": np.bincount(proposal, weights=vp * (vote_mask == 0), minlength=n_proposals),
+    }
+    for i, id in enumerate(CitizenId):
+        holds = (vote_mask >> i) & 1
+        n_holders = int(np.count_nonzero((masks >> i) & 1))
+        name = id.name.lower()
+        proposals[f"n_{name}_voters"] = np.bincount(proposal, weights=holds, minlength=n_proposals).astype(np.int64)
+        proposals[f"{name}_vp"] = np.bincount(proposal, weights=vp * holds, minlength=n_proposals)
+        proposals[f"{name}_turnout"] = proposals[f"n_{name}_voters"] / n_holders if n_holders > 0 else np.zeros(n_proposals)
+
+    last_rank = np.full(len(addresses), -1, dtype=np.int64)
+    np.maximum.at(last_rank, voter, rank[proposal])
+    sorted_created = np.sort(order)
+    address_table = {
+        "address": addresses,
+        "n_votes": np.bincount(voter, minlength=len(addresses)),
+        "vp": np.bincount(voter, weights=vp, minlength=len(addresses)),
+        "first_vote_created": sorted_created[first_rank] if n_proposals > 0 else np.zeros(0, dtype=np.int64),
+        "last_vote_created": sorted_created[last_rank] if n_proposals > 0 else np.zeros(0, dtype=np.int64),
+        "citizen_mask": address_mask,
+        "is_citizen": address_mask > 0,
+    }
+    return ParticipationTables(proposals=proposals, addresses=address_table)
+
+
+class SnapshotAnalytics(object):
+
+    def __init__(self, api: Optional[SnapshotAPI] = None) -> None:
+        self.api = SnapshotAPI() if api is None else api
+
+    def load_votes(self, proposal: SnapshotProposal) -> VoteArrays:
+        return VoteArrays.from_table(self.api.get_votes_columnar(proposal))
+
+    def get_proposal_stats(self, proposal: SnapshotProposal) -> Dict[str, Any]:
+        votes = self.load_votes(proposal)
+        return {
+            "n_votes": len(votes),
+            "tally": votes.tally(),
+            "gini": votes.gini(),
+            "nakamoto": votes.nakamoto(),
+            "quorum_reached_at": votes.quorum_reached_at(proposal.quorum) if proposal.quorum else None,
+        }
+
+    def get_citizen_participation(
+        self,
+        proposals: Optional[List[SnapshotProposal]] = None,
+        holdings: Optional[Dict[str, Dict[int, int]]] = None,
+        citizen: Optional[CitizenNFT] = None
+    ) -> ParticipationTables:
+        # every proposal of the space by default, holdings from the local citizen holder index
+        proposals = self.api.get_proposals() if proposals is None else proposals
+        if holdings is None:
+            citizen = CitizenNFT() if citizen is None else citizen
+            holdings = citizen.get_holder_index().balances
+
+        votes = {proposal.id: self.load_votes(proposal) for proposal in proposals}
+        created = {proposal.id: proposal.start for proposal in proposals}
+        return join_citizen_votes(votes, holdings, created=created)
@@ -1,23 +1,145 @@
+import datetime
 import logging
-from typing import Optional
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
 
 import telegram
-from telegram.ext import CommandHandler, Updater
+from telegram import Update
+from telegram.ext import CallbackContext, CommandHandler, Updater
 from telegram.parsemode import ParseMode
 
+from citydao.broadcast import Delivery, SendQueue, SubscriptionStore
 from citydao.calendar import CityDAOCalendar
 from citydao.snapshot import SnapshotAPI
 from citydao.spotify import CityDAOSpotify
 from citydao.treasury import CityDAOTreasury
 from citydao.tweets import CityDAOTwitter
+from citydao.utils import StaleWhileRevalidateCache, escape_markdown_v2
+
+
+DEFAULT_REPORT_TIMEOUTS = {
+    "tweets": 60.,
+    "spotify": 30.,
+    "treasury": 60.,
+    "calendar": 30.,
+    "proposals": 60.,
+}
+
+
+# how long a rendered command reply is served before it is refreshed in the background
+DEFAULT_CACHE_TTLS = {
+    "tweets": 300.,
+    "spotify": 600.,
+    "treasury": 120.,
+    "calendar": 300.,
+    "proposals": 60.,
+}
+
+
+@dataclass
+class ReportSource(object):
+    name: str
+    fetch: Callable[[], Optional[str]]
+    timeout: float = 60.
+
+
+@dataclass
+class ReportSection(object):
+    name: str
+    message: Optional[str] = None
+    error: Optional[str] = None
+    elapsed: float = 0.
+
+    @property
+    def missed_deadline(self) -> bool:
+        return self.error == "timeout"
+
+
+class ReportPipeline(object):
+    # every source runs at once, sections are handed out in source order as soon as
+    # they and all sections before them are done, a source is given up after its timeout
+
+    def __init__(self, sources: List[ReportSource]) -> None:
+        self.sources = sources
+        self.logger = logging.getLogger(__name__)
+
+    def __repr__(self) -> str:
+        return f"ReportPipeline({[source.name for source in self.sources]})"
+
+    @staticmethod
+    def _start(source: ReportSource) -> Future:
+        # daemon threads, a hung client must not keep the process alive
+        future = Future()
+
+        def target() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(source.fetch())
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, name=f"report-{source.name}", daemon=True).start()
+        return future
+
+    def run(self, on_section: Optional[Callable[[ReportSection], None]] = None) -> List[ReportSection]:
+        started_at = time.monotonic()
+        futures = [self._start(source) for source in self.sources]
+
+        sections = []
+        for source, future in zip(self.sources, futures):
+            section = ReportSection(name=source.name)
+            try:
+                section.message = future.result(timeout=max(0., started_at + source.timeout - time.monotonic()))
+            except FutureTimeoutError:
+                section.error = "timeout"
+                self.logger.warning(f"Report source {source.name} missed its {source.timeout}s deadline")
+            except Exception as e:
+                section.error = repr(e)
+                self.logger.exception(f"Report source {source.name} failed")
+            section.elapsed = time.monotonic() - started_at
+
+            sections.append(section)
+            if on_section is not None:
+                on_section(section)
+        return sections
+
+    @staticmethod
+    def format_failures(sections: List[ReportSection]) -> Optional[str]:
+        missed = [section.name for section in sections if section.missed_deadline]
+        failed = [section.name for section in sections if section.error is not None and not section.missed_deadline]
+        if len(missed) == 0 and len(failed) == 0:
+            return None
+
+        template = ""
+        if len(missed) > 0:
+            template += f"⏳ No response in time from: {escape_markdown_v2(', '.join(missed))}\n"
+        if len(failed) > 0:
+            template += f"⚠️ Failed to fetch: {escape_markdown_v2(', '.join(failed))}\n"
+        return template[:-1]
 
 
 class Bot(object):
 
-    def __init__(self, **kwargs) -> None:
+    def __init__(
+        self,
+        cache_ttls: Optional[Dict[str, float]] = None,
+        discover_tokens: bool = False,
+        **kwargs
+    ) -> None:
         self.snapshot = SnapshotAPI()
         self.citydao_twitter = None
-        self.treasury = CityDAOTreasury()
+        self.citydao_spotify = None
+        self.calendar = None
+        # with `discover_tokens` the treasury section covers every token the safes have received
+        self.treasury = CityDAOTreasury(discover_tokens=discover_tokens)
+        self.cache_ttls = {**DEFAULT_CACHE_TTLS, **({} if cache_ttls is None else cache_ttls)}
+        self.message_cache = StaleWhileRevalidateCache()
+        self.chat_id = None
 
     def init_spotify(self, client_id: str, client_credentials) -> None:
         self.citydao_spotify = CityDAOSpotify(client_id, client_credentials)
@@ -43,74 +165,167 @@ class Bot(object):
     def get_spotify_msg(self) -> str:
         return self.citydao_spotify.get_daily_summary()
 
+    def get_message_sources(self) -> Dict[str, Callable[[], Optional[str]]]:
+        # in the order the report sections are sent, sources that were not initialized are skipped
+        sources = [
+            ("tweets", self.get_tweets_msg, self.citydao_twitter),
+            ("spotify", self.get_spotify_msg, self.citydao_spotify),
+            ("treasury", self.get_treasury_msg, self.treasury),
+            ("calendar", self.get_calendar_msg, self.calendar),
+            ("proposals", self.get_proposals_msg, self.snapshot),
+        ]
+        return {name: fetch for name, fetch, client in sources if client is not None}
+
+    def get_cached_msg(self, name: str) -> Optional[str]:
+        return self.message_cache.get(name, self.get_message_sources()[name], ttl=self.cache_ttls[name])
+
+    def warm_message_cache(self) -> None:
+        for name, fetch in self.get_message_sources().items():
+            self.message_cache.refresh(name, fetch)
+
+    def get_report_sources(self, timeouts: Optional[Dict[str, float]] = None) -> List[ReportSource]:
+        timeouts = {**DEFAULT_REPORT_TIMEOUTS, **({} if timeouts is None else timeouts)}
+        return [
+            ReportSource(name=name, fetch=fetch, timeout=timeouts[name])
+            for name, fetch in self.get_message_sources().items()
+        ]
+
+    def send_daily_report(
+        self,
+        timeouts: Optional[Dict[str, float]] = None,
+        broadcast: bool = False
+    ) -> List[ReportSection]:
+        # with `broadcast` every section also goes to the subscribed chats
+        send = self.broadcast if broadcast else self.send_message
+
+        def on_section(section: ReportSection) -> None:
+            if section.message is not None:
+                send(section.message)
+
+        sections = ReportPipeline(self.get_report_sources(timeouts)).run(on_section)
+        # missed deadlines are only reported to the default chat
+        failures = ReportPipeline.format_failures(sections)
+        if failures is not None and self.chat_id is not None:
+            self.send_message(failures)
+        return sections
+
     def send_message(self, msg: str) -> None:
         raise NotImplementedError()
 
+    def broadcast(self, msg: str) -> None:
+        raise NotImplementedError()
+
     def run(self) -> None:
         raise NotImplementedError
 
 
 class TelegramBot(Bot):
 
-    def __init__(self, token: str, chat_id: Optional[str] = None) -> None:
-        super().__init__()
+    def __init__(
+        self,
+        token: str,
+        chat_id: Optional[str] = None,
+        cache_ttls: Optional[Dict[str, float]] = None,
+        subscriptions: Optional[SubscriptionStore] = None,
+        send_queue: Optional[SendQueue] = None,
+        discover_tokens: bool = False
+    ) -> None:
+        super().__init__(cache_ttls=cache_ttls, discover_tokens=discover_tokens)
         self.bot = telegram.Bot(token=token)
         self.updater = Updater(token=token, use_context=True)
         self.dispatcher = self.updater.dispatcher
         self.chat_id = chat_id
+        self.subscriptions = SubscriptionStore() if subscriptions is None else subscriptions
+        self.send_queue = SendQueue(self.bot) if send_queue is None else send_queue
 
     def set_chat_id(self, chat_id: str) -> None:
         self.chat_id = chat_id
 
-    def send_message(self, msg: str, parse_mode: ParseMode = ParseMode.MARKDOWN_V2) -> None:
+    def send_message(
+        self,
+        msg: str,
+        parse_mode: ParseMode = ParseMode.MARKDOWN_V2,
+        chat_id: Optional[str] = None
+    ) -> None:
+        # long messages are split at 4096 characters and sent under the flood limits
         if msg is None or len(msg) == 0:
             return
-        self.bot.send_message(
-            chat_id=self.chat_id,
-            text=msg,
-            parse_mode=parse_mode
-        )
-
-    def proposal_handler(self) -> None:
-        self.send_message(
-            self.get_proposals_msg(),
-        )
-        self.bot.send_message()
+        delivery = self.send_queue.send(self.chat_id if chat_id is None else chat_id, msg, parse_mode)
+        if delivery.error is not None:
+            raise delivery.error
 
-    def run(self) -> None:
-        logging.info("Starting telegram bot...")
+    def get_broadcast_chat_ids(self) -> List[str]:
+        chat_ids = [] if self.chat_id is None else [str(self.chat_id)]
+        return chat_ids + [chat_id for chat_id in self.subscriptions.get_chat_ids() if chat_id not in chat_ids]
 
-        self.updater.dispatcher.add_handler(
-            CommandHandler(
-                "proposals",
-                self.get_proposals_msg
-            )
-        )
+    def broadcast(self, msg: str, parse_mode: ParseMode = ParseMode.MARKDOWN_V2) -> List[Delivery]:
+        # the default chat and every subscribed chat, concurrently,
+        # chats that blocked the bot are unsubscribed and migrated groups follow their new id
+        if msg is None or len(msg) == 0:
+            return []
+        deliveries = self.send_queue.broadcast(self.get_broadcast_chat_ids(), msg, parse_mode)
+        for delivery in deliveries:
+            if delivery.migrated_to is not None:
+                self.subscriptions.migrate(delivery.chat_id, delivery.migrated_to)
+            if delivery.blocked:
+                self.subscriptions.remove(delivery.chat_id)
+        n_failed = sum(not delivery.ok for delivery in deliveries)
+        if n_failed > 0:
+            logging.warning(f"Broadcast failed for {n_failed} of {len(deliveries)} chats")
+        return deliveries
 
-        self.updater.dispatcher.add_handler(
-            CommandHandler(
-                "tweets",
-                self.get_tweets_msg
-            )
-        )
+    def command_handler(self, name: str) -> Callable[[Update, CallbackContext], None]:
+        # replies from the message cache, upstream is only hit once per ttl whatever the chat traffic
+        def handler(update: Update, context: CallbackContext) -> None:
+            if name not in self.get_message_sources():
+                msg = f"{escape_markdown_v2(name)} is not configured on this bot"
+            else:
+                try:
+                    msg = self.get_cached_msg(name) or f"Nothing new from {escape_markdown_v2(name)} today"
+                except Exception:
+                    logging.exception(f"Failed to build the {name} message")
+                    msg = f"Could not fetch {escape_markdown_v2(name)} right now, please try again later"
+            self.send_queue.send(update.effective_chat.id, msg)
 
-        self.updater.dispatcher.add_handler(
-            CommandHandler(
-                "calendar",
-                self.get_calendar_msg
-            )
-        )
+        return handler
 
-        self.updater.dispatcher.add_handler(
-            CommandHandler(
-                "treasury",
-                self.get_treasury_msg
-            )
-        )
+    def subscribe_handler(self, update: Update, context: CallbackContext) -> None:
+        chat = update.effective_chat
+        if self.subscriptions.add(chat.id, chat.title or chat.username):
+            msg = "Subscribed, the daily report will be sent to this chat"
+        else:
+            msg = "This chat is already subscribed"
+        self.send_queue.send(chat.id, escape_markdown_v2(msg))
+
+    def unsubscribe_handler(self, update: Update, context: CallbackContext) -> None:
+        if self.subscriptions.remove(update.effective_chat.id):
+            msg = "Unsubscribed from the daily report"
+        else:
+            msg = "This chat is not subscribed"
+        self.send_queue.send(update.effective_chat.id, escape_markdown_v2(msg))
+
+    def daily_report_job(self, context: CallbackContext) -> None:
+        self.send_daily_report(broadcast=True)
 
-        self.updater.dispatcher.add_handler(
-            CommandHandler(
-                "spotify",
-                self.get_spotify_msg
+    def run(self, report_time: Optional[datetime.time] = None) -> None:
+        logging.info("Starting telegram bot...")
+
+        # the broadcast runs in this process so it reads the subscriptions /subscribe writes
+        if report_time is not None:
+            self.updater.job_queue.run_daily(self.daily_report_job, time=report_time, name="daily-report")
+
+        for name in ["proposals", "tweets", "calendar", "treasury", "spotify"]:
+            self.updater.dispatcher.add_handler(
+                CommandHandler(
+                    name,
+                    self.command_handler(name),
+                    run_async=True
+                )
             )
-        )
+
+        self.updater.dispatcher.add_handler(CommandHandler("subscribe", self.subscribe_handler, run_async=True))
+        self.updater.dispatcher.add_handler(CommandHandler("unsubscribe", self.unsubscribe_handler, run_async=True))
+
+        self.warm_message_cache()
+        self.updater.start_polling()
+        self.updater.idle()
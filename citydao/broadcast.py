@@ -0,0 +1,176 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+
+import telegram
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, Unauthorized
+from telegram.parsemode import ParseMode
+
+from citydao.ratelimit import TokenBucket
+from citydao.utils import get_cache_dir, split_markdown_v2
+
+
+ChatId = Union[int, str]
+
+
+class SubscriptionStore(object):
+    # chats and channels that receive the daily report, kept across restarts.
+    # /subscribe and the broadcast must open the same file, `CITYDAO_SUBSCRIPTIONS_DB` moves it out of the cache dir
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        if path is None:
+            path = os.getenv("CITYDAO_SUBSCRIPTIONS_DB") or os.path.join(get_cache_dir(), "subscriptions.db")
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                chat_id TEXT PRIMARY KEY,
+                title TEXT,
+                subscribed_at INTEGER NOT NULL
+            );
+        """)
+
+    def __repr__(self) -> str:
+        return f"SubscriptionStore({self.path})"
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+
+    def add(self, chat_id: ChatId, title: Optional[str] = None) -> bool:
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO subscriptions VALUES (?, ?, ?)",
+                (str(chat_id), title, int(time.time()))
+            )
+        return cursor.rowcount > 0
+
+    def remove(self, chat_id: ChatId) -> bool:
+        with self.lock, self.conn:
+            cursor = self.conn.execute("DELETE FROM subscriptions WHERE chat_id = ?", (str(chat_id),))
+        return cursor.rowcount > 0
+
+    def migrate(self, chat_id: ChatId, new_chat_id: ChatId) -> None:
+        # groups upgraded to supergroups get a new id
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE OR REPLACE subscriptions SET chat_id = ? WHERE chat_id = ?",
+                (str(new_chat_id), str(chat_id))
+            )
+
+    def get_chat_ids(self) -> List[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT chat_id FROM subscriptions ORDER BY subscribed_at, rowid").fetchall()
+        return [row["chat_id"] for row in rows]
+
+
+@dataclass
+class Delivery(object):
+    chat_id: ChatId
+    n_messages: int
+    n_sent: int = 0
+    migrated_to: Optional[int] = None
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def blocked(self) -> bool:
+        # the bot was removed from the chat or blocked by the user
+        return isinstance(self.error, Unauthorized)
+
+
+class SendQueue(object):
+    # delivers to many chats concurrently under Telegram's flood limits:
+    # ~30 messages per second overall, 1 per second in a chat, 20 per minute in a group or channel.
+    # messages of a chat are always sent one at a time and in order
+
+    def __init__(
+        self,
+        bot: telegram.Bot,
+        global_rate: float = 30.,
+        chat_rate: float = 1.,
+        group_rate: float = 20. / 60.,
+        max_workers: int = 32,
+        max_retries: int = 5,
+        backoff_factor: float = 0.5
+    ) -> None:
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.chat_locks: Dict[str, threading.Lock] = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="telegram-send")
+        self.logger = logging.getLogger(__name__)
+
+    def __repr__(self) -> str:
+        return f"SendQueue(global_rate={self.global_bucket.rate})"
+
+    def _get_chat_state(self, chat_id: ChatId) -> Tuple[TokenBucket, threading.Lock]:
+        key = str(chat_id)
+        with self.lock:
+            if key not in self.buckets:
+                # private chats have positive ids, groups negative ones and channels can be @names
+                is_group = key.startswith("-") or key.startswith("@")
+                self.buckets[key] = TokenBucket(self.group_rate if is_group else self.chat_rate, capacity=1.)
+                self.chat_locks[key] = threading.Lock()
+            return self.buckets[key], self.chat_locks[key]
+
+    def _send(self, chat_id: ChatId, text: str, parse_mode: ParseMode) -> telegram.Message:
+        bucket, _ = self._get_chat_state(chat_id)
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            self.global_bucket.acquire()
+            try:
+                return self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.logger.warning(f"Flood limit on chat {chat_id}, retrying in {e.retry_after}s")
+                time.sleep(e.retry_after)
+            except BadRequest:
+                raise
+            except NetworkError:
+                # includes TimedOut, the message may be sent twice which is better than not at all
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff_factor * 2**attempt)
+
+    def deliver(self, chat_id: ChatId, messages: List[str], parse_mode: ParseMode = ParseMode.MARKDOWN_V2) -> Delivery:
+        delivery = Delivery(chat_id=chat_id, n_messages=len(messages))
+        _, chat_lock = self._get_chat_state(chat_id)
+        with chat_lock:
+            while delivery.n_sent < len(messages):
+                try:
+                    self._send(chat_id, messages[delivery.n_sent], parse_mode)
+                    delivery.n_sent += 1
+                except ChatMigrated as e:
+                    chat_id = delivery.migrated_to = e.new_chat_id
+                except Exception as e:
+                    self.logger.warning(f"Failed to deliver to chat {delivery.chat_id}: {e!r}")
+                    delivery.error = e
+                    break
+        return delivery
+
+    def send(self, chat_id: ChatId, msg: str, parse_mode: ParseMode = ParseMode.MARKDOWN_V2) -> Delivery:
+        return self.deliver(chat_id, split_markdown_v2(msg), parse_mode)
+
+    def broadcast(self, chat_ids: List[ChatId], msg: str, parse_mode: ParseMode = ParseMode.MARKDOWN_V2) -> List[Delivery]:
+        messages = split_markdown_v2(msg)
+        return list(self.executor.map(lambda chat_id: self.deliver(chat_id, messages, parse_mode), chat_ids))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
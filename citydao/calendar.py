@@ -1,9 +1,16 @@
+import logging
+import os
+import sqlite3
+import threading
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional
 
 import pytz
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from citydao.utils import get_cache_dir
 
 
 @dataclass
@@ -19,39 +26,184 @@ class CalendarEvent(object):
         return f"CalendarEvent(summary='{self.summary}', start_time={self.start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}, end_time={self.end_time.strftime('%Y-%m-%dT%H:%M:%SZ')}"
 
 
-class CityDAOCalendar(object):
+def parse_event_time(time: Dict[str, str]) -> datetime:
+    # timed events have a dateTime, all-day events only a date
+    if "dateTime" in time:
+        return datetime.fromisoformat(time["dateTime"].replace("Z", "+00:00")).astimezone(pytz.UTC)
+    return datetime.strptime(time["date"], "%Y-%m-%d").replace(tzinfo=pytz.UTC)
 
-    def __init__(self, google_apikey: str) -> None:
-        self.calendar_id = "c_4r6hnu78hifcmgimcgm0huhc6k@group.calendar.google.com"
-        self.service = build("calendar", "v3", developerKey=google_apikey)
-        self.timezone = "UTC"
-        self.url = f"https://calendar.google.com/calendar/u/0/embed?src=c_4r6hnu78hifcmgimcgm0huhc6k@group.calendar.google.com&ctz={self.timezone}"
 
-    def get_today_events(self) -> Any:
-        today = datetime.now()
-        start_time = today.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=pytz.UTC)
-        end_time = start_time + timedelta(days=1)
-        events = self.service.events().list(
-            calendarId=self.calendar_id, 
-            timeMin=start_time.strftime("%Y-%m-%dT%H:%M:%SZ"), 
-            timeMax=end_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
-            orderBy="startTime",
-            singleEvents=True,
-            timeZone=self.timezone
-        ).execute()
+class CalendarEventStore(object):
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = os.path.join(get_cache_dir(), "calendar.db") if path is None else path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sync_tokens (
+                calendar TEXT PRIMARY KEY,
+                token TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                id TEXT PRIMARY KEY,
+                calendar TEXT NOT NULL,
+                url TEXT,
+                summary TEXT,
+                creator TEXT,
+                start_time INTEGER,
+                end_time INTEGER,
+                meeting_url TEXT
+            );
+            CREATE INDEX IF NOT EXISTS events_calendar_start ON events (calendar, start_time);
+        """)
+
+    def __repr__(self) -> str:
+        return f"CalendarEventStore({self.path})"
+
+    def get_sync_token(self, calendar_id: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT token FROM sync_tokens WHERE calendar = ?", (calendar_id,)).fetchone()
+        return None if row is None else row["token"]
+
+    def clear(self, calendar_id: str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM events WHERE calendar = ?", (calendar_id,))
+            self.conn.execute("DELETE FROM sync_tokens WHERE calendar = ?", (calendar_id,))
+
+    def apply_changes(self, calendar_id: str, items: List[Dict[str, Any]], sync_token: Optional[str]) -> None:
+        # cancelled events are deleted, everything else is upserted
+        with self.lock, self.conn:
+            for item in items:
+                if item.get("status") == "cancelled":
+                    self.conn.execute("DELETE FROM events WHERE id = ?", (item["id"],))
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        item["id"], calendar_id, item.get("htmlLink"), item.get("summary", ""),
+                        item.get("creator", {}).get("email", "").split("@")[0],
+                        int(parse_event_time(item["start"]).timestamp()),
+                        int(parse_event_time(item["end"]).timestamp()),
+                        item.get("hangoutLink")
+                    )
+                )
+            if sync_token is not None:
+                self.conn.execute(
+                    "INSERT INTO sync_tokens (calendar, token) VALUES (?, ?) ON CONFLICT(calendar) DO UPDATE SET token = excluded.token",
+                    (calendar_id, sync_token)
+                )
 
+    def get_events(self, calendar_id: str, start_time: datetime, end_time: datetime) -> List[CalendarEvent]:
+        # events overlapping [start_time, end_time)
+        with self.lock:
+            rows = self.conn.execute(
+                """SELECT * FROM events WHERE calendar = ? AND start_time < ? AND end_time > ?
+                    ORDER BY start_time""",
+                (calendar_id, int(end_time.timestamp()), int(start_time.timestamp()))
+            ).fetchall()
         return [
             CalendarEvent(
-                url=event["htmlLink"],
-                summary=event["summary"],
-                creator=event["creator"]["email"].split("@")[0],
-                start_time=datetime.strptime(event["start"]["dateTime"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.timezone(self.timezone)),
-                end_time=datetime.strptime(event["end"]["dateTime"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=pytz.timezone(self.timezone)),
-                meeting_url=event.get("hangoutLink", None)
+                url=row["url"],
+                summary=row["summary"],
+                creator=row["creator"],
+                start_time=datetime.fromtimestamp(row["start_time"], tz=pytz.UTC),
+                end_time=datetime.fromtimestamp(row["end_time"], tz=pytz.UTC),
+                meeting_url=row["meeting_url"]
             )
-            for event in events["items"]
+            for row in rows
         ]
 
+
+class CityDAOCalendar(object):
+
+    # httplib2 is not thread-safe, every thread builds its own services
+    _local = threading.local()
+
+    def __init__(
+        self,
+        google_apikey: str,
+        store: Optional[CalendarEventStore] = None,
+        full_sync_window: timedelta = timedelta(days=7)
+    ) -> None:
+        self.calendar_id = "c_4r6hnu78hifcmgimcgm0huhc6k@group.calendar.google.com"
+        self.google_apikey = google_apikey
+        self.timezone = "UTC"
+        self.url = f"https://calendar.google.com/calendar/u/0/embed?src=c_4r6hnu78hifcmgimcgm0huhc6k@group.calendar.google.com&ctz={self.timezone}"
+        self.store = CalendarEventStore() if store is None else store
+        self.full_sync_window = full_sync_window
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def service(self) -> Any:
+        # built on first use from the discovery document shipped with the client library,
+        # and shared by every instance using the same key on the same thread
+        services = getattr(CityDAOCalendar._local, "services", None)
+        if services is None:
+            services = CityDAOCalendar._local.services = {}
+        service = services.get(self.google_apikey)
+        if service is None:
+            service = services[self.google_apikey] = build(
+                "calendar", "v3",
+                developerKey=self.google_apikey,
+                static_discovery=True,
+                cache_discovery=False
+            )
+        return service
+
+    def _list_changes(self, sync_token: Optional[str]) -> None:
+        # a full sync only covers events since `full_sync_window` ago instead of the whole history,
+        # incremental syncs can not be bounded and return every change since the token
+        page_token = None
+        time_min = datetime.now(tz=pytz.UTC) - self.full_sync_window
+        while True:
+            params = {"calendarId": self.calendar_id, "singleEvents": True, "timeZone": self.timezone}
+            if sync_token is not None:
+                params["syncToken"] = sync_token
+            else:
+                params["timeMin"] = time_min.strftime("%Y-%m-%dT%H:%M:%SZ")
+            if page_token is not None:
+                params["pageToken"] = page_token
+            events = self.service.events().list(**params).execute()
+
+            # the sync token only comes with the last page
+            self.store.apply_changes(self.calendar_id, events.get("items", []), events.get("nextSyncToken"))
+            page_token = events.get("nextPageToken")
+            if page_token is None:
+                return
+
+    def sync(self) -> None:
+        # incremental with the stored sync token, a full sync when there is none or it expired
+        sync_token = self.store.get_sync_token(self.calendar_id)
+        if sync_token is None:
+            self.store.clear(self.calendar_id)
+        try:
+            self._list_changes(sync_token)
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            self.logger.info("Calendar sync token expired, running a full sync")
+            self.store.clear(self.calendar_id)
+            self._list_changes(None)
+
+    def get_events(self, start_time: datetime, end_time: datetime, sync: bool = True) -> List[CalendarEvent]:
+        if sync:
+            self.sync()
+        return self.store.get_events(self.calendar_id, start_time, end_time)
+
+    def get_today_events(self, sync: bool = True) -> List[CalendarEvent]:
+        start_time = datetime.now(tz=pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+        return self.get_events(start_time, start_time + timedelta(days=1), sync=sync)
+
+    def get_week_events(self, sync: bool = True) -> List[CalendarEvent]:
+        today = datetime.now(tz=pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+        start_time = today - timedelta(days=today.weekday())
+        return self.get_events(start_time, start_time + timedelta(days=7), sync=sync)
+
+    def get_upcoming_events(self, days: int = 7, sync: bool = True) -> List[CalendarEvent]:
+        start_time = datetime.now(tz=pytz.UTC)
+        return self.get_events(start_time, start_time + timedelta(days=days), sync=sync)
+
     def format_events(self, events: List[CalendarEvent]) -> Optional[str]:
         if len(events) == 0:
             return None
@@ -70,6 +222,6 @@ class CityDAOCalendar(object):
 
         return template
 
-    def get_daily_summary(self) -> str:
-        today_events = self.get_today_events()
+    def get_daily_summary(self, sync: bool = True) -> str:
+        today_events = self.get_today_events(sync=sync)
         return self.format_events(today_events)
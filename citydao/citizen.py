@@ -1,12 +1,19 @@
 import json
+import logging
 import os
+import sqlite3
+import threading
 from enum import Enum
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import requests
 from web3 import Web3
+from web3.types import BlockIdentifier, LogReceipt
 
-from citydao.utils import Web3Address
+from citydao.indexer import LogScanner, get_start_block, topic_to_address
+from citydao.multicall import Multicall
+from citydao.snapshot import SnapshotAPI, SnapshotProposal, SnapshotVote
+from citydao.utils import ContractFactory, TTLCache, Web3Address, get_cache_dir
 
 
 class NFTAddress(Enum):
@@ -19,23 +26,233 @@ class CitizenId(Enum):
     FIRST_CITIZEN = 7
 
 
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+
+class CitizenHolderStore(object):
+    # balance changes of every holder, the current balances are kept materialized
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = os.path.join(get_cache_dir(), "citizen.db") if path is None else path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                name TEXT PRIMARY KEY,
+                block INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS balance_changes (
+                tx_hash TEXT NOT NULL,
+                log_index INTEGER NOT NULL,
+                batch_index INTEGER NOT NULL,
+                block INTEGER NOT NULL,
+                holder TEXT NOT NULL,
+                token_id INTEGER NOT NULL,
+                delta INTEGER NOT NULL,
+                PRIMARY KEY (tx_hash, log_index, batch_index, holder)
+            );
+            CREATE INDEX IF NOT EXISTS balance_changes_block ON balance_changes (block);
+            CREATE TABLE IF NOT EXISTS balances (
+                holder TEXT NOT NULL,
+                token_id INTEGER NOT NULL,
+                balance INTEGER NOT NULL,
+                PRIMARY KEY (holder, token_id)
+            );
+        """)
+
+    def __repr__(self) -> str:
+        return f"CitizenHolderStore({self.path})"
+
+    def get_checkpoint(self, name: str) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute("SELECT block FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row["block"]
+
+    def add_changes(self, name: str, block: int, changes: List[Tuple[str, int, int, int, str, int, int]]) -> None:
+        # changes and checkpoint in one transaction, replayed logs are ignored
+        with self.lock, self.conn:
+            for change in changes:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO balance_changes VALUES (?, ?, ?, ?, ?, ?, ?)", change)
+                if cursor.rowcount == 0:
+                    continue
+                holder, token_id, delta = change[4:]
+                self.conn.execute(
+                    """INSERT INTO balances (holder, token_id, balance) VALUES (?, ?, ?)
+                        ON CONFLICT(holder, token_id) DO UPDATE SET balance = balance + excluded.balance""",
+                    (holder, token_id, delta)
+                )
+            self.conn.execute("DELETE FROM balances WHERE balance = 0")
+            self.conn.execute(
+                "INSERT INTO checkpoints (name, block) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET block = excluded.block",
+                (name, block)
+            )
+
+    def get_balances(self, block: Optional[int] = None) -> List[Tuple[str, int, int]]:
+        with self.lock:
+            if block is None:
+                rows = self.conn.execute("SELECT holder, token_id, balance FROM balances").fetchall()
+            else:
+                rows = self.conn.execute(
+                    """SELECT holder, token_id, SUM(delta) AS balance FROM balance_changes
+                        WHERE block <= ? GROUP BY holder, token_id HAVING SUM(delta) != 0""",
+                    (block,)
+                ).fetchall()
+        return [tuple(row) for row in rows]
+
+
+class CitizenHolderIndex(object):
+    # replays TransferSingle / TransferBatch logs of the citizen contract into a local holder table
+
+    def __init__(
+        self,
+        provider: Optional[Web3] = None,
+        store: Optional[CitizenHolderStore] = None,
+        scanner: Optional[LogScanner] = None,
+        start_block: Optional[int] = None,
+        confirmations: int = 12
+    ) -> None:
+        # `start_block` defaults to the deployment block of the citizen contract
+        self.provider = Web3Address.get_default_provider() if provider is None else provider
+        self.store = CitizenHolderStore() if store is None else store
+        self.scanner = LogScanner(self.provider) if scanner is None else scanner
+        self.start_block = start_block
+        self.confirmations = confirmations
+        self.checkpoint_name = f"citizen:{NFTAddress.CITIZEN.value.lower()}"
+
+        topics = ContractFactory.get_event_topics(f"{os.path.dirname(os.path.abspath(__file__))}/abi/erc1150.json")
+        self.transfer_single_topic = topics["TransferSingle"]
+        self.transfer_batch_topic = topics["TransferBatch"]
+
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.holders = {}
+        self.logger = logging.getLogger(__name__)
+        for holder, token_id, balance in self.store.get_balances():
+            self._update(holder, token_id, balance)
+
+    def __repr__(self) -> str:
+        return f"CitizenHolderIndex(n_holders={len(self.balances)})"
+
+    def _update(self, holder: str, token_id: int, delta: int) -> None:
+        balances = self.balances.setdefault(holder, {})
+        balance = balances.get(token_id, 0) + delta
+        if balance != 0:
+            balances[token_id] = balance
+            self.holders.setdefault(token_id, set()).add(holder)
+            return
+
+        balances.pop(token_id, None)
+        self.holders.get(token_id, set()).discard(holder)
+        if len(balances) == 0:
+            del self.balances[holder]
+
+    def _parse_logs(self, logs: List[LogReceipt]) -> List[Tuple[str, int, int, int, str, int, int]]:
+        changes = []
+        for log in logs:
+            topic0 = Web3.toHex(log["topics"][0])
+            data = Web3.toBytes(hexstr=log["data"]) if isinstance(log["data"], str) else bytes(log["data"])
+            if topic0 == self.transfer_single_topic:
+                ids, values = self.provider.codec.decode_abi(["uint256", "uint256"], data)
+                ids, values = [ids], [values]
+            elif topic0 == self.transfer_batch_topic:
+                ids, values = self.provider.codec.decode_abi(["uint256[]", "uint256[]"], data)
+            else:
+                continue
+
+            tx_hash = Web3.toHex(log["transactionHash"])
+            sender, recipient = topic_to_address(log["topics"][2]), topic_to_address(log["topics"][3])
+            if sender == recipient:
+                continue
+            for batch_index, (token_id, value) in enumerate(zip(ids, values)):
+                position = (tx_hash, log["logIndex"], batch_index, log["blockNumber"])
+                # mints and burns only move one side
+                if sender != ZERO_ADDRESS:
+                    changes.append(position + (sender, token_id, -value))
+                if recipient != ZERO_ADDRESS:
+                    changes.append(position + (recipient, token_id, value))
+        return changes
+
+    def sync(self, to_block: Optional[int] = None) -> int:
+        # resumes from the last checkpoint, returns the last indexed block
+        checkpoint = self.store.get_checkpoint(self.checkpoint_name)
+        if checkpoint is None and self.start_block is None:
+            self.start_block = get_start_block(self.provider, [NFTAddress.CITIZEN.value], self.logger)
+        from_block = self.start_block if checkpoint is None else checkpoint + 1
+        to_block = self.provider.eth.block_number - self.confirmations if to_block is None else to_block
+        if from_block > to_block:
+            return to_block
+
+        def on_chunk(logs: List[LogReceipt], block: int) -> None:
+            changes = self._parse_logs(logs)
+            self.store.add_changes(self.checkpoint_name, block, changes)
+            with self.lock:
+                for change in changes:
+                    self._update(*change[4:])
+
+        filters = [{
+            "address": NFTAddress.CITIZEN.value,
+            "topics": [[self.transfer_single_topic, self.transfer_batch_topic]]
+        }]
+        self.scanner.scan(filters, from_block, to_block, on_chunk)
+        return to_block
+
+    def get_holders(self, id: CitizenId) -> List[str]:
+        with self.lock:
+            return sorted(self.holders.get(id.value, ()))
+
+    def get_balance(self, address: str, id: CitizenId) -> int:
+        with self.lock:
+            return self.balances.get(Web3.toChecksumAddress(address), {}).get(id.value, 0)
+
+    def get_balances(self, address: str) -> Dict[int, int]:
+        with self.lock:
+            return dict(self.balances.get(Web3.toChecksumAddress(address), {}))
+
+    def get_snapshot(self, block: int) -> Dict[str, Dict[int, int]]:
+        # holder -> {id: balance} as of `block`
+        snapshot = {}
+        for holder, token_id, balance in self.store.get_balances(block):
+            snapshot.setdefault(holder, {})[token_id] = balance
+        return snapshot
+
+
 class CitizenNFT(object):
 
     def __init__(
         self, 
         opensea_apikey: Optional[str] = None, 
-        provider: Optional[Web3] = None
+        provider: Optional[Web3] = None,
+        cache_ttl: float = 60.,
+        historical_cache_ttl: float = 24 * 3600.
     ) -> None:
         self.opensea_apikey = opensea_apikey
         self.provider = Web3Address.get_default_provider() if provider is None else provider
         
         abi_path = f"{os.path.dirname(os.path.abspath(__file__))}/abi/erc1150.json"
         self.citizen_nft = Web3Address(NFTAddress.CITIZEN.value).get_contract(self.provider, abi_path)
+        self.holder_index = None
+        self.multicall = Multicall(self.provider)
+
+        # balances at a fixed block never change, "latest" ones only for a short while
+        self.cache_ttl = cache_ttl
+        self.historical_cache_ttl = historical_cache_ttl
+        self.balance_cache = TTLCache(maxsize=200000, ttl=cache_ttl)
 
     def set_opensea_apikey(self, apikey: str) -> None:
         self.opensea_apikey = apikey
 
-    def get_holders(self, id: CitizenId) -> List[Web3Address]:
+    def get_holder_index(self, sync: bool = True) -> CitizenHolderIndex:
+        if self.holder_index is None:
+            self.holder_index = CitizenHolderIndex(self.provider)
+        if sync:
+            self.holder_index.sync()
+        return self.holder_index
+
+    def get_holders(self, id: CitizenId, sync: bool = True) -> List[Web3Address]:
+        return [Web3Address.intern(holder) for holder in self.get_holder_index(sync).get_holders(id)]
+
+    def get_opensea_asset(self, id: CitizenId) -> Any:
         request_url = f"https://api.opensea.io/api/v1/assets/{NFTAddress.CITIZEN.value}/{id.value}"
         response = requests.get(
             request_url,
@@ -48,6 +265,73 @@ class CitizenNFT(object):
     def get_balance(self, address: Web3Address, id: CitizenId) -> int:
         return self.citizen_nft.functions.balanceOf(account=address.address, id=id.value).call()
 
+    def get_balances_many(
+        self,
+        addresses: List[Union[str, Web3Address]],
+        ids: Optional[List[CitizenId]] = None,
+        block_identifier: BlockIdentifier = "latest",
+        chunk_size: int = 500,
+        chunks_per_call: int = 8
+    ) -> Dict[str, Dict[CitizenId, int]]:
+        # balanceOfBatch over (address, id) pairs in chunks, several chunks per Multicall3 eth_call
+        ids = list(CitizenId) if ids is None else ids
+        addresses = [address.address if isinstance(address, Web3Address) else address for address in addresses]
+        ttl = self.historical_cache_ttl if isinstance(block_identifier, int) else self.cache_ttl
+
+        balances = {address: {} for address in addresses}
+        missing = []
+        for address in balances:
+            for id in ids:
+                balance = self.balance_cache.get((block_identifier, address.lower(), id.value))
+                if balance is None:
+                    missing.append((address, id))
+                else:
+                    balances[address][id] = balance
+
+        chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+        functions = [
+            self.citizen_nft.functions.balanceOfBatch(
+                [Web3.toChecksumAddress(address) for address, _ in chunk],
+                [id.value for _, id in chunk]
+            )
+            for chunk in chunks
+        ]
+        outputs = self.multicall.call(functions, block_identifier=block_identifier, max_calls=chunks_per_call)
+        for chunk, function, output in zip(chunks, functions, outputs):
+            if output is None:
+                # surfaces the revert reason of the failed chunk
+                output = function.call(block_identifier=block_identifier)
+            for (address, id), balance in zip(chunk, output):
+                self.balance_cache.set((block_identifier, address.lower(), id.value), balance, ttl=ttl)
+                balances[address][id] = balance
+        return balances
+
+    def get_vote_share(
+        self,
+        votes: List[SnapshotVote],
+        block_identifier: BlockIdentifier = "latest"
+    ) -> Dict[str, float]:
+        # share of the voting power cast by holders of each citizen id, and of any of them
+        voters = list(dict.fromkeys(vote.voter.address for vote in votes))
+        balances = self.get_balances_many(voters, block_identifier=block_identifier)
+
+        total_vp = sum(vote.vp or 0. for vote in votes)
+        vp = {id.name: 0. for id in CitizenId}
+        vp["ANY"] = 0.
+        for vote in votes:
+            held = [id for id, balance in balances[vote.voter.address].items() if balance > 0]
+            for id in held:
+                vp[id.name] += vote.vp or 0.
+            if len(held) > 0:
+                vp["ANY"] += vote.vp or 0.
+        return {name: value / total_vp if total_vp > 0 else 0. for name, value in vp.items()}
+
+    def get_proposal_vote_share(self, proposal: SnapshotProposal, api: Optional[SnapshotAPI] = None) -> Dict[str, float]:
+        # holdings as of the proposal snapshot block
+        votes = proposal.votes if proposal.votes is not None else proposal.get_votes(api)
+        block_identifier = int(proposal.snapshot) if str(proposal.snapshot).isdigit() else "latest"
+        return self.get_vote_share(votes, block_identifier=block_identifier)
+
     def get_total_supply(self, id: CitizenId) -> int:
         if id == CitizenId.FIRST_CITIZEN:
             return 1
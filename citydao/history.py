@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+from web3 import Web3
+
+from citydao.utils import Web3Address, get_cache_dir
+
+
+def to_timestamp(time: Union[int, float, datetime]) -> int:
+    if isinstance(time, datetime):
+        return int(time.timestamp())
+    return int(time)
+
+
+def to_seconds(interval: Union[int, float, timedelta]) -> int:
+    if isinstance(interval, timedelta):
+        return int(interval.total_seconds())
+    return int(interval)
+
+
+class BlockTimestampIndex(object):
+    # maps timestamps to block numbers by searching block headers, headers are cached
+
+    def __init__(self, provider: Optional[Web3] = None) -> None:
+        self.provider = Web3Address.get_default_provider() if provider is None else provider
+        self.lock = threading.Lock()
+        self.timestamps = {}
+
+    def __repr__(self) -> str:
+        return f"BlockTimestampIndex(n_headers={len(self.timestamps)})"
+
+    def get_timestamp(self, block_number: int) -> int:
+        with self.lock:
+            timestamp = self.timestamps.get(block_number)
+        if timestamp is None:
+            timestamp = self.provider.eth.get_block(block_number)["timestamp"]
+            with self.lock:
+                self.timestamps[block_number] = timestamp
+        return timestamp
+
+    def get_block_number(self, timestamp: int, latest: Optional[int] = None) -> int:
+        # last block mined at or before `timestamp`, interpolation search
+        # falling back to bisection whenever a guess does not shrink the range enough
+        lo = 0
+        hi = self.provider.eth.block_number if latest is None else latest
+        t_lo, t_hi = self.get_timestamp(lo), self.get_timestamp(hi)
+        if timestamp >= t_hi:
+            return hi
+        if timestamp < t_lo:
+            return 0
+
+        # invariant: t_lo <= timestamp < t_hi
+        bisect = False
+        while hi - lo > 1:
+            if bisect:
+                guess = (lo + hi) // 2
+            else:
+                guess = lo + int((timestamp - t_lo) * (hi - lo) / max(1, t_hi - t_lo))
+                guess = min(max(guess, lo + 1), hi - 1)
+
+            size = hi - lo
+            t_guess = self.get_timestamp(guess)
+            if t_guess <= timestamp:
+                lo, t_lo = guess, t_guess
+            else:
+                hi, t_hi = guess, t_guess
+            bisect = not bisect and (hi - lo) * 2 > size
+        return lo
+
+
+class BalanceHistoryStore(object):
+    # append-only float64 records of (timestamp, block, *tickers), one file per column layout
+
+    def __init__(self, columns: List[str], cache_dir: Optional[str] = None) -> None:
+        self.columns = ["timestamp", "block"] + list(columns)
+        cache_dir = get_cache_dir() if cache_dir is None else cache_dir
+        layout = hashlib.sha1(json.dumps(self.columns).encode()).hexdigest()[:8]
+        self.path = os.path.join(cache_dir, f"treasury_history_{layout}.f64")
+        self.lock = threading.Lock()
+
+        with open(f"{self.path}.json", "w") as fp:
+            json.dump(self.columns, fp)
+
+    def __repr__(self) -> str:
+        return f"BalanceHistoryStore({self.path})"
+
+    def load(self) -> np.ndarray:
+        with self.lock:
+            if not os.path.exists(self.path):
+                return np.zeros((0, len(self.columns)))
+            records = np.fromfile(self.path, dtype=np.float64).reshape(-1, len(self.columns))
+        return records[np.argsort(records[:, 0], kind="stable")]
+
+    def append(self, records: np.ndarray) -> None:
+        with self.lock, open(self.path, "ab") as fp:
+            np.asarray(records, dtype=np.float64).reshape(-1, len(self.columns)).tofile(fp)
+
+    def to_dict(self, records: np.ndarray) -> Dict[str, np.ndarray]:
+        series = {column: records[:, i] for i, column in enumerate(self.columns)}
+        series["timestamp"] = series["timestamp"].astype(np.int64)
+        series["block"] = series["block"].astype(np.int64)
+        return series
@@ -0,0 +1,400 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+from web3 import Web3
+from web3.types import FilterParams, LogReceipt
+
+from citydao.utils import ContractFactory, Web3Address, get_cache_dir
+
+
+# substrings of the errors RPC providers return when a single eth_getLogs asks for too much
+TOO_MANY_RESULTS_ERRORS = (
+    "query returned more than",
+    "block range",
+    "response size exceeded",
+    "log response size",
+    "logs matched by query exceeds",
+    "query timeout exceeded",
+)
+
+# throttled requests must be retried as they are, splitting them only multiplies the load
+RATE_LIMIT_ERRORS = (
+    "429",
+    "too many requests",
+    "rate limit",
+    "request rate",
+)
+
+
+def get_error_message(error: Exception) -> str:
+    message = error.args[0] if len(error.args) > 0 else error
+    if isinstance(message, dict):
+        message = message.get("message", "")
+    return str(message).lower()
+
+
+def is_rate_limited(error: Exception) -> bool:
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code == 429:
+        return True
+    message = get_error_message(error)
+    return any(marker in message for marker in RATE_LIMIT_ERRORS)
+
+
+def is_too_many_results(error: Exception) -> bool:
+    if is_rate_limited(error):
+        return False
+    # a read timeout on eth_getLogs almost always means the node is scanning too many blocks
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    message = get_error_message(error)
+    return any(marker in message for marker in TOO_MANY_RESULTS_ERRORS)
+
+
+def address_to_topic(address: str) -> str:
+    return "0x" + address.lower()[2:].rjust(64, "0")
+
+
+def topic_to_address(topic: Any) -> str:
+    return Web3.toChecksumAddress("0x" + Web3.toHex(topic)[-40:])
+
+
+def find_deployment_block(provider: Web3, address: str, latest: Optional[int] = None) -> int:
+    # first block with code at `address`, bisecting eth_getCode needs ~25 calls to a node with historical state.
+    # 0 for addresses without code
+    hi = provider.eth.block_number if latest is None else latest
+    if len(provider.eth.get_code(address, hi)) == 0:
+        return 0
+    lo = 0
+    while lo < hi:
+        middle = (lo + hi) // 2
+        if len(provider.eth.get_code(address, middle)) > 0:
+            hi = middle
+        else:
+            lo = middle + 1
+    return lo
+
+
+def get_start_block(provider: Web3, addresses: List[str], logger: logging.Logger) -> int:
+    # the first sync starts at the oldest deployment instead of scanning ~15M empty blocks from genesis
+    try:
+        return min(find_deployment_block(provider, address) for address in addresses)
+    except (ValueError, requests.exceptions.RequestException) as e:
+        logger.warning(f"Could not find the deployment block of {addresses}, scanning from genesis: {e}")
+        return 0
+
+
+class LogScanner(object):
+    # eth_getLogs over block ranges in adaptive chunks, chunks shrink when the provider
+    # complains about the size of the response and grow back while ranges go through
+
+    def __init__(
+        self,
+        provider: Optional[Web3] = None,
+        chunk_size: int = 2000,
+        min_chunk_size: int = 1,
+        max_chunk_size: int = 500000,
+        max_workers: int = 4,
+        max_retries: int = 5,
+        backoff_factor: float = 1.
+    ) -> None:
+        self.provider = Web3Address.get_default_provider() if provider is None else provider
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def __repr__(self) -> str:
+        return f"LogScanner(chunk_size={self.chunk_size})"
+
+    def _shrink(self, size: int) -> None:
+        with self.lock:
+            self.chunk_size = max(self.min_chunk_size, min(self.chunk_size, size // 2))
+
+    def _grow(self, size: int) -> None:
+        with self.lock:
+            if size >= self.chunk_size:
+                self.chunk_size = min(self.max_chunk_size, self.chunk_size * 2)
+
+    def _get_logs_with_backoff(self, params: FilterParams) -> List[LogReceipt]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.provider.eth.get_logs(params)
+            except (ValueError, requests.exceptions.RequestException) as e:
+                if not is_rate_limited(e) or attempt == self.max_retries:
+                    raise
+                delay = self.backoff_factor * 2**attempt
+                self.logger.warning(f"eth_getLogs rate limited, retrying in {delay}s: {e}")
+                time.sleep(delay)
+
+    def get_logs(self, filter_params: FilterParams, from_block: int, to_block: int) -> List[LogReceipt]:
+        # logs of a single filter, the range is split in halves until the provider accepts it
+        size = to_block - from_block + 1
+        try:
+            logs = self._get_logs_with_backoff({**filter_params, "fromBlock": from_block, "toBlock": to_block})
+        except (ValueError, requests.exceptions.Timeout) as e:
+            if not is_too_many_results(e) or size <= self.min_chunk_size:
+                raise
+            self.logger.info(f"eth_getLogs {from_block}-{to_block} too large, splitting: {e}")
+            self._shrink(size)
+            middle = from_block + size // 2
+            return self.get_logs(filter_params, from_block, middle - 1) + self.get_logs(filter_params, middle, to_block)
+
+        self._grow(size)
+        return logs
+
+    def scan(
+        self,
+        filters: List[FilterParams],
+        from_block: int,
+        to_block: int,
+        on_chunk: Callable[[List[LogReceipt], int], None]
+    ) -> None:
+        # ranges of a wave are fetched concurrently, `on_chunk` receives the logs of the wave
+        # sorted by position and the last block covered so callers can checkpoint in order
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            start = from_block
+            while start <= to_block:
+                ranges = []
+                for _ in range(self.max_workers):
+                    if start > to_block:
+                        break
+                    end = min(to_block, start + self.chunk_size - 1)
+                    ranges.append((start, end))
+                    start = end + 1
+
+                jobs = [
+                    executor.submit(self.get_logs, filter_params, range_start, range_end)
+                    for range_start, range_end in ranges
+                    for filter_params in filters
+                ]
+                logs = {}
+                for job in jobs:
+                    for log in job.result():
+                        logs[(log["transactionHash"], log["logIndex"])] = log
+                on_chunk(sorted(logs.values(), key=lambda log: (log["blockNumber"], log["logIndex"])), ranges[-1][1])
+
+
+class TreasuryLogStore(object):
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = os.path.join(get_cache_dir(), "treasury.db") if path is None else path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                name TEXT PRIMARY KEY,
+                block INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS transfers (
+                tx_hash TEXT NOT NULL,
+                log_index INTEGER NOT NULL,
+                block INTEGER NOT NULL,
+                token TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (tx_hash, log_index)
+            );
+            CREATE INDEX IF NOT EXISTS transfers_block ON transfers (block);
+            CREATE INDEX IF NOT EXISTS transfers_token ON transfers (token, block);
+            CREATE TABLE IF NOT EXISTS executions (
+                tx_hash TEXT NOT NULL,
+                log_index INTEGER NOT NULL,
+                block INTEGER NOT NULL,
+                safe TEXT NOT NULL,
+                safe_tx_hash TEXT NOT NULL,
+                payment TEXT NOT NULL,
+                PRIMARY KEY (tx_hash, log_index)
+            );
+            CREATE INDEX IF NOT EXISTS executions_block ON executions (block);
+        """)
+
+    def __repr__(self) -> str:
+        return f"TreasuryLogStore({self.path})"
+
+    def get_checkpoint(self, name: str) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute("SELECT block FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row["block"]
+
+    def add_logs(
+        self,
+        name: str,
+        block: int,
+        transfers: List[Tuple[Any, ...]],
+        executions: List[Tuple[Any, ...]]
+    ) -> None:
+        # rows and checkpoint in the same transaction, so a crash never skips a range
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?)", transfers)
+            self.conn.executemany("INSERT OR REPLACE INTO executions VALUES (?, ?, ?, ?, ?, ?)", executions)
+            self.conn.execute(
+                "INSERT INTO checkpoints (name, block) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET block = excluded.block",
+                (name, block)
+            )
+
+    def get_transfers(
+        self,
+        token: Optional[str] = None,
+        from_block: Optional[int] = None,
+        to_block: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        query = "SELECT * FROM transfers WHERE 1 = 1"
+        params = []
+        if token is not None:
+            query += " AND token = ?"
+            params.append(Web3.toChecksumAddress(token))
+        if from_block is not None:
+            query += " AND block >= ?"
+            params.append(from_block)
+        if to_block is not None:
+            query += " AND block <= ?"
+            params.append(to_block)
+        query += " ORDER BY block, log_index"
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [{**row, "value": int(row["value"])} for row in map(dict, rows)]
+
+    def get_tokens(self, recipients: List[str]) -> List[str]:
+        # tokens in order of first receipt
+        with self.lock:
+            rows = self.conn.execute(
+                f"""SELECT token, MIN(block) AS first_block FROM transfers
+                    WHERE recipient IN ({", ".join("?" * len(recipients))})
+                    GROUP BY token ORDER BY first_block""",
+                recipients
+            ).fetchall()
+        return [row["token"] for row in rows]
+
+    def get_executions(self, from_block: Optional[int] = None, to_block: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM executions WHERE block >= ? AND block <= ? ORDER BY block, log_index",
+                (0 if from_block is None else from_block, 2**62 if to_block is None else to_block)
+            ).fetchall()
+        return [{**row, "payment": int(row["payment"])} for row in map(dict, rows)]
+
+
+class TreasuryIndexer(object):
+    # ERC-20 transfers in and out of the safes and executed safe transactions, kept in a local table
+
+    def __init__(
+        self,
+        treasury: Optional[Any] = None,
+        store: Optional[TreasuryLogStore] = None,
+        scanner: Optional[LogScanner] = None,
+        start_block: Optional[int] = None,
+        confirmations: int = 12
+    ) -> None:
+        # `start_block` defaults to the deployment block of the oldest safe,
+        # tokens sent to a safe before it was deployed are not indexed
+        if treasury is None:
+            from citydao.treasury import CityDAOTreasury
+            treasury = CityDAOTreasury()
+        self.treasury = treasury
+        self.provider = treasury.provider
+        self.store = TreasuryLogStore() if store is None else store
+        self.scanner = LogScanner(self.provider) if scanner is None else scanner
+        self.start_block = start_block
+        self.confirmations = confirmations
+
+        self.safes = [safe.address for safe in treasury.safe_addresses]
+        self.checkpoint_name = "treasury:" + ",".join(sorted(safe.lower() for safe in self.safes))
+
+        abi_dir = f"{os.path.dirname(os.path.abspath(__file__))}/abi"
+        self.transfer_topic = ContractFactory.get_event_topics(f"{abi_dir}/erc20.json")["Transfer"]
+        self.execution_topic = ContractFactory.get_event_topics(f"{abi_dir}/gnosis_safe.json")["ExecutionSuccess"]
+        self.logger = logging.getLogger(__name__)
+
+    def __repr__(self) -> str:
+        return f"TreasuryIndexer({self.safes}, checkpoint={self.store.get_checkpoint(self.checkpoint_name)})"
+
+    def get_filters(self) -> List[FilterParams]:
+        safe_topics = [address_to_topic(safe) for safe in self.safes]
+        return [
+            {"address": self.safes, "topics": [self.execution_topic]},
+            {"topics": [self.transfer_topic, safe_topics]},
+            {"topics": [self.transfer_topic, None, safe_topics]},
+        ]
+
+    def _parse_logs(self, logs: List[LogReceipt]) -> Tuple[List[Tuple[Any, ...]], List[Tuple[Any, ...]]]:
+        transfers, executions = [], []
+        for log in logs:
+            topics = log["topics"]
+            topic0 = Web3.toHex(topics[0])
+            tx_hash = Web3.toHex(log["transactionHash"])
+            data = Web3.toBytes(hexstr=log["data"]) if isinstance(log["data"], str) else bytes(log["data"])
+            if topic0 == self.transfer_topic:
+                # ERC-721 transfers share the topic but index the token id
+                if len(topics) != 3 or len(data) != 32:
+                    continue
+                transfers.append((
+                    tx_hash, log["logIndex"], log["blockNumber"], log["address"],
+                    topic_to_address(topics[1]), topic_to_address(topics[2]), str(int.from_bytes(data, "big"))
+                ))
+            elif topic0 == self.execution_topic and len(data) == 64:
+                executions.append((
+                    tx_hash, log["logIndex"], log["blockNumber"], log["address"],
+                    Web3.toHex(data[:32]), str(int.from_bytes(data[32:], "big"))
+                ))
+        return transfers, executions
+
+    def sync(self, to_block: Optional[int] = None) -> int:
+        # resumes from the last checkpoint, returns the last indexed block
+        checkpoint = self.store.get_checkpoint(self.checkpoint_name)
+        if checkpoint is None and self.start_block is None:
+            self.start_block = get_start_block(self.provider, self.safes, self.logger)
+        from_block = self.start_block if checkpoint is None else checkpoint + 1
+        to_block = self.provider.eth.block_number - self.confirmations if to_block is None else to_block
+        if from_block > to_block:
+            return to_block
+
+        def on_chunk(logs: List[LogReceipt], block: int) -> None:
+            transfers, executions = self._parse_logs(logs)
+            self.store.add_logs(self.checkpoint_name, block, transfers, executions)
+
+        self.scanner.scan(self.get_filters(), from_block, to_block, on_chunk)
+        return to_block
+
+    def get_transfers(
+        self,
+        token: Optional[str] = None,
+        direction: Optional[str] = None,
+        from_block: Optional[int] = None,
+        to_block: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        # direction is "in", "out" or None for both, transfers between safes are neither
+        safes = set(self.safes)
+        transfers = []
+        for transfer in self.store.get_transfers(token, from_block, to_block):
+            is_in, is_out = transfer["recipient"] in safes, transfer["sender"] in safes
+            if is_in == is_out:
+                continue
+            transfer["direction"] = "in" if is_in else "out"
+            if direction is None or direction == transfer["direction"]:
+                transfers.append(transfer)
+        return transfers
+
+    def get_received_tokens(self) -> List[str]:
+        return self.store.get_tokens(self.safes)
+
+    def get_flows(self, from_block: Optional[int] = None, to_block: Optional[int] = None) -> Dict[str, Dict[str, int]]:
+        # raw inflow / outflow per token
+        flows = {}
+        for transfer in self.get_transfers(from_block=from_block, to_block=to_block):
+            flow = flows.setdefault(transfer["token"], {"in": 0, "out": 0})
+            flow[transfer["direction"]] += transfer["value"]
+        return flows
@@ -0,0 +1,112 @@
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from eth_abi.exceptions import DecodingError
+from web3 import Web3
+from web3._utils.abi import get_abi_output_types
+from web3.contract import ContractFunction
+from web3.types import BlockIdentifier
+
+from citydao.utils import Web3Address
+
+
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL3_DEPLOY_BLOCK = 14353601
+
+
+class Multicall(object):
+
+    def __init__(self, provider: Optional[Web3] = None) -> None:
+        self.provider = Web3Address.get_default_provider() if provider is None else provider
+
+        abi_path = f"{os.path.dirname(os.path.abspath(__file__))}/abi/multicall3.json"
+        self.contract = Web3Address(MULTICALL3_ADDRESS).get_contract(self.provider, abi_path)
+
+    def __repr__(self) -> str:
+        return f"Multicall({MULTICALL3_ADDRESS})"
+
+    def get_eth_balance(self, address: str) -> ContractFunction:
+        return self.contract.functions.getEthBalance(address)
+
+    def _decode(self, function: ContractFunction, data: bytes) -> Any:
+        output_types = get_abi_output_types(function.abi)
+        outputs = self.provider.codec.decode_abi(output_types, data)
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def _call_batch(self, functions: List[ContractFunction], block_number: int) -> List[Union[Any, None]]:
+        # before Multicall3 was deployed, send plain eth_calls as one JSON-RPC batch
+        calls = []
+        for function in functions:
+            if function.address == MULTICALL3_ADDRESS and function.fn_name == "getEthBalance":
+                calls.append(("eth_getBalance", [function.args[0], hex(block_number)]))
+            else:
+                calls.append(("eth_call", [
+                    {"to": function.address, "data": function._encode_transaction_data()},
+                    hex(block_number)
+                ]))
+
+        outputs = []
+        for function, (method, _), response in zip(functions, calls, self.provider.provider.make_batch_request(calls)):
+            output = None
+            if "result" in response and method == "eth_getBalance":
+                output = int(response["result"], 16)
+            elif "result" in response and len(response["result"]) > 2:
+                try:
+                    output = self._decode(function, Web3.toBytes(hexstr=response["result"]))
+                except DecodingError:
+                    output = None
+            outputs.append(output)
+        return outputs
+
+    def encode(self, functions: List[ContractFunction], allow_failure: bool = True) -> Dict[str, str]:
+        # eth_call transaction of a single aggregate3, for callers doing their own transport
+        calls = [
+            (function.address, allow_failure, function._encode_transaction_data())
+            for function in functions
+        ]
+        return {"to": MULTICALL3_ADDRESS, "data": self.contract.functions.aggregate3(calls)._encode_transaction_data()}
+
+    def decode(self, functions: List[ContractFunction], data: bytes) -> List[Union[Any, None]]:
+        # raw return data of aggregate3 back to the outputs of `functions`
+        results = self._decode(self.contract.functions.aggregate3([]), data)
+        return self._decode_results(functions, results)
+
+    def _decode_results(self, functions: List[ContractFunction], results: List[Tuple[bool, bytes]]) -> List[Union[Any, None]]:
+        outputs = []
+        for function, (success, data) in zip(functions, results):
+            output = None
+            if success and len(data) > 0:
+                try:
+                    output = self._decode(function, data)
+                except DecodingError:
+                    output = None
+            outputs.append(output)
+        return outputs
+
+    def call(
+        self,
+        functions: List[ContractFunction],
+        block_identifier: BlockIdentifier = "latest",
+        allow_failure: bool = True,
+        max_calls: int = 500
+    ) -> List[Union[Any, None]]:
+        # all functions in as few eth_calls as possible, failed calls are returned as None
+        if len(functions) == 0:
+            return []
+
+        if (
+            isinstance(block_identifier, int)
+            and block_identifier < MULTICALL3_DEPLOY_BLOCK
+            and hasattr(self.provider.provider, "make_batch_request")
+        ):
+            return self._call_batch(functions, block_identifier)
+
+        calls = [
+            (function.address, allow_failure, function._encode_transaction_data())
+            for function in functions
+        ]
+        # stay under the gas cap of eth_call on large portfolios
+        results = []
+        for i in range(0, len(calls), max_calls):
+            results += self.contract.functions.aggregate3(calls[i:i + max_calls]).call(block_identifier=block_identifier)
+        return self._decode_results(functions, results)
@@ -0,0 +1,217 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+import requests
+from eth_utils import to_bytes
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3._utils.encoding import FriendlyJsonSerde
+from web3.providers.base import BaseProvider, JSONBaseProvider
+from web3.types import RPCEndpoint as RPCMethod
+from web3.types import RPCResponse
+
+from citydao.ratelimit import TokenBucket
+
+
+DEFAULT_RPC_URLS = [
+    "https://rpc.ankr.com/eth",
+    "https://cloudflare-eth.com",
+    "https://eth.llamarpc.com",
+]
+
+
+# JSON-RPC errors that come from the endpoint (rate limits, quotas, keys, disabled methods)
+# rather than from the call, another endpoint may well serve the same request
+ENDPOINT_ERRORS = (
+    "rate limit",
+    "too many requests",
+    "daily request count",
+    "quota",
+    "capacity",
+    "compute units",
+    "unauthorized",
+    "forbidden",
+    "api key",
+    "not supported",
+    "method not found",
+)
+
+
+def is_endpoint_error(payload: Any) -> bool:
+    for response in payload if isinstance(payload, list) else [payload]:
+        error = response.get("error") if isinstance(response, dict) else None
+        if not isinstance(error, dict):
+            continue
+        message = str(error.get("message", "")).lower()
+        if error.get("code") == -32601 or any(marker in message for marker in ENDPOINT_ERRORS):
+            return True
+    return False
+
+
+class RPCEndpoint(object):
+
+    def __init__(self, url: str, rate_limit: Optional[float] = None) -> None:
+        self.url = url
+        self.bucket = None if rate_limit is None else TokenBucket(rate_limit)
+        self.latency = 0.
+        self.n_failures = 0
+        self.unhealthy_until = 0.
+
+    def __repr__(self) -> str:
+        return f"RPCEndpoint({self.url}, latency={self.latency:.3f})"
+
+    def is_healthy(self) -> bool:
+        return self.unhealthy_until <= time.monotonic()
+
+    def record_success(self, latency: float) -> None:
+        # exponentially weighted latency
+        self.latency = latency if self.latency == 0. else 0.8 * self.latency + 0.2 * latency
+        self.n_failures = 0
+
+    def record_failure(self) -> None:
+        # back off exponentially, up to a minute
+        self.n_failures += 1
+        self.unhealthy_until = time.monotonic() + min(60., 2.**self.n_failures)
+
+
+class FailoverHTTPProvider(JSONBaseProvider):
+
+    def __init__(
+        self,
+        endpoints: List[Union[str, RPCEndpoint]],
+        timeout: float = 10.,
+        pool_maxsize: int = 16
+    ) -> None:
+        super().__init__()
+        if len(endpoints) == 0:
+            raise ValueError("FailoverHTTPProvider needs at least one RPC endpoint")
+        self.endpoints = [
+            endpoint if isinstance(endpoint, RPCEndpoint) else RPCEndpoint(endpoint)
+            for endpoint in endpoints
+        ]
+        self.timeout = timeout
+        self.logger = logging.getLogger(__name__)
+
+        adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+    def __repr__(self) -> str:
+        return f"FailoverHTTPProvider({[endpoint.url for endpoint in self.endpoints]})"
+
+    def _ranked_endpoints(self) -> List[RPCEndpoint]:
+        # healthy endpoints first, fastest first, unhealthy ones are kept as a last resort
+        return sorted(self.endpoints, key=lambda endpoint: (not endpoint.is_healthy(), endpoint.latency))
+
+    def _acquire_endpoints(self) -> Iterator[RPCEndpoint]:
+        # skip endpoints that are out of rate limit budget, only wait for them once all others failed
+        throttled = []
+        for endpoint in self._ranked_endpoints():
+            if endpoint.bucket is None or endpoint.bucket.try_acquire():
+                yield endpoint
+            else:
+                throttled.append(endpoint)
+
+        for endpoint in throttled:
+            endpoint.bucket.acquire()
+            yield endpoint
+
+    def _post(self, request_data: bytes, batch: bool = False) -> Any:
+        # the decoded payload of the first endpoint that serves the request, endpoints fail over on
+        # transport errors, any non-2xx status, endpoint errors in the body and batches answered with a single object
+        last_error = None
+        rejected = None
+        for endpoint in self._acquire_endpoints():
+            started_at = time.monotonic()
+            try:
+                response = self.session.post(endpoint.url, data=request_data, timeout=self.timeout)
+                response.raise_for_status()
+                payload = response.json()
+            except (requests.RequestException, ValueError) as e:
+                self.logger.warning(f"RPC endpoint {endpoint.url} failed: {e}")
+                endpoint.record_failure()
+                last_error = e
+                continue
+
+            if is_endpoint_error(payload) or (batch and not isinstance(payload, list)):
+                self.logger.warning(f"RPC endpoint {endpoint.url} rejected the request: {payload}")
+                endpoint.record_failure()
+                rejected = payload
+                continue
+
+            endpoint.record_success(time.monotonic() - started_at)
+            return payload
+
+        # every endpoint answered with an error, it is raised by the caller like any other JSON-RPC error
+        if rejected is not None:
+            return rejected
+        raise last_error
+
+    def make_request(self, method: RPCMethod, params: Any) -> RPCResponse:
+        return self._post(self.encode_rpc_request(method, params))
+
+    def make_batch_request(self, calls: List[Tuple[str, Any]]) -> List[RPCResponse]:
+        # raw JSON-RPC batch, params are sent as is
+        request_ids = [next(self.request_counter) for _ in calls]
+        request_data = to_bytes(text=FriendlyJsonSerde().json_encode([
+            {"jsonrpc": "2.0", "method": method, "params": params or [], "id": request_id}
+            for request_id, (method, params) in zip(request_ids, calls)
+        ]))
+        responses = self._post(request_data, batch=True)
+        if not isinstance(responses, list):
+            raise ValueError(f"RPC batch request was rejected by every endpoint: {responses}")
+        responses = {response["id"]: response for response in responses}
+        return [responses[request_id] for request_id in request_ids]
+
+    def isConnected(self) -> bool:
+        try:
+            response = self.make_request(RPCMethod("web3_clientVersion"), [])
+        except (IOError, ValueError, requests.RequestException):
+            return False
+        return "error" not in response
+
+
+class OfflineProvider(BaseProvider):
+    # a Web3 backend without a transport, for building and decoding calls that another client sends
+
+    def make_request(self, method: RPCMethod, params: Any) -> RPCResponse:
+        raise RuntimeError(f"{method} can not be sent through an OfflineProvider")
+
+    def isConnected(self) -> bool:
+        return False
+
+
+class ProviderRegistry(object):
+    # process wide Web3 instances, one per endpoint list
+
+    _providers = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get_rpc_urls() -> List[str]:
+        rpc_urls = os.getenv("CITYDAO_RPC_URLS")
+        if not rpc_urls:
+            return DEFAULT_RPC_URLS
+        urls = [url.strip() for url in rpc_urls.split(",") if url.strip()]
+        if len(urls) == 0:
+            raise ValueError(f"CITYDAO_RPC_URLS={rpc_urls!r} does not contain any RPC url")
+        return urls
+
+    @classmethod
+    def get(cls, endpoints: Optional[List[Union[str, RPCEndpoint]]] = None) -> Web3:
+        endpoints = cls.get_rpc_urls() if endpoints is None else endpoints
+        key = tuple(endpoint if isinstance(endpoint, str) else endpoint.url for endpoint in endpoints)
+        with cls._lock:
+            if key not in cls._providers:
+                cls._providers[key] = Web3(FailoverHTTPProvider(endpoints))
+            return cls._providers[key]
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._providers.clear()
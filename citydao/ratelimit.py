@@ -0,0 +1,38 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    # `rate` tokens are refilled per second up to `capacity`
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"TokenBucket(rate={self.rate}, capacity={self.capacity})"
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, tokens: float = 1.) -> float:
+        with self.lock:
+            self._refill()
+            return max(0., (tokens - self.tokens) / self.rate)
+
+    def try_acquire(self, tokens: float = 1.) -> bool:
+        with self.lock:
+            self._refill()
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def acquire(self, tokens: float = 1.) -> None:
+        while not self.try_acquire(tokens):
+            time.sleep(self.wait_time(tokens))
@@ -0,0 +1,80 @@
+import os
+import threading
+from typing import Dict, List, Optional
+
+from web3 import Web3
+
+from citydao.utils import TTLCache, Web3Address, get_cache_dir
+
+
+# ENS ReverseRecords, reverse resolves many addresses in one call and
+# only returns names whose forward resolution points back to the address
+REVERSE_RECORDS_ADDRESS = "0x3671aE578E63FdF66ad4F3E12CC0c0d71Ac7510C"
+
+_MISSING = object()
+
+
+class ENSResolver(object):
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(
+        self,
+        provider: Optional[Web3] = None,
+        cache_path: Optional[str] = None,
+        ttl: float = 7 * 24 * 3600.,
+        miss_ttl: float = 24 * 3600.,
+        maxsize: int = 100000,
+        batch_size: int = 200
+    ) -> None:
+        self.provider = Web3Address.get_default_provider() if provider is None else provider
+        self.miss_ttl = miss_ttl
+        self.batch_size = batch_size
+        self.cache = TTLCache(
+            maxsize=maxsize,
+            ttl=ttl,
+            path=os.path.join(get_cache_dir(), "ens.json") if cache_path is None else cache_path
+        )
+
+        abi_path = f"{os.path.dirname(os.path.abspath(__file__))}/abi/reverse_records.json"
+        self.reverse_records = Web3Address(REVERSE_RECORDS_ADDRESS).get_contract(self.provider, abi_path)
+
+    def __repr__(self) -> str:
+        return f"ENSResolver(cache={self.cache})"
+
+    @classmethod
+    def default(cls) -> "ENSResolver":
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def _get_names(self, addresses: List[str]) -> List[str]:
+        return self.reverse_records.functions.getNames(addresses).call()
+
+    def resolve_many(self, addresses: List[str]) -> Dict[str, Optional[str]]:
+        names = {}
+        unresolved = []
+        for address in dict.fromkeys(addresses):
+            name = self.cache.get(address.lower(), _MISSING)
+            if name is _MISSING:
+                unresolved.append(address)
+            else:
+                names[address] = name
+
+        for i in range(0, len(unresolved), self.batch_size):
+            batch = unresolved[i:i + self.batch_size]
+            resolved = self._get_names([Web3.toChecksumAddress(address) for address in batch])
+            for address, name in zip(batch, resolved):
+                # cache misses too, with a shorter ttl
+                name = name or None
+                self.cache.set(address.lower(), name, ttl=None if name is not None else self.miss_ttl)
+                names[address] = name
+
+        if len(unresolved) > 0:
+            self.cache.save()
+        return names
+
+    def resolve(self, address: str) -> Optional[str]:
+        return self.resolve_many([address])[address]
@@ -1,15 +1,113 @@
-import json
+import functools
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
-from typing import Any, Dict, List, Optional, Union
-
-import requests
-
-from citydao.utils import Web3Address
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from citydao.store import SnapshotStore
+from citydao.transport import GraphQLTransport
+from citydao.utils import Web3Address, escape_markdown_v2
+
+
+SNAPSHOT_HUB_URL = "https://hub.snapshot.org/graphql"
+
+# sentinels instead of null so filters are always bound
+MAX_CREATED = 2**31 - 1
+
+SPACE_QUERY = """query Space($id: String!) {
+    space(id: $id) {
+        id
+        name
+        about
+        network
+        symbol
+        members
+    }
+}"""
+
+PROPOSAL_FIELDS = """
+        id
+        title
+        body
+        choices
+        start
+        end
+        snapshot
+        state
+        scores
+        quorum
+        author
+        created
+"""
+
+PROPOSALS_QUERY = """query Proposals($space: String!, $first: Int!) {
+    proposals(
+        first: $first,
+        where: { space_in: [$space] },
+        orderBy: "created",
+        orderDirection: desc
+    ) {""" + PROPOSAL_FIELDS + """    }
+}"""
+
+PROPOSALS_BY_STATE_QUERY = """query Proposals($space: String!, $state: String!, $first: Int!) {
+    proposals(
+        first: $first,
+        where: { space_in: [$space], state: $state },
+        orderBy: "created",
+        orderDirection: desc
+    ) {""" + PROPOSAL_FIELDS + """    }
+}"""
+
+NEW_PROPOSALS_QUERY = """query Proposals($space: String!, $watermark: Int!, $first: Int!) {
+    proposals(
+        first: $first,
+        where: { space_in: [$space], created_gt: $watermark },
+        orderBy: "created",
+        orderDirection: asc
+    ) {""" + PROPOSAL_FIELDS + """    }
+}"""
+
+PROPOSAL_SCORES_QUERY = """query Proposals($ids: [String]!, $first: Int!) {
+    proposals(first: $first, where: { id_in: $ids }) {
+        id
+        state
+        scores
+    }
+}"""
+
+
+@functools.lru_cache(maxsize=None)
+def votes_query(n_proposals: int) -> str:
+    # one aliased `votes` field per proposal, query text only depends on batch size
+    fields = "".join(
+        f"""
+    p{i}: votes(
+        first: $first,
+        skip: $skip{i},
+        where: {{ proposal: $proposal{i}, created_lte: $cursor{i}, created_gte: $since{i} }},
+        orderBy: "created",
+        orderDirection: desc
+    ) {{
+        id
+        voter
+        created
+        choice
+        vp
+    }}"""
+        for i in range(n_proposals)
+    )
+    params = ", ".join(
+        f"$proposal{i}: String!, $skip{i}: Int!, $cursor{i}: Int!, $since{i}: Int!"
+        for i in range(n_proposals)
+    )
+    return f"query Votes($first: Int!, {params}) {{{fields}\n}}"
 
 
 class ProposalStatus(Enum):
+    PENDING = "pending"
     ACTIVE = "active"
     CLOSED = "closed"
 
@@ -24,10 +122,8 @@ class SnapshotSpace(object):
     about: Optional[str] = None
 
     def __post_init__(self):
-        self.members = [
-            Web3Address(member, resolve_ens=True)
-            for member in self.members
-        ]
+        self.members = [Web3Address(member) for member in self.members]
+        Web3Address.resolve_ens_many(self.members)
 
     def add_member(self, address: str) -> None:
         self.members.append(Web3Address(address, resolve_ens=True))
@@ -36,7 +132,7 @@ class SnapshotSpace(object):
         return f"SnapshotSpace(name='{self.name}', symbol='{self.symbol}')"
 
 
-@dataclass
+@dataclass(slots=True)
 class SnapshotProposal(object):
     id: str
     title: str
@@ -49,176 +145,475 @@ class SnapshotProposal(object):
     snapshot: str
     quorum: int
     scores: Optional[Dict[str, int]] = None
-    
+    space: str = "daocity.eth"
+    url: str = field(init=False, default="")
+    votes: Optional[List["SnapshotVote"]] = field(init=False, default=None, repr=False)
+
     def __post_init__(self) -> None:
         if isinstance(self.state, str):
             self.state = ProposalStatus(self.state)
-        self.url = f"https://snapshot.org/#/daocity.eth/proposal/{self.id}"
+        self.url = f"https://snapshot.org/#/{self.space}/proposal/{self.id}"
 
-    def get_votes(self) -> None:
-        self.votes = SnapshotAPI().get_votes(self)
+    def get_votes(self, api: Optional["SnapshotAPI"] = None) -> List["SnapshotVote"]:
+        api = SnapshotAPI(space=self.space) if api is None else api
+        self.votes = api.get_votes(self)
         return self.votes
 
     def __repr__(self) -> str:
         return f"CityDAOProposal(title='{self.title}', author={self.author.address})"
 
 
-@dataclass
+@dataclass(slots=True)
 class SnapshotVote(object):
     voter: Web3Address
     created: int
     choice: int
+    vp: Optional[float] = None
+
+    def __repr__(self) -> str:
+        return f"Vote({self.choice})"
+
+
+class VoteView(object):
+    __slots__ = ("table", "index")
+
+    def __init__(self, table: "VoteTable", index: int) -> None:
+        self.table = table
+        self.index = index
+
+    @property
+    def voter(self) -> Web3Address:
+        return Web3Address.intern(self.table.voters[self.table.voter[self.index]])
+
+    @property
+    def created(self) -> int:
+        return self.table.created[self.index]
+
+    @property
+    def choice_index(self) -> int:
+        return self.table.choice[self.index]
+
+    @property
+    def choice(self) -> str:
+        return self.table.choices[self.table.choice[self.index]]
+
+    @property
+    def vp(self) -> float:
+        return self.table.vp[self.index]
 
     def __repr__(self) -> str:
         return f"Vote({self.choice})"
 
 
+class VoteTable(object):
+    # columnar votes, voters are stored once and referenced by index,
+    # choice is stored as 0-based index of `choices`
+    __slots__ = ("choices", "voters", "voter", "created", "choice", "vp", "_voter_index")
+
+    def __init__(self, choices: List[str]) -> None:
+        self.choices = tuple(sys.intern(choice) for choice in choices)
+        self.voters = []
+        self.voter = array("i")
+        self.created = array("q")
+        self.choice = array("h")
+        self.vp = array("d")
+        self._voter_index = {}
+
+    def __len__(self) -> int:
+        return len(self.voter)
+
+    def __getitem__(self, index: int) -> VoteView:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return VoteView(self, index)
+
+    def __iter__(self) -> Iterator[VoteView]:
+        return (VoteView(self, i) for i in range(len(self)))
+
+    def __repr__(self) -> str:
+        return f"VoteTable(n_votes={len(self)}, n_voters={len(self.voters)})"
+
+    def _get_voter_id(self, voter: str) -> int:
+        voter_id = self._voter_index.get(voter)
+        if voter_id is None:
+            voter_id = self._voter_index[voter] = len(self.voters)
+            self.voters.append(sys.intern(voter))
+        return voter_id
+
+    def append(self, voter: str, created: int, choice: int, vp: float) -> None:
+        self.voter.append(self._get_voter_id(voter))
+        self.created.append(created)
+        self.choice.append(choice)
+        self.vp.append(vp)
+
+    def extend_raw(self, votes: List[Dict[str, Any]]) -> None:
+        # raw hub votes, choice index start with 1
+        self.voter.extend(self._get_voter_id(vote["voter"]) for vote in votes)
+        self.created.extend(vote["created"] for vote in votes)
+        self.choice.extend(vote["choice"] - 1 for vote in votes)
+        self.vp.extend(vote["vp"] for vote in votes)
+
+
+# parsing and formatting need no transport, they are shared with the async client
+def parse_proposal(proposal: Dict[str, Any], space: str) -> SnapshotProposal:
+    return SnapshotProposal(
+        id=proposal["id"],
+        title=proposal["title"],
+        body=proposal["body"],
+        choices=proposal["choices"],
+        start=proposal["start"],
+        end=proposal["end"],
+        snapshot=proposal["snapshot"],
+        state=proposal["state"],
+        author=Web3Address(proposal["author"]),
+        scores={choice: int(score) for choice, score in zip(proposal["choices"], proposal["scores"])},
+        quorum=proposal["quorum"],
+        space=space
+    )
+
+
+def format_active_proposals(proposals: List[SnapshotProposal], space_url: str, name: str = "CityDAO") -> Optional[str]:
+    template = f"🗳 [{name} Snapshot]({space_url}) have {len(proposals)} active proposal\(s\)\\!\n\n"
+
+    if len(proposals) == 0:
+        return None
+
+    for proposal in proposals:
+        template += f"👉 [`{proposal.title}`]({proposal.url})\n"
+
+        template += "    📊 "
+        for i, (choice, count) in enumerate(proposal.scores.items()):
+            template += f"{choice}: {count}"
+            if i != len(proposal.scores) - 1:
+                template += f"\t"
+        template += "\n"
+
+        template += f"   🧿 Quorum: {sum(proposal.scores.values())}  / {proposal.quorum}\n"
+        deadline = datetime.utcfromtimestamp(proposal.end)
+        time_delta = (deadline - datetime.today())
+        days_left = time_delta.days
+        seconds_left = time_delta.seconds
+        minutes_left, _ = divmod(seconds_left, 60)
+        hours_left, minutes_left = divmod(minutes_left, 60)
+        template += f"   ⏰ Deadline: {deadline.strftime('%d %b %Y %H:%M:%S UTC')}\n"
+        template += f"           \({int(days_left)} days {int(hours_left)} hours {int(minutes_left)} minutes left\\!\)\n"
+        template += f"   🟢 Cast your vote [here]({proposal.url})\n\n"
+
+    template += f"📝 Be sure to vote if you're a Citizen\\!"
+    return template
+
+
 class SnapshotAPI(object):
 
-    def __init__(self) -> None:
-        self.endpoint = "https://hub.snapshot.org/graphql"
-        self.space = "daocity.eth"
+    def __init__(
+        self,
+        space: str = "daocity.eth",
+        store: Optional[SnapshotStore] = None,
+        use_store: bool = True,
+        transport: Optional[GraphQLTransport] = None
+    ) -> None:
+        self.endpoint = SNAPSHOT_HUB_URL
+        self.space = space
         self.url = f"https://snapshot.org/#/{self.space}"
+        self.transport = GraphQLTransport(self.endpoint) if transport is None else transport
+        if store is None and use_store:
+            store = SnapshotStore()
+        self.store = store
+
+    def query_graphql(
+        self,
+        query: str,
+        variables: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        return self.transport.query(query, variables, timeout=timeout)
+
+    @staticmethod
+    def _next_vote_cursor(page: List[Dict[str, Any]], cursor: int, n_boundary: int) -> Tuple[int, int]:
+        # page by `created` cursor instead of `skip`, only skip votes
+        # that share the boundary timestamp with the previous page
+        last_created = page[-1]["created"]
+        n_last = sum(1 for vote in page if vote["created"] == last_created)
+        n_boundary = n_boundary + n_last if last_created == cursor else n_last
+        return last_created, n_boundary
+
+    def _query_vote_pages(
+        self,
+        batch: List[Tuple[str, int, int, int]],
+        page_size: int
+    ) -> Dict[str, Any]:
+        variables = {"first": page_size}
+        for i, (proposal_id, since, cursor, n_boundary) in enumerate(batch):
+            variables.update({
+                f"proposal{i}": proposal_id,
+                f"skip{i}": n_boundary,
+                f"cursor{i}": cursor,
+                f"since{i}": since,
+            })
+        return self.query_graphql(votes_query(len(batch)), variables)
+
+    def _iter_vote_pages(
+        self,
+        proposal_id: str,
+        page_size: int = 1000
+    ) -> Iterator[List[Dict[str, Any]]]:
+        cursor = MAX_CREATED
+        n_boundary = 0
+        while True:
+            response = self._query_vote_pages([(proposal_id, 0, cursor, n_boundary)], page_size)
+            page = response["data"]["p0"]
+            if len(page) == 0:
+                return
+
+            yield page
+
+            if len(page) < page_size:
+                return
+            cursor, n_boundary = SnapshotAPI._next_vote_cursor(page, cursor, n_boundary)
+
+    def _parse_vote(self, proposal: SnapshotProposal, vote: Dict[str, Any]) -> SnapshotVote:
+        return SnapshotVote(
+            voter=Web3Address.intern(vote["voter"]),
+            created=vote["created"],
+            choice=proposal.choices[vote["choice"] - 1],  # choice index start with 1
+            vp=vote["vp"]
+        )
+
+    def iter_votes(self, proposal: SnapshotProposal, page_size: int = 1000) -> Iterator[SnapshotVote]:
+        for page in self._iter_vote_pages(proposal.id, page_size=page_size):
+            for vote in page:
+                yield self._parse_vote(proposal, vote)
+
+    def get_votes(self, proposal: SnapshotProposal, page_size: int = 1000) -> List[SnapshotVote]:
+        if self.store is None:
+            return list(self.iter_votes(proposal, page_size=page_size))
+
+        self.sync_votes([proposal], page_size=page_size)
+        return [self._parse_vote(proposal, vote) for vote in self.store.get_votes(proposal.id)]
+
+    def _fetch_vote_pages_many(
+        self,
+        items: List[Tuple[str, Optional[int]]],
+        page_size: int = 1000,
+        batch_size: int = 8,
+        max_batch_size: int = 32
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        # pack several proposals into one aliased query per round trip,
+        # proposals with more votes than `page_size` stay in the queue with their cursor.
+        # batch size is halved when the hub rejects a response and grows back otherwise
+        votes = {proposal_id: [] for proposal_id, _ in items}
+        pending = [(proposal_id, since or 0, MAX_CREATED, 0) for proposal_id, since in items]
+
+        while len(pending) > 0:
+            batch, rest = pending[:batch_size], pending[batch_size:]
+            response = self._query_vote_pages(batch, page_size)
+
+            if response.get("errors") or response.get("data") is None:
+                if batch_size == 1:
+                    raise RuntimeError(f"Snapshot hub error: {response.get('errors')}")
+                batch_size = max(1, batch_size // 2)
+                continue
+
+            pending = rest
+            for i, (proposal_id, since, cursor, n_boundary) in enumerate(batch):
+                page = response["data"][f"p{i}"]
+                votes[proposal_id].extend(page)
+                if len(page) == page_size:
+                    pending.append((proposal_id, since, *SnapshotAPI._next_vote_cursor(page, cursor, n_boundary)))
+            batch_size = min(max_batch_size, batch_size * 2)
 
-    def query_graphql(self, query: str) -> None:
-        response = requests.post(self.endpoint, json={"query": query})
-        return json.loads(response.text)
-
-    def get_votes(self, proposal: SnapshotProposal) -> Any:
-        query = """query Votes {{
-                    votes (
-                        skip: 0
-                        where: {{
-                            proposal: "{proposal_id}"
-                        }}
-                        orderBy: "created",
-                        orderDirection: desc
-                    ) {{
-                        id
-                        voter
-                        created
-                        choice
-                        proposal {{
-                            id
-                            choices
-                        }}
-                    }}
-                }}""".format(proposal_id=proposal.id)
-
-        response = self.query_graphql(query)
-        
-        votes = []
-        for vote in response["data"]["votes"]:
-            choices = vote["proposal"]["choices"]
-            choice = choices[vote["choice"] - 1]  # choice index start with 1
-            votes.append(SnapshotVote(
-                voter=Web3Address(vote["voter"]),
-                created=vote["created"],
-                choice=choice
-            ))
         return votes
 
+    def get_votes_many(self, proposals: List[SnapshotProposal], page_size: int = 1000) -> Dict[str, List[SnapshotVote]]:
+        if self.store is None:
+            raw_votes = self._fetch_vote_pages_many([(proposal.id, None) for proposal in proposals], page_size=page_size)
+        else:
+            self.sync_votes(proposals, page_size=page_size)
+            raw_votes = {proposal.id: self.store.get_votes(proposal.id) for proposal in proposals}
+
+        return {
+            proposal.id: [self._parse_vote(proposal, vote) for vote in raw_votes[proposal.id]]
+            for proposal in proposals
+        }
+
+    def sync_votes(self, proposals: List[SnapshotProposal], page_size: int = 1000) -> None:
+        # fetch only votes newer than the stored watermark, closed proposals are frozen after their last sync
+        proposals = [proposal for proposal in proposals if not self.store.is_votes_frozen(proposal.id)]
+        raw_votes = self._fetch_vote_pages_many(
+            [(proposal.id, self.store.get_vote_watermark(proposal.id)) for proposal in proposals],
+            page_size=page_size
+        )
+        for proposal in proposals:
+            self.store.add_votes(
+                proposal.id,
+                raw_votes[proposal.id],
+                frozen=proposal.state == ProposalStatus.CLOSED
+            )
+
+    def get_votes_columnar(self, proposal: SnapshotProposal, page_size: int = 1000) -> VoteTable:
+        # bulk mode for large proposals, one entry per column instead of per vote
+        if self.store is None:
+            pages = self._iter_vote_pages(proposal.id, page_size=page_size)
+        else:
+            self.sync_votes([proposal], page_size=page_size)
+            pages = self.store.iter_vote_chunks(proposal.id)
+
+        table = VoteTable(proposal.choices)
+        for page in pages:
+            table.extend_raw(page)
+        return table
+
     def get_space_info(self) -> SnapshotSpace:
-        query = """query {
-                    space(id: "daocity.eth") {
-                        id
-                        name
-                        about
-                        network
-                        symbol
-                        members
-                    }
-                }
-                """
-
-        response = self.query_graphql(query)
+        response = self.query_graphql(SPACE_QUERY, {"id": self.space})
         return SnapshotSpace(**response["data"]["space"])
 
+    def _parse_proposal(self, proposal: Dict[str, Any]) -> SnapshotProposal:
+        return parse_proposal(proposal, self.space)
+
+    def sync_proposals(self, page_size: int = 1000) -> None:
+        # new proposals are downloaded once past the `created` watermark,
+        # only scores and state of non-closed proposals are refreshed
+        open_ids = self.store.get_open_proposal_ids(self.space)
+        while True:
+            watermark = self.store.get_proposal_watermark(self.space)
+            response = self.query_graphql(NEW_PROPOSALS_QUERY, {
+                "space": self.space,
+                "watermark": 0 if watermark is None else watermark,
+                "first": page_size,
+            })
+            proposals = response["data"]["proposals"]
+            self.store.upsert_proposals(self.space, proposals)
+            if len(proposals) < page_size:
+                break
+
+        if len(open_ids) == 0:
+            return
+
+        response = self.query_graphql(PROPOSAL_SCORES_QUERY, {"ids": open_ids, "first": len(open_ids)})
+        self.store.update_scores(response["data"]["proposals"])
+
     def get_proposals(
         self, 
         status: Optional[ProposalStatus] = None,
         resolve_author_ens: bool = False
     ) -> List[SnapshotProposal]:
-        query_status = "" if status is None else f'state: "{status.value}",'
-
-        query = """query Proposals {{
-            proposals (
-                skip: 0,
-                where: {{
-                    space_in: ["{space}"],
-                    {status}
-                }},
-                orderBy: "created",
-                orderDirection: desc
-            ) {{
-                id
-                title
-                body
-                choices
-                start
-                end
-                snapshot
-                state
-                scores
-                scores_by_strategy
-                scores_total
-                quorum
-                author
-            }}
-        }}""".format(
-            space=self.space,
-            status=query_status
+        # a cold store would page the whole history of the space, so a state filter is queried
+        # directly until the first unfiltered call backfills the store
+        use_store = self.store is not None and (
+            status is None or self.store.get_proposal_watermark(self.space) is not None
         )
-
-        response = self.query_graphql(query)
-        proposals = [
-            SnapshotProposal(
-                id=proposal["id"],
-                title=proposal["title"],
-                body=proposal["body"],
-                choices=proposal["choices"],
-                start=proposal["start"],
-                end=proposal["end"],
-                snapshot=proposal["snapshot"],
-                state=proposal["state"],
-                author=Web3Address(proposal["author"], resolve_ens=resolve_author_ens),
-                scores={choice: int(score) for choice, score in zip(proposal["choices"], proposal["scores"])},
-                quorum=proposal["quorum"]
-            )
-            for proposal in response["data"]["proposals"]
-        ]
+        if use_store:
+            self.sync_proposals()
+            proposals = self.store.get_proposals(self.space, None if status is None else status.value)
+        elif status is None:
+            response = self.query_graphql(PROPOSALS_QUERY, {"space": self.space, "first": 1000})
+            proposals = response["data"]["proposals"]
+        else:
+            response = self.query_graphql(PROPOSALS_BY_STATE_QUERY, {
+                "space": self.space,
+                "state": status.value,
+                "first": 1000,
+            })
+            proposals = response["data"]["proposals"]
+
+        proposals = [self._parse_proposal(proposal) for proposal in proposals]
+        if resolve_author_ens:
+            Web3Address.resolve_ens_many([proposal.author for proposal in proposals])
         return proposals
 
-    def format_active_proposals(self, proposals: List[SnapshotProposal]) -> Optional[str]:
-        template = f"🗳 [CityDAO Snapshot]({self.url}) have {len(proposals)} active proposal\(s\)\\!\n\n"
-
-        if len(proposals) == 0:
-            return None
-
-        for proposal in proposals:
-            template += f"👉 [`{proposal.title}`]({proposal.url})\n"
-
-            template += "    📊 "
-            for i, (choice, count) in enumerate(proposal.scores.items()):
-                template += f"{choice}: {count}"
-                if i != len(proposal.scores) - 1:
-                    template += f"\t"
-            template += "\n"
-
-            template += f"   🧿 Quorum: {sum(proposal.scores.values())}  / {proposal.quorum}\n"
-            deadline = datetime.utcfromtimestamp(proposal.end)
-            time_delta = (deadline - datetime.today())
-            days_left = time_delta.days
-            seconds_left = time_delta.seconds
-            minutes_left, _ = divmod(seconds_left, 60)
-            hours_left, minutes_left = divmod(minutes_left, 60)
-            template += f"   ⏰ Deadline: {deadline.strftime('%d %b %Y %H:%M:%S UTC')}\n"
-            template += f"           \({int(days_left)} days {int(hours_left)} hours {int(minutes_left)} minutes left\\!\)\n"
-            template += f"   🟢 Cast your vote [here]({proposal.url})\n\n"
-
-        template += f"📝 Be sure to vote if you're a Citizen\\!"
-        return template
+    def format_active_proposals(self, proposals: List[SnapshotProposal], name: str = "CityDAO") -> Optional[str]:
+        return format_active_proposals(proposals, self.url, name=name)
 
     def get_daily_summary(self) -> str:
         active_proposals = self.get_proposals(ProposalStatus.ACTIVE)
         return self.format_active_proposals(active_proposals)
+
+
+@dataclass
+class SnapshotSpaceSummary(object):
+    space: SnapshotSpace
+    proposals: List[SnapshotProposal]
+    votes: Dict[str, List[SnapshotVote]] = field(default_factory=lambda: {})
+
+    def __repr__(self) -> str:
+        return f"SnapshotSpaceSummary(space='{self.space.id}', n_proposals={len(self.proposals)})"
+
+
+class MultiSpaceSnapshotAPI(object):
+
+    def __init__(
+        self,
+        spaces: List[str],
+        max_workers: int = 8,
+        store: Optional[SnapshotStore] = None,
+        use_store: bool = True,
+        transport: Optional[GraphQLTransport] = None
+    ) -> None:
+        # all spaces share one connection pool and one store
+        if transport is None:
+            transport = GraphQLTransport(SNAPSHOT_HUB_URL, pool_maxsize=max_workers)
+        if store is None and use_store:
+            store = SnapshotStore()
+        self.apis = {
+            space: SnapshotAPI(space=space, store=store, use_store=use_store, transport=transport)
+            for space in spaces
+        }
+        self.max_workers = max_workers
+
+    def __repr__(self) -> str:
+        return f"MultiSpaceSnapshotAPI(spaces={list(self.apis)})"
+
+    def _get_proposals_and_votes(
+        self,
+        api: SnapshotAPI,
+        status: Optional[ProposalStatus],
+        include_votes: bool
+    ) -> Tuple[List[SnapshotProposal], Dict[str, List[SnapshotVote]]]:
+        proposals = api.get_proposals(status)
+        votes = api.get_votes_many(proposals) if include_votes else {}
+        return proposals, votes
+
+    def get_summary(
+        self,
+        status: Optional[ProposalStatus] = ProposalStatus.ACTIVE,
+        include_votes: bool = False
+    ) -> Dict[str, SnapshotSpaceSummary]:
+        # space info and proposals (+ votes) of every space run concurrently,
+        # total latency is bounded by the slowest space instead of the sum
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            space_futures = {
+                space: executor.submit(api.get_space_info)
+                for space, api in self.apis.items()
+            }
+            proposal_futures = {
+                space: executor.submit(self._get_proposals_and_votes, api, status, include_votes)
+                for space, api in self.apis.items()
+            }
+
+            summary = {}
+            for space in self.apis:
+                proposals, votes = proposal_futures[space].result()
+                summary[space] = SnapshotSpaceSummary(
+                    space=space_futures[space].result(),
+                    proposals=proposals,
+                    votes=votes
+                )
+        return summary
+
+    def format_summary(self, summary: Dict[str, SnapshotSpaceSummary]) -> Optional[str]:
+        sections = [
+            self.apis[space].format_active_proposals(
+                space_summary.proposals,
+                name=escape_markdown_v2(space_summary.space.name)
+            )
+            for space, space_summary in summary.items()
+        ]
+        sections = [section for section in sections if section is not None]
+        if len(sections) == 0:
+            return None
+        return "\n\n—————————————————————————\n\n".join(sections)
+
+    def get_daily_summary(self) -> Optional[str]:
+        return self.format_summary(self.get_summary(ProposalStatus.ACTIVE))
@@ -1,11 +1,23 @@
 import base64
+import bisect
+import json
+import os
+import sqlite3
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-import functools
-from typing import List
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import pytz
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from citydao.utils import get_cache_dir
+
+
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
 
 
 @dataclass
@@ -16,6 +28,7 @@ class SpotifyEpisode(object):
     preview_url: str
     description: str
     duration: float
+    id: Optional[str] = None
 
     def __post_init__(self):
         self.duration = SpotifyEpisode.sec_to_str(self.duration)
@@ -34,18 +47,151 @@ class SpotifyEpisode(object):
             return f"{int(hours)} hours {int(minutes)} minutes {seconds:.2f} seconds".replace(".", "\\.")
 
 
-class CityDAOSpotify(object):
+class EpisodeCatalog(object):
+    # every episode of a show on disk, indexed in memory by release date and name
 
-    def __init__(self, client_id: str, client_credentials: str) -> None:
-        self.client_credentials = base64.urlsafe_b64encode(
-            f"{client_id}:{client_credentials}".encode()
-        ).decode()
-        self.citydao_id = "4DqYWZyAMxUAL5o22caPSd"
-        self.base_url = f"https://api.spotify.com"
+    def __init__(self, show_id: str, path: Optional[str] = None) -> None:
+        self.show_id = show_id
+        self.path = os.path.join(get_cache_dir(), "spotify.db") if path is None else path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS episodes (
+                id TEXT PRIMARY KEY,
+                show TEXT NOT NULL,
+                name TEXT,
+                url TEXT,
+                release_date TEXT,
+                preview_url TEXT,
+                description TEXT,
+                duration_ms INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS episodes_show_release_date ON episodes (show, release_date);
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                etag TEXT NOT NULL,
+                payload TEXT NOT NULL
+            );
+        """)
 
-    def issue_oauth(self) -> None:
-        r = requests.post(
-            f"https://accounts.spotify.com/api/token",
+        self.episodes = {}
+        self.by_date = []  # sorted (release_date, id)
+        self.by_name = {}
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM episodes WHERE show = ?", (self.show_id,)).fetchall()
+        self._index(rows)
+
+    def __len__(self) -> int:
+        return len(self.episodes)
+
+    def __repr__(self) -> str:
+        return f"EpisodeCatalog(show={self.show_id}, n_episodes={len(self)})"
+
+    @staticmethod
+    def _to_episode(row: Dict[str, Any]) -> SpotifyEpisode:
+        return SpotifyEpisode(
+            name=row["name"],
+            url=row["url"],
+            created_at=datetime.strptime(row["release_date"], "%Y-%m-%d"),
+            preview_url=row["preview_url"],
+            description=row["description"],
+            duration=row["duration_ms"] / 1000,
+            id=row["id"]
+        )
+
+    def _index(self, rows: List[Dict[str, Any]]) -> None:
+        for row in rows:
+            if row["id"] in self.episodes:
+                continue
+            self.episodes[row["id"]] = self._to_episode(row)
+            bisect.insort(self.by_date, (row["release_date"], row["id"]))
+            self.by_name[row["name"].lower()] = row["id"]
+
+    def get_latest_release_date(self) -> Optional[str]:
+        return self.by_date[-1][0] if len(self.by_date) > 0 else None
+
+    def add_items(self, items: List[Dict[str, Any]]) -> None:
+        # raw items of the episodes endpoint
+        rows = [
+            {
+                "id": item["id"],
+                "name": item["name"],
+                "url": item["external_urls"]["spotify"],
+                "release_date": item["release_date"],
+                "preview_url": item["audio_preview_url"],
+                "description": item["description"],
+                "duration_ms": item["duration_ms"],
+            }
+            for item in items
+        ]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT OR REPLACE INTO episodes
+                    (id, show, name, url, release_date, preview_url, description, duration_ms)
+                    VALUES (:id, :show, :name, :url, :release_date, :preview_url, :description, :duration_ms)""",
+                [{**row, "show": self.show_id} for row in rows]
+            )
+            self._index(rows)
+
+    def get_response(self, url: str) -> Optional[Tuple[str, Any]]:
+        # (etag, payload) of the last 200 response, kept on disk so a fresh process still gets 304s
+        with self.lock:
+            row = self.conn.execute("SELECT etag, payload FROM responses WHERE url = ?", (url,)).fetchone()
+        return None if row is None else (row["etag"], json.loads(row["payload"]))
+
+    def set_response(self, url: str, etag: str, payload: Any) -> None:
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (url, etag, json.dumps(payload)))
+
+    def get_latest(self, n: int = 30) -> List[SpotifyEpisode]:
+        return [self.episodes[id] for _, id in reversed(self.by_date[-n:])] if n > 0 else []
+
+    def get_between(self, start: datetime, end: datetime) -> List[SpotifyEpisode]:
+        # released on days within [start, end], newest first
+        lo = bisect.bisect_left(self.by_date, (start.strftime("%Y-%m-%d"),))
+        hi = bisect.bisect_right(self.by_date, (end.strftime("%Y-%m-%d"), "\uffff"))
+        return [self.episodes[id] for _, id in reversed(self.by_date[lo:hi])]
+
+    def find_by_name(self, name: str) -> Optional[SpotifyEpisode]:
+        id = self.by_name.get(name.lower())
+        return None if id is None else self.episodes[id]
+
+    def search(self, text: str) -> List[SpotifyEpisode]:
+        text = text.lower()
+        return [self.episodes[id] for name, id in self.by_name.items() if text in name]
+
+
+class SpotifyTokenManager(object):
+    # client credentials token cached until shortly before it expires,
+    # refreshed ahead of time on a background timer so requests never wait for it
+
+    def __init__(
+        self,
+        client_credentials: str,
+        session: Optional[requests.Session] = None,
+        refresh_margin: float = 60.,
+        background_refresh: bool = True
+    ) -> None:
+        self.client_credentials = client_credentials
+        self.session = requests.Session() if session is None else session
+        self.refresh_margin = refresh_margin
+        self.background_refresh = background_refresh
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0.
+        self.timer = None
+        self.logger = logging.getLogger(__name__)
+
+    def __repr__(self) -> str:
+        return f"SpotifyTokenManager(expires_in={max(0., self.expires_at - time.time()):.0f}s)"
+
+    def _is_fresh(self) -> bool:
+        return self.access_token is not None and time.time() < self.expires_at - self.refresh_margin
+
+    def _fetch(self) -> None:
+        r = self.session.post(
+            SPOTIFY_TOKEN_URL,
             headers={
                 "Authorization": f"Basic {self.client_credentials}",
                 "Content-Type": "application/x-www-form-urlencoded"
@@ -54,30 +200,132 @@ class CityDAOSpotify(object):
                 "grant_type": "client_credentials",
             }
         )
+        r.raise_for_status()
         response = r.json()
-        access_token = response.get("access_token")
-        self.headers = {"Authorization": f"Bearer {access_token}"}
-
-    def get_latest_episodes(self) -> List[SpotifyEpisode]:
-        self.issue_oauth()
-        endpoint = f"{self.base_url}/v1/shows/{self.citydao_id}/episodes?market=ES&limit=30"
-        r = requests.get(
-            endpoint,
-            headers={ **self.headers }
+        self.access_token = response["access_token"]
+        self.expires_at = time.time() + response.get("expires_in", 3600)
+        self._schedule_refresh()
+
+    def _schedule_refresh(self) -> None:
+        if not self.background_refresh:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(max(0., self.expires_at - self.refresh_margin - time.time()), self._refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _refresh(self) -> None:
+        try:
+            with self.lock:
+                self._fetch()
+        except requests.RequestException as e:
+            # the next get_token call fetches it synchronously
+            self.logger.warning(f"Spotify token refresh failed: {e}")
+
+    def get_token(self) -> str:
+        with self.lock:
+            if not self._is_fresh():
+                self._fetch()
+            return self.access_token
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.access_token = None
+
+    def close(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+class CityDAOSpotify(object):
+
+    def __init__(
+        self,
+        client_id: str,
+        client_credentials: str,
+        background_refresh: bool = True,
+        pool_maxsize: int = 4,
+        catalog: Optional[EpisodeCatalog] = None
+    ) -> None:
+        self.client_credentials = base64.urlsafe_b64encode(
+            f"{client_id}:{client_credentials}".encode()
+        ).decode()
+        self.citydao_id = "4DqYWZyAMxUAL5o22caPSd"
+        self.base_url = f"https://api.spotify.com"
+
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.token_manager = SpotifyTokenManager(
+            self.client_credentials,
+            session=self.session,
+            background_refresh=background_refresh
         )
-        response = r.json()
-        episodes = [
-            SpotifyEpisode(
-                name=item["name"],
-                url=item["external_urls"]["spotify"],
-                created_at=datetime.strptime(item["release_date"], "%Y-%m-%d"),
-                preview_url=item["audio_preview_url"],
-                description=item["description"],
-                duration=item["duration_ms"] / 1000
-            )
-            for item in response["items"]
-        ]
-        return episodes
+        self.catalog = EpisodeCatalog(self.citydao_id) if catalog is None else catalog
+
+    def issue_oauth(self) -> None:
+        self.headers = {"Authorization": f"Bearer {self.token_manager.get_token()}"}
+
+    def get_json(self, url: str) -> Any:
+        # conditional GET, an unchanged resource costs a 304 and the cached payload is returned
+        for _ in range(2):
+            self.issue_oauth()
+            headers = {**self.headers}
+            cached = self.catalog.get_response(url)
+            if cached is not None:
+                headers["If-None-Match"] = cached[0]
+
+            r = self.session.get(url, headers=headers)
+            if r.status_code == 401:
+                self.token_manager.invalidate()
+                continue
+            if r.status_code == 304 and cached is not None:
+                return cached[1]
+            r.raise_for_status()
+
+            response = r.json()
+            etag = r.headers.get("ETag")
+            if etag is not None:
+                self.catalog.set_response(url, etag, response)
+            return response
+        r.raise_for_status()
+
+    def iter_episode_pages(self, page_size: int = 50) -> Iterator[List[Dict[str, Any]]]:
+        # newest first, following the `next` links
+        url = f"{self.base_url}/v1/shows/{self.citydao_id}/episodes?market=ES&limit={page_size}"
+        while url is not None:
+            response = self.get_json(url)
+            yield [item for item in response["items"] if item is not None]
+            url = response.get("next")
+
+    def iter_episodes(self, page_size: int = 50) -> Iterator[SpotifyEpisode]:
+        for items in self.iter_episode_pages(page_size):
+            for item in items:
+                yield SpotifyEpisode(
+                    name=item["name"],
+                    url=item["external_urls"]["spotify"],
+                    created_at=datetime.strptime(item["release_date"], "%Y-%m-%d"),
+                    preview_url=item["audio_preview_url"],
+                    description=item["description"],
+                    duration=item["duration_ms"] / 1000,
+                    id=item["id"]
+                )
+
+    def sync_catalog(self, page_size: int = 50) -> int:
+        # pages stop once they reach episodes released before the newest catalogued day
+        latest = self.catalog.get_latest_release_date()
+        n_episodes = len(self.catalog)
+        for items in self.iter_episode_pages(page_size):
+            self.catalog.add_items(items)
+            if latest is not None and any(item["release_date"] < latest for item in items):
+                break
+        return len(self.catalog) - n_episodes
+
+    def get_latest_episodes(self, n: int = 30, sync: bool = True) -> List[SpotifyEpisode]:
+        if sync:
+            self.sync_catalog()
+        return self.catalog.get_latest(n)
 
     @staticmethod
     def _is_date_in_ytd(date: datetime) -> bool:
@@ -128,8 +376,8 @@ class CityDAOSpotify(object):
 
         return template
 
-    def get_daily_summary(self, n_episodes: int = 3) -> str:
-        episodes = self.get_latest_episodes()
+    def get_daily_summary(self, n_episodes: int = 3, sync: bool = True) -> str:
+        episodes = self.get_latest_episodes(sync=sync)
         new_episodes, other_episodes = self.filter_today_episodes(episodes, return_others=True)
         other_episodes = other_episodes[:max(0, n_episodes - len(new_episodes))]
 
@@ -0,0 +1,150 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+from citydao.utils import get_cache_dir
+
+
+class SnapshotStore(object):
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = os.path.join(get_cache_dir(), "snapshot.db") if path is None else path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS proposals (
+                id TEXT PRIMARY KEY,
+                space TEXT NOT NULL,
+                title TEXT,
+                body TEXT,
+                choices TEXT,
+                start INTEGER,
+                end INTEGER,
+                snapshot TEXT,
+                state TEXT,
+                author TEXT,
+                quorum REAL,
+                scores TEXT,
+                created INTEGER,
+                votes_frozen INTEGER DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS proposals_space_created ON proposals (space, created);
+            CREATE TABLE IF NOT EXISTS votes (
+                id TEXT PRIMARY KEY,
+                proposal TEXT NOT NULL,
+                voter TEXT,
+                created INTEGER,
+                choice INTEGER,
+                vp REAL,
+                UNIQUE (proposal, voter)
+            );
+            CREATE INDEX IF NOT EXISTS votes_proposal_created ON votes (proposal, created);
+        """)
+
+    def __repr__(self) -> str:
+        return f"SnapshotStore({self.path})"
+
+    def get_proposal_watermark(self, space: str) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MAX(created) FROM proposals WHERE space = ?", (space,)
+            ).fetchone()
+        return row[0]
+
+    def upsert_proposals(self, space: str, proposals: List[Dict[str, Any]]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT INTO proposals
+                    (id, space, title, body, choices, start, end, snapshot, state, author, quorum, scores, created)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET state = excluded.state, scores = excluded.scores""",
+                [
+                    (
+                        proposal["id"], space, proposal["title"], proposal["body"],
+                        json.dumps(proposal["choices"]), proposal["start"], proposal["end"],
+                        proposal["snapshot"], proposal["state"], proposal["author"],
+                        proposal["quorum"], json.dumps(proposal["scores"]), proposal["created"]
+                    )
+                    for proposal in proposals
+                ]
+            )
+
+    def update_scores(self, proposals: List[Dict[str, Any]]) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE proposals SET state = ?, scores = ? WHERE id = ?",
+                [
+                    (proposal["state"], json.dumps(proposal["scores"]), proposal["id"])
+                    for proposal in proposals
+                ]
+            )
+
+    def get_open_proposal_ids(self, space: str) -> List[str]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM proposals WHERE space = ? AND state != 'closed'", (space,)
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def get_proposals(self, space: str, state: Optional[str] = None) -> List[Dict[str, Any]]:
+        query = "SELECT * FROM proposals WHERE space = ?"
+        params = [space]
+        if state is not None:
+            query += " AND state = ?"
+            params.append(state)
+        query += " ORDER BY created DESC"
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [
+            {**row, "choices": json.loads(row["choices"]), "scores": json.loads(row["scores"])}
+            for row in map(dict, rows)
+        ]
+
+    def get_vote_watermark(self, proposal_id: str) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MAX(created) FROM votes WHERE proposal = ?", (proposal_id,)
+            ).fetchone()
+        return row[0]
+
+    def is_votes_frozen(self, proposal_id: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT votes_frozen FROM proposals WHERE id = ?", (proposal_id,)
+            ).fetchone()
+        return row is not None and bool(row["votes_frozen"])
+
+    def add_votes(self, proposal_id: str, votes: List[Dict[str, Any]], frozen: bool = False) -> None:
+        # closed proposals never change, freeze them once their votes are complete
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT INTO votes (id, proposal, voter, created, choice, vp) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(proposal, voter) DO UPDATE SET
+                        id = excluded.id, created = excluded.created, choice = excluded.choice, vp = excluded.vp
+                    WHERE excluded.created >= votes.created""",
+                [
+                    (vote["id"], proposal_id, vote["voter"], vote["created"], vote["choice"], vote["vp"])
+                    for vote in votes
+                ]
+            )
+            if frozen:
+                self.conn.execute("UPDATE proposals SET votes_frozen = 1 WHERE id = ?", (proposal_id,))
+
+    def get_votes(self, proposal_id: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM votes WHERE proposal = ? ORDER BY created DESC", (proposal_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def iter_vote_chunks(self, proposal_id: str, chunk_size: int = 10000) -> Iterator[List[Dict[str, Any]]]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM votes WHERE proposal = ? ORDER BY created DESC", (proposal_id,)
+            ).fetchall()
+        for i in range(0, len(rows), chunk_size):
+            yield [dict(row) for row in rows[i:i + chunk_size]]
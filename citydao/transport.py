@@ -0,0 +1,56 @@
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class GraphQLTransport(object):
+
+    def __init__(
+        self,
+        endpoint: str,
+        timeout: float = 30.,
+        max_retries: int = 5,
+        backoff_factor: float = 0.5,
+        pool_maxsize: int = 16
+    ) -> None:
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+        # keep-alive session, retried with exponential backoff on rate limit and server errors
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"POST"}),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+        })
+
+    def __repr__(self) -> str:
+        return f"GraphQLTransport({self.endpoint})"
+
+    def query(
+        self,
+        query: str,
+        variables: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        response = self.session.post(
+            self.endpoint,
+            json={"query": query, "variables": variables or {}},
+            timeout=self.timeout if timeout is None else timeout
+        )
+        # graphql errors are returned as json body, only raise on non-graphql failures
+        if not response.ok and "json" not in response.headers.get("Content-Type", ""):
+            response.raise_for_status()
+        return response.json()
@@ -1,27 +1,106 @@
+import json
 import os
-from typing import Dict, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-from citydao.utils import Web3Address
+import numpy as np
+from web3 import Web3
+from web3.contract import ContractFunction
+from web3.types import BlockIdentifier
+
+from citydao.history import BalanceHistoryStore, BlockTimestampIndex, to_seconds, to_timestamp
+from citydao.indexer import TreasuryIndexer
+from citydao.multicall import Multicall
+from citydao.utils import Web3Address, escape_markdown_v2, get_cache_dir
+
+
+SAFE_ADDRESS = "0x60e7343205C9C88788a22C40030d35f9370d302D"
+
+DEFAULT_TOKENS = [
+    "0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2",  # WETH
+    "0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48",  # USDC
+]
+
+
+class TokenMetadataStore(object):
+    # symbol and decimals never change, keep them on disk instead of asking the chain
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = os.path.join(get_cache_dir(), "tokens.json") if path is None else path
+        self.lock = threading.Lock()
+        self.metadata = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as fp:
+                self.metadata = json.load(fp)
+
+    def __repr__(self) -> str:
+        return f"TokenMetadataStore(n_tokens={len(self.metadata)})"
+
+    @classmethod
+    def default(cls) -> "TokenMetadataStore":
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def get(self, address: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            return self.metadata.get(address.lower())
+
+    def set(self, address: str, symbol: str, decimals: Optional[int]) -> None:
+        # decimals is None for contracts that are not ERC-20 tokens, so they are not asked again
+        with self.lock:
+            self.metadata[address.lower()] = {"symbol": symbol, "decimals": decimals}
+
+    def save(self) -> None:
+        with self.lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as fp:
+                json.dump(self.metadata, fp, indent=4)
+            os.replace(tmp_path, self.path)
 
 
 class Token(object):
 
-    def __init__(self, address: str):
+    def __init__(
+        self,
+        address: str,
+        provider: Optional[Web3] = None,
+        metadata: Optional[TokenMetadataStore] = None
+    ):
         self.address = address
 
         abi_path = f"{os.path.dirname(os.path.abspath(__file__))}/abi/erc20.json"
-        self.provider = Web3Address.get_default_provider()
+        self.provider = Web3Address.get_default_provider() if provider is None else provider
         self.contract = Web3Address(self.address).get_contract(self.provider, abi_path)
+        self.metadata = TokenMetadataStore.default() if metadata is None else metadata
         self.ticker = self.get_ticker()
 
     def __repr__(self) -> str:
         return f"ERC20Token({self.address})"
 
+    def _get_metadata(self) -> Dict[str, Any]:
+        metadata = self.metadata.get(self.address)
+        if metadata is None:
+            self.metadata.set(
+                self.address,
+                symbol=self.contract.functions.symbol().call(),
+                decimals=self.contract.functions.decimals().call()
+            )
+            self.metadata.save()
+            metadata = self.metadata.get(self.address)
+        return metadata
+
     def get_ticker(self) -> str:
-        return self.contract.functions.symbol().call()
+        return self._get_metadata()["symbol"]
 
     def get_balance(self, address: Web3Address) -> float:
-        decimal = self.contract.functions.decimals().call()
+        decimal = self._get_metadata()["decimals"]
         balance = self.contract.functions.balanceOf(address.address).call()
         return balance / (10**(decimal))
 
@@ -36,31 +115,171 @@ class Token(object):
 
 class CityDAOTreasury(object):
 
-    def __init__(self) -> None:
-        self.contract_address = Web3Address("0x60e7343205C9C88788a22C40030d35f9370d302D")
+    def __init__(
+        self,
+        safe_addresses: Optional[List[str]] = None,
+        tokens: Optional[List[str]] = None,
+        metadata: Optional[TokenMetadataStore] = None,
+        discover_tokens: bool = False,
+        indexer: Optional[TreasuryIndexer] = None,
+        provider: Optional[Web3] = None
+    ) -> None:
+        safe_addresses = [SAFE_ADDRESS] if safe_addresses is None else safe_addresses
+        self.safe_addresses = [Web3Address(address) for address in safe_addresses]
+        self.contract_address = self.safe_addresses[0]
 
         abi_path = f"{os.path.dirname(os.path.abspath(__file__))}/abi/gnosis_safe.json"
-        self.provider = Web3Address.get_default_provider()
+        self.provider = Web3Address.get_default_provider() if provider is None else provider
         self.contract = self.contract_address.get_contract(self.provider, abi_path)
+        self.multicall = Multicall(self.provider)
+        self.metadata = TokenMetadataStore.default() if metadata is None else metadata
+        self.block_index = BlockTimestampIndex(self.provider)
 
+        self.tokens = []
+        self.token_contracts = []
+        self.add_tokens(DEFAULT_TOKENS if tokens is None else tokens)
+        self.configured_tokens = set(self.tokens)
 
-    def get_balance(self) -> List[Token]:
-        tokens = [Token.weth(), Token.usdc()]
-        balance = {
-            token.ticker: token.get_balance(self.contract_address)
-            for token in tokens
-        }
-        balance["ETH"] = self.provider.eth.get_balance(self.contract_address.address) / 1e18
+        self.indexer = indexer
+        self.discover = discover_tokens
+
+    def add_tokens(self, tokens: List[str]) -> List[str]:
+        erc20_abi_path = f"{os.path.dirname(os.path.abspath(__file__))}/abi/erc20.json"
+        known = {token.lower() for token in self.tokens}
+        added = []
+        for token in tokens:
+            if token.lower() in known:
+                continue
+            known.add(token.lower())
+            added.append(token)
+            self.tokens.append(token)
+            self.token_contracts.append(Web3Address(token).get_contract(self.provider, erc20_abi_path))
+        return added
+
+    def discover_tokens(self) -> List[str]:
+        # every token the safes have ever received, from the local Transfer log index
+        if self.indexer is None:
+            self.indexer = TreasuryIndexer(self)
+        self.indexer.sync()
+        return self.add_tokens(self.indexer.get_received_tokens())
+
+    def get_balance_functions(self) -> Tuple[List[str], List[ContractFunction]]:
+        # (tokens without metadata, calls for their metadata followed by every balance)
+        missing = [
+            (token, contract) for token, contract in zip(self.tokens, self.token_contracts)
+            if self.metadata.get(token) is None
+        ]
+        functions = []
+        for _, contract in missing:
+            functions += [contract.functions.symbol(), contract.functions.decimals()]
+        for safe in self.safe_addresses:
+            functions += [contract.functions.balanceOf(safe.address) for contract in self.token_contracts]
+            functions.append(self.multicall.get_eth_balance(safe.address))
+        return [token for token, _ in missing], functions
+
+    def get_balances(self, block_identifier: BlockIdentifier = "latest") -> Dict[str, Dict[str, float]]:
+        # every (safe, token) balance and the ETH balance of every safe in one eth_call,
+        # metadata of tokens seen for the first time is fetched in the same call
+        missing, functions = self.get_balance_functions()
+        return self.parse_balances(missing, self.multicall.call(functions, block_identifier=block_identifier))
+
+    def parse_balances(self, missing: List[str], outputs: List[Any]) -> Dict[str, Dict[str, float]]:
+        outputs = iter(outputs)
+        for token in missing:
+            symbol, decimals = next(outputs), next(outputs)
+            self.metadata.set(token, symbol=token if symbol is None else symbol, decimals=decimals)
+        if len(missing) > 0:
+            self.metadata.save()
+
+        tickers = self.get_token_tickers()
+        balances = {}
+        for safe in self.safe_addresses:
+            balance = {}
+            for token in self.tokens:
+                token_balance = next(outputs)
+                if token_balance is None or token not in tickers:
+                    continue
+                balance[tickers[token]] = token_balance / (10**self.metadata.get(token)["decimals"])
+            eth_balance = next(outputs)
+            balance["ETH"] = 0. if eth_balance is None else eth_balance / 1e18
+            balances[safe.address] = balance
+        return balances
+
+    @staticmethod
+    def sum_balances(balances: Dict[str, Dict[str, float]]) -> Dict[str, float]:
+        balance = {}
+        for safe_balance in balances.values():
+            for ticker, token_balance in safe_balance.items():
+                balance[ticker] = balance.get(ticker, 0.) + token_balance
         return balance
 
+    def get_balance(self, block_identifier: BlockIdentifier = "latest") -> Dict[str, float]:
+        return self.sum_balances(self.get_balances(block_identifier))
+
+    def get_token_tickers(self) -> Dict[str, str]:
+        # token -> ticker of every ERC-20 with known metadata, a symbol taken by an earlier token
+        # falls back to the token address so the same token always gets the same ticker
+        tickers = {}
+        for token in self.tokens:
+            metadata = self.metadata.get(token)
+            if metadata is None or metadata["decimals"] is None:
+                continue
+            tickers[token] = token if metadata["symbol"] in tickers.values() else metadata["symbol"]
+        return tickers
+
+    def get_tickers(self) -> List[str]:
+        if any(self.metadata.get(token) is None for token in self.tokens):
+            self.get_balances()
+        return list(self.get_token_tickers().values()) + ["ETH"]
+
+    def get_balance_history(
+        self,
+        start: Union[int, datetime],
+        end: Union[int, datetime],
+        interval: Union[int, timedelta] = timedelta(days=1),
+        max_workers: int = 8,
+        cache_dir: Optional[str] = None
+    ) -> Dict[str, np.ndarray]:
+        # balances sampled every `interval` between `start` and `end`,
+        # samples already on disk are reused and only the missing ones are read from the chain
+        tickers = self.get_tickers()
+        store = BalanceHistoryStore(tickers, cache_dir=cache_dir)
+        timestamps = np.arange(to_timestamp(start), to_timestamp(end) + 1, to_seconds(interval), dtype=np.int64)
+
+        records = store.load()
+        missing = timestamps[~np.isin(timestamps, records[:, 0].astype(np.int64))]
+        if len(missing) > 0:
+            latest = self.provider.eth.block_number
+            missing = missing[missing <= self.block_index.get_timestamp(latest)]
+
+            def read_sample(timestamp: int) -> List[float]:
+                block_number = self.block_index.get_block_number(int(timestamp), latest=latest)
+                balance = self.get_balance(block_identifier=block_number)
+                return [timestamp, block_number] + [balance.get(ticker, np.nan) for ticker in tickers]
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                store.append(np.array(list(executor.map(read_sample, missing)), dtype=np.float64))
+            records = store.load()
+
+        return store.to_dict(records[np.isin(records[:, 0].astype(np.int64), timestamps)])
+
     def format_balance(self, balance: Dict[str, float]) -> str:
-        template = f"🏦 [CityDAO Tresury](https://gnosis-safe.io/app/eth:0x60e7343205C9C88788a22C40030d35f9370d302D/balances) Balance\n"
+        template = f"🏦 [CityDAO Tresury](https://gnosis-safe.io/app/eth:{self.contract_address.address}/balances) Balance\n"
 
+        # discovered tokens that were sold or spent are left out of the report
+        tickers = self.get_token_tickers()
+        discovered = {tickers[token] for token in tickers if token not in self.configured_tokens}
         for token, token_balance in balance.items():
-            template += f"   \- {token_balance:,.4f} `{token}`\n".replace(".", "\\.")
+            if token_balance == 0 and token in discovered:
+                continue
+            # symbols of discovered tokens are untrusted on-chain strings
+            amount = f"{token_balance:,.4f}".replace(".", "\\.")
+            template += f"   \- {amount} `{escape_markdown_v2(token)}`\n"
 
         return template[:-1]  # remove last new line token
 
     def get_daily_summary(self) -> str:
+        if self.discover:
+            self.discover_tokens()
         balance = self.get_balance()
         return self.format_balance(balance)
@@ -1,10 +1,17 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Any, List, Optional, Set, Tuple
 import pytz
 
 import tweepy as tw
 
+from citydao.utils import get_cache_dir
+
 
 @dataclass
 class Tweet(object):
@@ -21,30 +28,222 @@ class Tweet(object):
         return f"Tweet({self.url})"
 
 
+class TweetArchive(object):
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = os.path.join(get_cache_dir(), "tweets.db") if path is None else path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS tweets (
+                id INTEGER PRIMARY KEY,
+                account TEXT NOT NULL,
+                text TEXT,
+                created_at INTEGER,
+                fav_count INTEGER,
+                rtw_count INTEGER,
+                updated_at INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS tweets_account_created ON tweets (account, created_at);
+            CREATE TABLE IF NOT EXISTS pending_ranges (
+                account TEXT PRIMARY KEY,
+                since_id INTEGER,
+                max_id INTEGER NOT NULL
+            );
+        """)
+
+    def __repr__(self) -> str:
+        return f"TweetArchive({self.path})"
+
+    def get_since_id(self, account: str) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute("SELECT MAX(id) FROM tweets WHERE account = ?", (account,)).fetchone()
+        return row[0]
+
+    def get_oldest_id(self, account: str) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute("SELECT MIN(id) FROM tweets WHERE account = ?", (account,)).fetchone()
+        return row[0]
+
+    def get_pending_range(self, account: str) -> Optional[Tuple[Optional[int], int]]:
+        # (since_id, max_id) of a timeline range that was only partly fetched
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT since_id, max_id FROM pending_ranges WHERE account = ?", (account,)
+            ).fetchone()
+        return None if row is None else (row["since_id"], row["max_id"])
+
+    def _set_pending_range(self, account: str, pending_range: Optional[Tuple[Optional[int], int]]) -> None:
+        if pending_range is None:
+            self.conn.execute("DELETE FROM pending_ranges WHERE account = ?", (account,))
+        else:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pending_ranges VALUES (?, ?, ?)", (account, *pending_range)
+            )
+
+    def clear_pending_range(self, account: str) -> None:
+        with self.lock, self.conn:
+            self._set_pending_range(account, None)
+
+    def add_tweets(
+        self,
+        account: str,
+        tweets: List[Tweet],
+        pending_range: Optional[Tuple[Optional[int], int]] = None
+    ) -> None:
+        # engagement counts of known tweets are overwritten with the fresher ones,
+        # a page and the range still left to fetch below it are written together
+        now = int(time.time())
+        with self.lock, self.conn:
+            if pending_range is not None:
+                self._set_pending_range(account, pending_range)
+            self.conn.executemany(
+                """INSERT INTO tweets (id, account, text, created_at, fav_count, rtw_count, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        fav_count = excluded.fav_count, rtw_count = excluded.rtw_count, updated_at = excluded.updated_at""",
+                [
+                    (
+                        int(tweet.id), account, tweet.text, int(tweet.created_at.replace(tzinfo=pytz.UTC).timestamp()),
+                        tweet.fav_count, tweet.rtw_count, now
+                    )
+                    for tweet in tweets
+                ]
+            )
+
+    def get_ids_since(self, account: str, created_at: datetime) -> List[int]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id FROM tweets WHERE account = ? AND created_at >= ?",
+                (account, int(created_at.timestamp()))
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def get_tweets(self, account: str, count: int = 200) -> List[Tweet]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM tweets WHERE account = ? ORDER BY id DESC LIMIT ?", (account, count)
+            ).fetchall()
+        return [
+            Tweet(
+                id=row["id"],
+                text=row["text"],
+                created_at=datetime.fromtimestamp(row["created_at"], tz=pytz.UTC),
+                fav_count=row["fav_count"],
+                rtw_count=row["rtw_count"]
+            )
+            for row in rows
+        ]
+
+
 class CityDAOTwitter(object):
 
-    def __init__(self, apikey: str, api_secret: str) -> None:
+    def __init__(
+        self,
+        apikey: str,
+        api_secret: str,
+        archive: Optional[TweetArchive] = None,
+        refresh_window: timedelta = timedelta(days=2),
+        max_pages: int = 16
+    ) -> None:
         auth = tw.OAuth1UserHandler(apikey, api_secret)
-        self.api = tw.API(auth, wait_on_rate_limit=True)
+        # rate limits end the sync early instead of sleeping, the archive still serves the report
+        self.api = tw.API(auth, wait_on_rate_limit=False)
         self.account = "CityDAO"
+        self.archive = TweetArchive() if archive is None else archive
+        self.refresh_window = refresh_window
+        self.max_pages = max_pages
+        self.logger = logging.getLogger(__name__)
 
-    def fetch_recent_tweets(self) -> List[str]:
-        tweets = self.api.user_timeline(
-            screen_name=self.account, 
+    @staticmethod
+    def _parse_tweet(tweet: Any) -> Tweet:
+        return Tweet(
+            id=tweet.id,
+            text=tweet.text,
+            created_at=tweet.created_at,
+            fav_count=tweet.favorite_count,
+            rtw_count=tweet.retweet_count
+        )
+
+    def _fetch_page(self, since_id: Optional[int], max_id: Optional[int]) -> List[Any]:
+        return self.api.user_timeline(
+            screen_name=self.account,
             include_rts=False,
             exclude_replies=True,
-            count=200
+            count=200,
+            since_id=since_id,
+            max_id=max_id,
+            trim_user=True
         )
-        return [
-            Tweet(
-                id=tweet.id,
-                text=tweet.text,
-                created_at=tweet.created_at,
-                fav_count=tweet.favorite_count,
-                rtw_count=tweet.retweet_count
-            )
-            for tweet in tweets
-        ]
+
+    def _sync_new_pages(self, fetched: Set[int]) -> None:
+        # a range cut short by rate limits or `max_pages` is resumed first on the next sync,
+        # otherwise the tweets below it would never be fetched
+        n_pages = 0
+        while n_pages < self.max_pages:
+            pending = self.archive.get_pending_range(self.account)
+            since_id, max_id = (self.archive.get_since_id(self.account), None) if pending is None else pending
+            while n_pages < self.max_pages:
+                tweets = self._fetch_page(since_id, max_id)
+                n_pages += 1
+                if len(tweets) == 0:
+                    self.archive.clear_pending_range(self.account)
+                    break
+                fetched.update(tweet.id for tweet in tweets)
+                max_id = min(tweet.id for tweet in tweets) - 1
+                self.archive.add_tweets(
+                    self.account,
+                    [self._parse_tweet(tweet) for tweet in tweets],
+                    pending_range=(since_id, max_id)
+                )
+            if pending is None:
+                break
+
+    def sync(self) -> int:
+        # new tweets since the newest archived one, paged backwards with max_id,
+        # then engagement of recent tweets that were not part of the new pages
+        fetched = set()
+        try:
+            if self.archive.get_since_id(self.account) is None:
+                # a cold archive (e.g. on a fresh CI runner) only needs the latest page for the report,
+                # older tweets are left to `backfill`
+                tweets = self._fetch_page(None, None)
+                fetched.update(tweet.id for tweet in tweets)
+                self.archive.add_tweets(self.account, [self._parse_tweet(tweet) for tweet in tweets])
+            else:
+                self._sync_new_pages(fetched)
+
+            recent = datetime.now(tz=pytz.UTC) - self.refresh_window
+            ids = [id for id in self.archive.get_ids_since(self.account, recent) if id not in fetched]
+            for i in range(0, len(ids), 100):
+                tweets = self.api.lookup_statuses(ids[i:i + 100], trim_user=True)
+                self.archive.add_tweets(self.account, [self._parse_tweet(tweet) for tweet in tweets])
+        except tw.TooManyRequests as e:
+            self.logger.warning(f"Twitter rate limit reached, serving tweets from the archive: {e}")
+        return len(fetched)
+
+    def backfill(self, max_pages: Optional[int] = None) -> int:
+        # tweets older than the oldest archived one, never part of `sync`
+        # so that a cold archive costs a single timeline call
+        max_pages = self.max_pages if max_pages is None else max_pages
+        n_tweets = 0
+        try:
+            for _ in range(max_pages):
+                oldest_id = self.archive.get_oldest_id(self.account)
+                tweets = self._fetch_page(None, None if oldest_id is None else oldest_id - 1)
+                if len(tweets) == 0:
+                    break
+                n_tweets += len(tweets)
+                self.archive.add_tweets(self.account, [self._parse_tweet(tweet) for tweet in tweets])
+        except tw.TooManyRequests as e:
+            self.logger.warning(f"Twitter rate limit reached, backfill stopped: {e}")
+        return n_tweets
+
+    def fetch_recent_tweets(self, count: int = 200, sync: bool = True) -> List[Tweet]:
+        if sync:
+            self.sync()
+        return self.archive.get_tweets(self.account, count)
 
     @staticmethod
     def _is_date_in_ytd(date: datetime) -> bool:
@@ -1,14 +1,260 @@
+import functools
 import json
-from typing import Optional
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 
-from ens import ENS
+from eth_utils import event_abi_to_log_topic
 from web3 import Web3
+from web3.contract import Contract
+
+from citydao.provider import ProviderRegistry
+
+
+def get_cache_dir() -> str:
+    cache_dir = os.getenv("CITYDAO_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "citydao")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def escape_markdown_v2(text: str) -> str:
+    return re.sub(r"([_*\[\]()~`>#+\-=|{}.!\\])", r"\\\1", text)
+
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+
+def _is_escaped(text: str, i: int) -> bool:
+    # text[i] follows an odd run of backslashes
+    n = 0
+    while i - n > 0 and text[i - n - 1] == "\\":
+        n += 1
+    return n % 2 == 1
+
+
+def _find_split(text: str, limit: int) -> int:
+    # last line break, then last space, in the second half of `limit`, otherwise a hard cut
+    for separator in ("\n", " "):
+        i = text.rfind(separator, limit // 2, limit + 1)
+        while i > limit // 2 and _is_escaped(text, i):
+            i = text.rfind(separator, limit // 2, i)
+        if i > limit // 2:
+            return i
+    i = limit
+    while _is_escaped(text, i):
+        i -= 1
+    return i
+
+
+def split_markdown_v2(text: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> List[str]:
+    # chunks of at most `limit` characters that never end on a dangling escape,
+    # a code block cut in two is closed and reopened so both chunks parse
+    chunks = []
+    while len(text) > limit:
+        i = _find_split(text, limit)
+        if text[:i].count("```") % 2 == 1:
+            i = _find_split(text, limit - 4)
+        chunk, rest = text[:i], text[i:]
+        if rest[:1] in ("\n", " "):
+            rest = rest[1:]
+        if chunk.count("```") % 2 == 1:
+            chunk, rest = chunk + "\n```", "```\n" + rest
+        chunks.append(chunk)
+        text = rest
+    if len(text) > 0:
+        chunks.append(text)
+    return chunks
+
+
+class TTLCache(object):
+    # LRU cache where every entry expires after its ttl, optionally persisted as json
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600., path: Optional[str] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        if self.path is not None and os.path.exists(self.path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"TTLCache(size={len(self)}, maxsize={self.maxsize})"
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.time():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        with self.lock:
+            self.data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def load(self) -> None:
+        with open(self.path, "r") as fp:
+            items = json.load(fp)
+        now = time.time()
+        with self.lock:
+            for key, (expires_at, value) in items:
+                if expires_at >= now:
+                    self.data[key] = (expires_at, value)
+
+    def save(self) -> None:
+        with self.lock:
+            items = [[key, list(item)] for key, item in self.data.items()]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(items, fp)
+        os.replace(tmp_path, self.path)
+
+
+class StaleWhileRevalidateCache(object):
+    # fresh values are returned as is, stale ones are returned at once while a background
+    # thread reloads them, concurrent misses of a key share a single load
+
+    def __init__(self, ttl: float = 60., max_stale: Optional[float] = None) -> None:
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.values = {}  # key -> (loaded_at, value)
+        self.loading = {}  # key -> Future
+        self.logger = logging.getLogger(__name__)
+
+    def __repr__(self) -> str:
+        return f"StaleWhileRevalidateCache(size={len(self.values)}, ttl={self.ttl})"
+
+    def _load(self, key: Hashable, loader: Callable[[], Any], future: Future) -> None:
+        try:
+            value = loader()
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            return
+
+        with self.lock:
+            self.values[key] = (time.monotonic(), value)
+            del self.loading[key]
+        future.set_result(value)
+
+    def get(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            item = self.values.get(key)
+            age = None if item is None else time.monotonic() - item[0]
+            if age is not None and age < ttl:
+                return item[1]
+
+            future = self.loading.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self.loading[key] = Future()
+
+            is_stale = age is not None and (self.max_stale is None or age < ttl + self.max_stale)
+            if is_stale:
+                if is_owner:
+                    threading.Thread(target=self._refresh, args=(key, loader, future), daemon=True).start()
+                return item[1]
+
+        # miss, the first caller loads in its own thread and concurrent callers wait for it
+        if is_owner:
+            self._load(key, loader, future)
+        return future.result()
+
+    def _refresh(self, key: Hashable, loader: Callable[[], Any], future: Future) -> None:
+        self._load(key, loader, future)
+        if future.exception() is not None:
+            self.logger.warning(f"Background refresh of {key} failed, keeping the stale value: {future.exception()}")
+
+    def refresh(self, key: Hashable, loader: Callable[[], Any]) -> None:
+        # warm a key in the background, no-op while it is already loading
+        with self.lock:
+            if key in self.loading:
+                return
+            future = self.loading[key] = Future()
+        threading.Thread(target=self._refresh, args=(key, loader, future), daemon=True).start()
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            self.values.pop(key, None)
+
+
+class ContractFactory(object):
+    # every ABI file is parsed once, contracts are cached per (endpoints, address, abi).
+    # keyed by endpoint rather than by Web3 instance, a contract holds its Web3 so an
+    # instance key would never be collected and short-lived instances would leak
+
+    _contracts = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def load_abi(abi_path: str) -> List[Dict[str, Any]]:
+        with open(abi_path, "r") as fp:
+            return json.load(fp)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_event_topics(abi_path: str) -> Dict[str, str]:
+        # event name -> topic0
+        return {
+            item["name"]: Web3.toHex(event_abi_to_log_topic(item))
+            for item in ContractFactory.load_abi(abi_path)
+            if item.get("type") == "event"
+        }
+
+    @staticmethod
+    def get_endpoint_key(provider: Web3) -> Optional[Tuple[str, ...]]:
+        # urls behind a Web3 instance, None for providers without a stable endpoint
+        backend = provider.provider
+        if hasattr(backend, "endpoints"):
+            return tuple(endpoint.url for endpoint in backend.endpoints)
+        endpoint_uri = getattr(backend, "endpoint_uri", None)
+        return None if endpoint_uri is None else (str(endpoint_uri),)
+
+    @classmethod
+    def get_contract(cls, provider: Web3, address: str, abi_path: str) -> Contract:
+        endpoint_key = cls.get_endpoint_key(provider)
+        if endpoint_key is None:
+            return provider.eth.contract(address=address, abi=ContractFactory.load_abi(abi_path))
+
+        key = (endpoint_key, address, abi_path)
+        with cls._lock:
+            if key not in cls._contracts:
+                cls._contracts[key] = provider.eth.contract(
+                    address=address,
+                    abi=ContractFactory.load_abi(abi_path)
+                )
+            return cls._contracts[key]
 
 
 class Web3Address(object):
+    __slots__ = ("address", "ens", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()
 
     def __init__(self, address: str, resolve_ens: bool = False) -> None:
-        self.address = address
+        self.address = sys.intern(address)
         self.ens = None
 
         if resolve_ens:
@@ -19,19 +265,32 @@ class Web3Address(object):
             return f"Web3Address({self.ens})"
         return f"Web3Address({self.address})"
 
+    @classmethod
+    def intern(cls, address: str) -> "Web3Address":
+        # share one instance per address, e.g. a voter across all of its votes
+        instance = cls._interned.get(address)
+        if instance is None:
+            instance = cls(address)
+            cls._interned[address] = instance
+        return instance
+
     @staticmethod
     def get_default_provider() -> Web3:
-        rpc_url = "https://rpc.ankr.com/eth"
-        return Web3(Web3.HTTPProvider(rpc_url))
+        return ProviderRegistry.get()
     
-    def get_contract(self, provider: Web3, abi_path: str) -> None:
-        with open(abi_path, "r") as fp:
-            abi = json.load(fp)
-        return provider.eth.contract(
-            address=self.address,
-            abi=abi
-        )
+    def get_contract(self, provider: Web3, abi_path: str) -> Contract:
+        return ContractFactory.get_contract(provider, self.address, abi_path)
 
     def resolve_ens(self, provider: Optional[Web3] = None) -> None:
-        provider = Web3Address.get_default_provider()
-        self.ens = ENS.fromWeb3(provider).name(self.address)
+        Web3Address.resolve_ens_many([self], provider=provider)
+
+    @staticmethod
+    def resolve_ens_many(addresses: List["Web3Address"], provider: Optional[Web3] = None) -> None:
+        from citydao.resolver import ENSResolver
+
+        if len(addresses) == 0:
+            return
+        resolver = ENSResolver.default() if provider is None else ENSResolver(provider=provider)
+        names = resolver.resolve_many([address.address for address in addresses])
+        for address in addresses:
+            address.ens = names[address.address]
@@ -0,0 +1,31 @@
+import asyncio
+import os
+from dotenv import load_dotenv
+
+from citydao.aio import AsyncTelegramBot
+
+
+def main():
+    load_dotenv()
+
+    bot = AsyncTelegramBot(token=os.getenv("TELEGRAM_TOKEN", None))
+    if os.getenv("SPOTIFY_CLIENT_ID"):
+        bot.init_spotify(os.getenv("SPOTIFY_CLIENT_ID"), os.getenv("SPOTIFY_CLIENT_CREDENTIALS"))
+    if os.getenv("TWITTER_APIKEY"):
+        bot.init_twitter(os.getenv("TWITTER_APIKEY"), os.getenv("TWITTER_API_SECRET"))
+    if os.getenv("GOOGLE_APIKEY"):
+        bot.init_google(os.getenv("GOOGLE_APIKEY"))
+
+    webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL")
+    if webhook_url:
+        bot.run_webhook(
+            webhook_url,
+            port=int(os.getenv("PORT", 8080)),
+            secret_token=os.getenv("TELEGRAM_WEBHOOK_SECRET")
+        )
+    else:
+        asyncio.run(bot.run_polling())
+
+
+if __name__ == "__main__":
+    main()
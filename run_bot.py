@@ -1,4 +1,7 @@
 import os
+from datetime import datetime
+
+import pytz
 from dotenv import load_dotenv
 
 from citydao.bot import TelegramBot
@@ -7,8 +10,17 @@ from citydao.bot import TelegramBot
 def main():
     load_dotenv()
 
-    bot = TelegramBot(token=os.getenv("TELEGRAM_TOKEN", None))
-    bot.run()
+    bot = TelegramBot(token=os.getenv("TELEGRAM_TOKEN", None), discover_tokens=True)
+    if os.getenv("SPOTIFY_CLIENT_ID"):
+        bot.init_spotify(os.getenv("SPOTIFY_CLIENT_ID"), os.getenv("SPOTIFY_CLIENT_CREDENTIALS"))
+    if os.getenv("TWITTER_APIKEY"):
+        bot.init_twitter(os.getenv("TWITTER_APIKEY"), os.getenv("TWITTER_API_SECRET"))
+    if os.getenv("GOOGLE_APIKEY"):
+        bot.init_google(os.getenv("GOOGLE_APIKEY"))
+
+    # chats that sent /subscribe get the daily report from this process, at the time of the scheduled workflow
+    report_time = datetime.strptime(os.getenv("TELEGRAM_REPORT_TIME", "00:01"), "%H:%M").time()
+    bot.run(report_time=report_time.replace(tzinfo=pytz.UTC))
 
 
 if __name__ == "__main__":
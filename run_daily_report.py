@@ -11,6 +11,7 @@ def main() -> None:
     telegram_bot = TelegramBot(
         token=os.getenv("TELEGRAM_TOKEN"),
         chat_id=os.getenv("TELEGRAM_CHAT_ID"),
+        discover_tokens=True,
     )
     telegram_bot.init_spotify(
         client_id=os.getenv("SPOTIFY_CLIENT_ID"),
@@ -22,32 +23,9 @@ def main() -> None:
     )
     telegram_bot.init_google(apikey=os.getenv("GOOGLE_APIKEY"))
 
-    tweets_msg = telegram_bot.get_tweets_msg()
-    proposal_msg = telegram_bot.get_proposals_msg()
-    treasury_msg = telegram_bot.get_treasury_msg()
-    calendar_msg = telegram_bot.get_calendar_msg()
-    spotify_msg = telegram_bot.get_spotify_msg()
-
-    # send telegram message
-    telegram_bot.send_message(
-        msg=tweets_msg
-    )
-
-    telegram_bot.send_message(
-        msg=spotify_msg
-    )
-
-    telegram_bot.send_message(
-        msg=treasury_msg
-    )
-
-    telegram_bot.send_message(
-        msg=calendar_msg
-    )
-
-    telegram_bot.send_message(
-        msg=proposal_msg
-    )
+    # all sources are fetched concurrently, sections are sent in order as they become ready.
+    # this runs on a fresh runner, subscribed chats are served by the bot process (run_bot.py)
+    telegram_bot.send_daily_report()
 
 if __name__ == "__main__":
     main()
@@ -1,20 +1,183 @@
+import asyncio
+import gc
+import json
 import os
-import sys
+import tempfile
+import threading
+import time
 import unittest
+import weakref
+from unittest import mock
 from datetime import datetime, timedelta
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
+import httplib2
+import pytz
+import requests
+from aiohttp.test_utils import TestClient, TestServer
 from dotenv import load_dotenv
+from googleapiclient.errors import HttpError
+from telegram.error import ChatMigrated, RetryAfter, Unauthorized
+from web3 import Web3
 
-from citydao.calendar import CityDAOCalendar
-from citydao.spotify import CityDAOSpotify
-from citydao.treasury import CityDAOTreasury
-from citydao.tweets import CityDAOTwitter
+from citydao.aio import AsyncCityDAOTreasury, AsyncHTTPClient, AsyncTelegramBot
+from citydao.analytics import VoteArrays, join_citizen_votes
+from citydao.bot import ReportPipeline, ReportSource, TelegramBot
+from citydao.broadcast import SendQueue, SubscriptionStore
+from citydao.calendar import CalendarEventStore, CityDAOCalendar
+from citydao.citizen import CitizenHolderIndex, CitizenHolderStore, CitizenId, CitizenNFT, NFTAddress
+from citydao.history import BalanceHistoryStore, BlockTimestampIndex
+from citydao.indexer import (
+    LogScanner, TreasuryIndexer, TreasuryLogStore, address_to_topic, find_deployment_block, is_too_many_results
+)
+from citydao.provider import FailoverHTTPProvider, OfflineProvider, ProviderRegistry
+from citydao.resolver import ENSResolver
+from citydao.snapshot import (
+    MultiSpaceSnapshotAPI, ProposalStatus, SnapshotAPI, SnapshotProposal, SnapshotVote, parse_proposal
+)
+from citydao.store import SnapshotStore
+from citydao.spotify import CityDAOSpotify, EpisodeCatalog
+from citydao.treasury import CityDAOTreasury, TokenMetadataStore
+from citydao.tweets import CityDAOTwitter, TweetArchive
+import citydao.utils
+from citydao.utils import ContractFactory, StaleWhileRevalidateCache, Web3Address, escape_markdown_v2, split_markdown_v2
+
+
+class FakeSnapshotHub(object):
+
+    def __init__(self, votes, proposals=()) -> None:
+        self.votes = list(votes)
+        self.proposals = list(proposals)
+        self.n_queries = 0
+
+    def query(self, query: str, variables=None, timeout=None):
+        self.n_queries += 1
+        if "space(" in query:
+            return {"data": {"space": {"id": variables["id"], "name": variables["id"], "network": 1, "symbol": "X"}}}
+
+        if "proposals(" in query:
+            if "ids" in variables:
+                proposals = [proposal for proposal in self.proposals if proposal["id"] in variables["ids"]]
+            else:
+                proposals = [
+                    proposal for proposal in self.proposals
+                    if proposal.get("space", "daocity.eth") == variables["space"]
+                    and proposal["created"] > variables.get("watermark", -1)
+                    and proposal["state"] == variables.get("state", proposal["state"])
+                ]
+            return {"data": {"proposals": proposals}}
+
+        data = {}
+        for i in range(query.count("votes(")):
+            votes = sorted(
+                [
+                    vote for vote in self.votes
+                    if vote["proposal"] == variables[f"proposal{i}"]
+                    and variables[f"since{i}"] <= vote["created"] <= variables[f"cursor{i}"]
+                ],
+                key=lambda vote: -vote["created"]
+            )
+            skip = variables[f"skip{i}"]
+            data[f"p{i}"] = votes[skip:skip + variables["first"]]
+        return {"data": data}
+
+
+def make_raw_proposal(id: str, created: int = 0, state: str = "closed"):
+    return {
+        "id": id, "title": "", "body": "", "choices": ["For", "Against"], "start": 0, "end": 0,
+        "state": state, "author": "0x0", "snapshot": "0", "quorum": 0, "scores": [0, 0], "created": created
+    }
+
+
+def make_proposal(id: str, state: str = "closed") -> SnapshotProposal:
+    return parse_proposal(make_raw_proposal(id, state=state), "daocity.eth")
+
+
+def make_votes(proposal_id: str, n: int):
+    # votes sharing a timestamp across page boundaries
+    return [
+        {"id": f"{proposal_id}{i}", "proposal": proposal_id, "voter": f"0x{i:040x}",
+         "created": 1000 + i // 3, "choice": 1 + i % 2, "vp": 1.}
+        for i in range(n)
+    ]
+
+
+class FakeRPCHandler(BaseHTTPRequestHandler):
+    # answers every request with block number 16, `/down` and `/forbidden` always fail,
+    # `/limited` answers with a rate limit error and `/nobatch` rejects batches with a single error object
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path in ["/down", "/forbidden"]:
+            self.send_response(503 if self.path == "/down" else 403)
+            self.end_headers()
+            return
+
+        if self.path == "/limited":
+            response = {"jsonrpc": "2.0", "id": 1, "error": {"code": -32005, "message": "daily request count exceeded"}}
+        elif self.path == "/nobatch" and isinstance(request, list):
+            error = {"code": -32600, "message": "batch requests are disabled"}
+            response = {"jsonrpc": "2.0", "id": None, "error": error}
+        elif isinstance(request, list):
+            response = [{"jsonrpc": "2.0", "id": r["id"], "result": "0x10"} for r in reversed(request)]
+        else:
+            response = {"jsonrpc": "2.0", "id": request["id"], "result": "0x10"}
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeLogProvider(object):
+    # eth_getLogs over a fixed list of logs, ranges wider than `max_range` are rejected
+
+    class FakeEth(object):
+
+        def __init__(self, logs, max_range) -> None:
+            self.logs = logs
+            self.max_range = max_range
+            self.requested = []
+
+        def get_logs(self, params):
+            self.requested.append((params["fromBlock"], params["toBlock"]))
+            if self.max_range is not None and params["toBlock"] - params["fromBlock"] >= self.max_range:
+                raise ValueError({"code": -32005, "message": "query returned more than 10000 results"})
+            topics = [topic if topic is None or isinstance(topic, list) else [topic] for topic in params["topics"]]
+            return [
+                log for log in self.logs
+                if params["fromBlock"] <= log["blockNumber"] <= params["toBlock"]
+                and all(
+                    topic is None or Web3.toHex(log_topic) in topic
+                    for topic, log_topic in zip(topics, log["topics"])
+                )
+            ]
+
+    def __init__(self, logs, max_range=None) -> None:
+        self.eth = FakeLogProvider.FakeEth(logs, max_range)
 
 
 class CityDAOTester(unittest.TestCase):
 
     def setUp(self):
         load_dotenv()
+        # default stores write under the cache dir, keep them out of the developer's ~/.cache/citydao
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"CITYDAO_CACHE_DIR": self.cache_dir.name})
+        self.env.start()
+        TokenMetadataStore._default = None
+        ENSResolver._default = None
+
+    def tearDown(self):
+        TokenMetadataStore._default = None
+        ENSResolver._default = None
+        self.env.stop()
+        self.cache_dir.cleanup()
 
 
     def test_isin_today(self):
@@ -23,23 +186,862 @@ class CityDAOTester(unittest.TestCase):
         assert not CityDAOTwitter._is_date_in_ytd(ytd - timedelta(days=2))
 
 
+    def test_iter_votes(self):
+        snapshot = SnapshotAPI(use_store=False, transport=FakeSnapshotHub(make_votes("0x1", 25)))
+        proposal = make_proposal("0x1")
+
+        fetched = list(snapshot.iter_votes(proposal, page_size=4))
+        assert len(fetched) == 25
+        assert len({vote.voter.address for vote in fetched}) == 25
+
+        table = snapshot.get_votes_columnar(proposal, page_size=2)
+        assert len(table) == 25 and len(table.voters) == 25
+        assert sorted(set(table.choice)) == [0, 1]
+        assert [vote.choice for vote in table] == [vote.choice for vote in fetched]
+        assert table[-1].voter is Web3Address.intern(fetched[-1].voter.address)
+
+
+    def test_get_votes_many(self):
+        n_votes = {"0x1": 25, "0x2": 3, "0x3": 0, "0x4": 10}
+        hub = FakeSnapshotHub([
+            vote for proposal_id, n in n_votes.items() for vote in make_votes(proposal_id, n)
+        ])
+        snapshot = SnapshotAPI(use_store=False, transport=hub)
+        votes = snapshot.get_votes_many([make_proposal(proposal_id) for proposal_id in n_votes], page_size=4)
+        assert {proposal_id: len(v) for proposal_id, v in votes.items()} == n_votes
+        assert hub.n_queries < sum(len(range(0, n + 1, 4)) for n in n_votes.values())
+
+
+    def test_snapshot_store_sync(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            hub = FakeSnapshotHub(
+                make_votes("0x1", 7) + make_votes("0x2", 5),
+                proposals=[make_raw_proposal("0x1", created=1), make_raw_proposal("0x2", created=2, state="active")]
+            )
+            snapshot = SnapshotAPI(store=SnapshotStore(os.path.join(tmp_dir, "snapshot.db")), transport=hub)
+            # a cold store queries the requested state without paging the whole space
+            assert [proposal.id for proposal in snapshot.get_proposals(ProposalStatus.ACTIVE)] == ["0x2"]
+            assert hub.n_queries == 1 and snapshot.store.get_proposal_watermark("daocity.eth") is None
+
+            assert len(snapshot.get_proposals()) == 2
+            assert len(snapshot.get_proposals(ProposalStatus.ACTIVE)) == 1
+
+            proposals = {proposal.id: proposal for proposal in snapshot.get_proposals()}
+            assert len(snapshot.get_votes(proposals["0x1"], page_size=4)) == 7
+            assert len(snapshot.get_votes(proposals["0x2"], page_size=4)) == 5
+
+            # closed proposal is frozen, active one only fetches past its watermark
+            hub.votes += make_votes("0x2", 9)[5:]
+            n_queries = hub.n_queries
+            votes = snapshot.get_votes_many(list(proposals.values()), page_size=10)
+            assert len(votes["0x1"]) == 7 and len(votes["0x2"]) == 9
+            assert hub.n_queries - n_queries == 1
+
+            # a re-vote replaces the earlier vote of the same voter under a new id
+            revote = {**make_votes("0x2", 1)[0], "id": "0x2revote", "created": 2000, "choice": 2, "vp": 3.}
+            hub.votes.append(revote)
+            snapshot.sync_votes([proposals["0x2"]])
+            stored = snapshot.store.get_votes("0x2")
+            assert len(stored) == 9 and len({vote["voter"] for vote in stored}) == 9
+            assert stored[0]["id"] == "0x2revote" and sum(vote["vp"] for vote in stored) == 11.
+
+
+    def test_multi_space_summary(self):
+        proposals = [
+            {**make_raw_proposal(f"0x{i}", created=i, state="active"), "space": space}
+            for i, space in enumerate(["daocity.eth", "daocity.eth", "partner.eth"])
+        ]
+        hub = FakeSnapshotHub(make_votes("0x0", 3) + make_votes("0x2", 4), proposals=proposals)
+        snapshot = MultiSpaceSnapshotAPI(["daocity.eth", "partner.eth", "empty.eth"], use_store=False, transport=hub)
+
+        summary = snapshot.get_summary(include_votes=True)
+        assert {space: len(s.proposals) for space, s in summary.items()} == {
+            "daocity.eth": 2, "partner.eth": 1, "empty.eth": 0
+        }
+        assert len(summary["partner.eth"].votes["0x2"]) == 4
+        assert summary["partner.eth"].proposals[0].url == "https://snapshot.org/#/partner.eth/proposal/0x2"
+        assert "partner\\.eth Snapshot" in snapshot.format_summary(summary)
+
+
+    def test_vote_analytics(self):
+        votes = VoteArrays.from_columns({
+            "voter": ["0xa", "0xb", "0xc", "0xd"],
+            "created": [0, 1800, 3600, 7300],
+            "choice": [0, 1, 0, 0],
+            "vp": [1., 1., 1., 7.],
+        }, choices=["For", "Against"])
+
+        assert votes.tally() == {"For": 9., "Against": 1.}
+        timestamps, scores = votes.score_timeseries(bucket_sec=3600)
+        assert timestamps.tolist() == [0, 3600, 7200]
+        assert scores.tolist() == [[1., 1.], [2., 1.], [9., 1.]]
+        assert votes.turnout_timeseries(bucket_sec=3600)[1].tolist() == [2, 3, 4]
+        assert votes.nakamoto() == 1
+        assert votes.quorum_reached_at(3.) == 3600
+        assert votes.quorum_reached_at(11.) is None
+        assert abs(votes.gini() - 0.45) < 1e-9
+
+        # no voting power at all is controlled by nobody
+        no_vp = VoteArrays.from_columns(
+            {"voter": ["0xa", "0xb"], "created": [0, 0], "choice": [0, 1], "vp": [0., 0.]}, choices=["For", "Against"]
+        )
+        assert no_vp.nakamoto() == 0 and no_vp.gini() == 0.
+
+
+    def test_citizen_participation(self):
+        def make_arrays(voters, vp):
+            return VoteArrays.from_columns(
+                {"voter": voters, "created": [0] * len(voters), "choice": [0] * len(voters), "vp": vp},
+                choices=["For", "Against"]
+            )
+
+        votes = {
+            "p2": make_arrays(["0xA", "0xc", "0xD"], [1., 2., 3.]),
+            "p1": make_arrays(["0xa", "0xB"], [4., 5.]),
+        }
+        holdings = {"0xa": {42: 1}, "0xB": {42: 2, 69: 1}, "0xe": {7: 1}}
+        tables = join_citizen_votes(votes, holdings, created={"p1": 100, "p2": 200})
+
+        proposals = tables.proposals
+        assert proposals["id"].tolist() == ["p2", "p1"]
+        assert proposals["n_voters"].tolist() == [3, 2]
+        assert proposals["n_repeat_voters"].tolist() == [1, 0]
+        assert proposals["n_citizen_voters"].tolist() == [1, 2]
+        assert proposals["citizen_turnout"].tolist() == [0.5, 1.]
+        assert proposals["founding_citizen_vp"].tolist() == [0., 5.]
+        assert proposals["non_citizen_vp"].tolist() == [5., 0.]
+
+        addresses = dict(zip(tables.addresses["address"].tolist(), tables.addresses["n_votes"].tolist()))
+        assert addresses == {"0xa": 2, "0xc": 1, "0xd": 1, "0xb": 1}
+        assert tables.addresses["is_citizen"].tolist() == [True, False, False, True]
+
+
+    def test_ens_resolver_cache(self):
+        names = {f"0x{i:040x}": f"citizen{i}.eth" if i % 2 == 0 else "" for i in range(5)}
+        calls = []
+
+        class FakeResolver(ENSResolver):
+            def _get_names(self, addresses):
+                calls.append(addresses)
+                return [names[address.lower()] for address in addresses]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = os.path.join(tmp_dir, "ens.json")
+            resolver = FakeResolver(cache_path=cache_path, batch_size=2)
+            resolved = resolver.resolve_many(list(names))
+            assert resolved == {address: name or None for address, name in names.items()}
+            assert len(calls) == 3
+
+            # hits and misses are both served from the persisted cache
+            assert FakeResolver(cache_path=cache_path).resolve_many(list(names)) == resolved
+            assert len(calls) == 3
+
+
+    def test_tweet_archive_sync(self):
+        now = datetime.now(tz=pytz.UTC)
+        timeline = [
+            SimpleNamespace(
+                id=i, text=f"tweet {i}", created_at=now - timedelta(hours=100 - i, minutes=30),
+                favorite_count=i, retweet_count=0
+            )
+            for i in range(1, 101)
+        ]
+        calls = []
+
+        class FakeAPI(object):
+            def user_timeline(self, since_id=None, max_id=None, count=200, **kwargs):
+                calls.append(("timeline", since_id, max_id))
+                tweets = [
+                    tweet for tweet in reversed(timeline)
+                    if (since_id is None or tweet.id > since_id) and (max_id is None or tweet.id <= max_id)
+                ]
+                # the timeline pages are smaller than `count` once replies are filtered out
+                return tweets[:min(count, 30)]
+
+            def lookup_statuses(self, ids, **kwargs):
+                calls.append(("lookup", len(ids)))
+                return [SimpleNamespace(**{**vars(timeline[id - 1]), "favorite_count": 1000}) for id in ids]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            twitter = CityDAOTwitter("key", "secret", archive=TweetArchive(os.path.join(tmp_dir, "tweets.db")))
+            twitter.api = FakeAPI()
+            # a cold archive costs one timeline call, older tweets only come with an explicit backfill
+            assert twitter.sync() == 30
+            assert calls == [("timeline", None, None)]
+            assert twitter.backfill() == 70
+            assert [call[2] for call in calls if call[0] == "timeline"] == [None, 70, 40, 10, 0]
+
+            calls.clear()
+            timeline.append(SimpleNamespace(id=101, text="new", created_at=now, favorite_count=0, retweet_count=0))
+            assert twitter.sync() == 1
+            # tweets of the last two days that were not just fetched: ids 53..100
+            assert calls == [("timeline", 100, None), ("timeline", 100, 100), ("lookup", 48)]
+
+            tweets = twitter.fetch_recent_tweets(count=3, sync=False)
+            assert [tweet.id for tweet in tweets] == [101, 100, 99]
+            assert [tweet.fav_count for tweet in tweets] == [0, 1000, 1000]
+
+        # a sync cut short resumes the unfinished range before fetching newer tweets
+        timeline.pop()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = TweetArchive(os.path.join(tmp_dir, "tweets.db"))
+            archive.add_tweets("CityDAO", [CityDAOTwitter._parse_tweet(tweet) for tweet in timeline[:10]])
+            twitter = CityDAOTwitter("key", "secret", archive=archive, max_pages=2)
+            twitter.api = FakeAPI()
+            assert twitter.sync() == 60
+            assert archive.get_pending_range("CityDAO") == (10, 40)
+
+            calls.clear()
+            timeline.append(SimpleNamespace(id=101, text="new", created_at=now, favorite_count=0, retweet_count=0))
+            twitter.max_pages = 16
+            assert twitter.sync() == 31
+            timeline_calls = [call[1:] for call in calls if call[0] == "timeline"]
+            assert timeline_calls == [(10, 40), (10, 10), (100, None), (100, 100)]
+            assert archive.get_pending_range("CityDAO") is None
+            assert len(archive.get_tweets("CityDAO")) == 101
+
+
     def test_fetch_twitter(self):
         citydao_twitter = CityDAOTwitter(
             apikey=os.getenv("TWITTER_APIKEY"),
             api_secret=os.getenv("TWITTER_API_SECRET")
         )
         latest_tweets = citydao_twitter.fetch_recent_tweets()
-        today_tweets = citydao_twitter.filter_today_tweets(latest_tweets)
+        citydao_twitter.filter_today_tweets(latest_tweets)
 
 
     def test_balance(self):
         treasury = CityDAOTreasury()
-        balance = treasury.get_balance()
+        treasury.get_balance()
+
+
+    def test_balance_multicall(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            treasury = CityDAOTreasury(
+                safe_addresses=[
+                    "0x60e7343205C9C88788a22C40030d35f9370d302D", "0x0000000000000000000000000000000000000001"
+                ],
+                metadata=TokenMetadataStore(os.path.join(tmp_dir, "tokens.json"))
+            )
+            codec = treasury.provider.codec
+            n_calls = []
+
+            class FakeAggregate3(object):
+                def __init__(self, calls):
+                    n_calls.append(len(calls))
+
+                def call(self, block_identifier="latest"):
+                    outputs = [("string", "WETH"), ("uint8", 18), ("string", "USDC"), ("uint8", 6)]
+                    outputs = outputs[:n_calls[-1] - 6]
+                    outputs += [("uint256", 2 * 10**18), ("uint256", 5 * 10**6), ("uint256", 10**18)] * 2
+                    return [(True, codec.encode_abi([type_], [value])) for type_, value in outputs]
+
+            with mock.patch.object(treasury.multicall.contract.functions, "aggregate3", FakeAggregate3):
+                assert treasury.get_balance() == {"WETH": 4., "USDC": 10., "ETH": 2.}
+                # token metadata is only read once
+                assert treasury.get_balance() == {"WETH": 4., "USDC": 10., "ETH": 2.}
+            assert n_calls == [10, 6]
+
+            # discovered tokens keep their ticker and a zero balance, they are only hidden in the report
+            spent, held = "0x0000000000000000000000000000000000000002", "0x0000000000000000000000000000000000000003"
+            treasury.metadata.set(spent, symbol="WETH", decimals=18)
+            treasury.metadata.set(held, symbol="WETH", decimals=18)
+            treasury.add_tokens([spent, held])
+
+            class FakeBalances(object):
+                def __init__(self, calls):
+                    self.n_calls = len(calls)
+
+                def call(self, block_identifier="latest"):
+                    values = [2 * 10**18, 5 * 10**6, 0, 10**18, 10**18] * 2
+                    return [(True, codec.encode_abi(["uint256"], [value])) for value in values]
+
+            with mock.patch.object(treasury.multicall.contract.functions, "aggregate3", FakeBalances):
+                balance = treasury.get_balance()
+            assert balance == {"WETH": 4., "USDC": 10., spent: 0., held: 2., "ETH": 2.}
+            assert list(balance) == treasury.get_tickers()
+            assert spent not in treasury.format_balance(balance) and held in treasury.format_balance(balance)
+
+            # on-chain symbols are untrusted and escaped inside the code span
+            assert "`FREE\\`\\\\\\_`" in treasury.format_balance({"FREE`\\_": 1.})
+
+
+    def test_balance_history(self):
+        # blocks every 12 seconds with a gap between block 100 and 101
+        block_timestamps = [1000 + 12 * i + (600 if i > 100 else 0) for i in range(1000)]
+        index = BlockTimestampIndex(provider=Web3())
+        index.get_timestamp = lambda block_number: block_timestamps[block_number]
+        for timestamp in [1000, 1011, 1012, 2200, 2500, 2812, 13587, 99999]:
+            block_number = index.get_block_number(timestamp, latest=999)
+            assert block_timestamps[block_number] <= timestamp
+            assert block_number == 999 or block_timestamps[block_number + 1] > timestamp
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = BalanceHistoryStore(["WETH", "ETH"], cache_dir=tmp_dir)
+            store.append([[200, 20, 1., 2.], [100, 10, 3., 4.]])
+            store.append([[300, 30, 5., 6.]])
+            history = store.to_dict(BalanceHistoryStore(["WETH", "ETH"], cache_dir=tmp_dir).load())
+            assert history["timestamp"].tolist() == [100, 200, 300]
+            assert history["ETH"].tolist() == [4., 2., 6.]
+
+
+    def test_treasury_indexer(self):
+        safe = "0x60e7343205C9C88788a22C40030d35f9370d302D"
+        token = "0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48"
+        dai = "0x6B175474E89094C44Da98b954EedeAC495271d0F"
+        other = "0x0000000000000000000000000000000000000001"
+        transfer_topic = Web3.keccak(text="Transfer(address,address,uint256)")
+        transfer_filter = {"topics": [Web3.toHex(transfer_topic)]}
+        logs = [
+            {
+                "address": address, "blockNumber": block, "logIndex": 0,
+                "transactionHash": Web3.keccak(block), "data": Web3.toHex(block.to_bytes(32, "big")),
+                "topics": [
+                    transfer_topic,
+                    Web3.toBytes(hexstr=address_to_topic(sender)),
+                    Web3.toBytes(hexstr=address_to_topic(recipient))
+                ]
+            }
+            for address, block, sender, recipient in
+            [(token, block, other, safe) for block in range(0, 1000, 7)]
+            + [(token, 500, safe, other), (dai, 800, other, safe)]
+        ]
+        provider = FakeLogProvider(logs, max_range=100)
+        requested = provider.eth.requested
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            treasury = CityDAOTreasury(metadata=TokenMetadataStore(os.path.join(tmp_dir, "tokens.json")))
+            store = TreasuryLogStore(os.path.join(tmp_dir, "treasury.db"))
+            scanner = LogScanner(provider, chunk_size=1000)
+            indexer = TreasuryIndexer(treasury, store=store, scanner=scanner, start_block=0)
+            indexer.sync(to_block=499)
+            assert store.get_checkpoint(indexer.checkpoint_name) == 499
+            # oversized ranges were split until the provider accepted them
+            assert any(to_block - from_block >= 100 for from_block, to_block in requested)
+            assert indexer.scanner.chunk_size < 1000
+
+            # read timeouts on large ranges split them as well
+            get_logs = provider.eth.get_logs
+
+            def slow_get_logs(filter_params):
+                if filter_params["toBlock"] - filter_params["fromBlock"] >= 50:
+                    raise requests.exceptions.ReadTimeout("Read timed out. (read timeout=10.0)")
+                return get_logs(filter_params)
+
+            with mock.patch.object(provider.eth, "get_logs", slow_get_logs):
+                found = LogScanner(provider, chunk_size=400).get_logs(transfer_filter, 600, 999)
+            expected = [log for log in logs if 600 <= log["blockNumber"] <= 999]
+            assert sorted(log["transactionHash"] for log in found) == sorted(log["transactionHash"] for log in expected)
+
+            # throttled requests are retried with backoff instead of split
+            assert not is_too_many_results(Exception("429 Client Error: Too Many Requests"))
+            assert not is_too_many_results(ValueError({"code": -32005, "message": "rate limit exceeded"}))
+            throttled = [ValueError({"code": -32005, "message": "daily request count exceeded, request rate limited"})]
+            throttled *= 2
+            requested.clear()
+
+            def throttled_get_logs(filter_params):
+                if len(throttled) > 0:
+                    requested.append((filter_params["fromBlock"], filter_params["toBlock"]))
+                    raise throttled.pop()
+                return get_logs(filter_params)
+
+            with mock.patch.object(provider.eth, "get_logs", throttled_get_logs):
+                found = LogScanner(provider, backoff_factor=0.).get_logs(transfer_filter, 600, 649)
+            assert len(found) == len([log for log in logs if 600 <= log["blockNumber"] <= 649])
+            assert requested == [(600, 649)] * 3
+
+            # resumes from the checkpoint
+            requested.clear()
+            indexer.sync(to_block=999)
+            assert min(from_block for from_block, _ in requested) == 500
+
+            inflows = indexer.get_transfers(token=token, direction="in")
+            assert [transfer["block"] for transfer in inflows] == list(range(0, 1000, 7))
+            assert indexer.get_flows() == {
+                token: {"in": sum(range(0, 1000, 7)), "out": 500},
+                dai: {"in": 800, "out": 0}
+            }
+            assert len(indexer.get_transfers(direction="out", from_block=500, to_block=500)) == 1
+
+            # tokens received by the safe are added to the balance read
+            treasury.indexer = indexer
+            with mock.patch.object(indexer, "sync"):
+                assert treasury.discover_tokens() == [dai]
+                assert treasury.discover_tokens() == []
+            assert treasury.tokens[-1] == dai and len(treasury.token_contracts) == 3
+
+        # the first sync starts at the deployment block of the oldest safe
+        code_calls = []
+
+        def get_code(address, block_identifier):
+            code_calls.append(block_identifier)
+            return b"\x60" if block_identifier >= 12345678 else b""
+
+        eth = SimpleNamespace(block_number=15000000, get_code=get_code)
+        assert find_deployment_block(SimpleNamespace(eth=eth), safe) == 12345678 and len(code_calls) < 30
+        no_code = SimpleNamespace(eth=SimpleNamespace(block_number=10, get_code=lambda *args: b""))
+        assert find_deployment_block(no_code, safe) == 0
+
+
+    def test_citizen_holder_index(self):
+        codec = Web3().codec
+        minter = "0x0000000000000000000000000000000000000000"
+        alice = "0x0000000000000000000000000000000000000A11"
+        bob = "0x0000000000000000000000000000000000000B0B"
+        single_topic = Web3.keccak(text="TransferSingle(address,address,address,uint256,uint256)")
+        batch_topic = Web3.keccak(text="TransferBatch(address,address,address,uint256[],uint256[])")
+
+        def make_log(block, sender, recipient, ids, values):
+            if isinstance(ids, list):
+                topic, data = batch_topic, codec.encode_abi(["uint256[]", "uint256[]"], [ids, values])
+            else:
+                topic, data = single_topic, codec.encode_abi(["uint256", "uint256"], [ids, values])
+            return {
+                "address": NFTAddress.CITIZEN.value, "blockNumber": block, "logIndex": 0,
+                "transactionHash": Web3.keccak(block), "data": Web3.toHex(data),
+                "topics": [topic, Web3.toBytes(hexstr=address_to_topic(sender))] + [
+                    Web3.toBytes(hexstr=address_to_topic(address)) for address in (sender, recipient)
+                ]
+            }
+
+        logs = [
+            make_log(10, minter, alice, [42, 69], [3, 1]),
+            make_log(20, alice, bob, 42, 2),
+            make_log(30, bob, alice, 42, 1),
+            make_log(40, alice, bob, [69], [1]),
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "citizen.db")
+            index = CitizenHolderIndex(
+                Web3(), store=CitizenHolderStore(path), scanner=LogScanner(FakeLogProvider(logs)), start_block=0
+            )
+            index.sync(to_block=35)
+            holders = sorted([Web3.toChecksumAddress(alice), Web3.toChecksumAddress(bob)])
+            assert index.get_holders(CitizenId.CITIZEN) == holders
+            assert index.get_balances(alice) == {42: 2, 69: 1}
+            index.sync(to_block=50)
+            assert index.get_holders(CitizenId.FOUNDING_CITIZEN) == [Web3.toChecksumAddress(bob)]
+
+            # balances are restored from disk and snapshots replay up to a block
+            index = CitizenHolderIndex(
+                Web3(), store=CitizenHolderStore(path), scanner=LogScanner(FakeLogProvider(logs)), start_block=0
+            )
+            assert index.get_balance(bob, CitizenId.CITIZEN) == 1
+            assert index.get_snapshot(15) == {Web3.toChecksumAddress(alice): {42: 3, 69: 1}}
+
+
+    def test_citizen_balances_many(self):
+        citizen = CitizenNFT(provider=Web3())
+        voters = [Web3.toChecksumAddress(f"0x{i:040x}") for i in range(1, 101)]
+        holdings = {(voters[i], 42): 1 for i in range(0, 100, 2)}
+        holdings.update({(voters[i], 69): 1 for i in range(0, 100, 5)})
+        n_functions = []
+
+        def fake_call(functions, block_identifier="latest", max_calls=500):
+            n_functions.append(len(functions))
+            return [[holdings.get(pair, 0) for pair in zip(*function.args)] for function in functions]
+
+        with mock.patch.object(citizen.multicall, "call", fake_call):
+            balances = citizen.get_balances_many(voters, chunk_size=64)
+            assert balances[voters[10]] == {
+                CitizenId.CITIZEN: 1, CitizenId.FOUNDING_CITIZEN: 1, CitizenId.FIRST_CITIZEN: 0
+            }
+            assert n_functions == [5]
+
+            # served from the cache
+            votes = [SnapshotVote(Web3Address(voter), created=0, choice=1, vp=1.) for voter in voters]
+            share = citizen.get_vote_share(votes)
+            assert n_functions == [5, 0]
+            assert share == {"CITIZEN": 0.5, "FOUNDING_CITIZEN": 0.2, "FIRST_CITIZEN": 0., "ANY": 0.6}
+
+
+    def test_async_bot_runtime(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            treasury = CityDAOTreasury(
+                metadata=TokenMetadataStore(os.path.join(tmp_dir, "tokens.json")), provider=Web3(OfflineProvider())
+            )
+            codec = treasury.provider.codec
+            transactions = []
+
+            async def fake_eth_call(transaction, block_identifier="latest"):
+                transactions.append(transaction)
+                outputs = [("string", "WETH"), ("uint8", 18), ("string", "USDC"), ("uint8", 6)]
+                outputs += [("uint256", 2 * 10**18), ("uint256", 5 * 10**6), ("uint256", 10**18)]
+                results = [(True, codec.encode_abi([type_], [value])) for type_, value in outputs]
+                return codec.encode_abi(["(bool,bytes)[]"], [results])
+
+            # the aggregate3 read is encoded and decoded without the sync provider
+            async_treasury = AsyncCityDAOTreasury(AsyncHTTPClient(), treasury=treasury, rpc_urls=[])
+            async_treasury.eth_call = fake_eth_call
+            assert asyncio.run(async_treasury.get_balance()) == {"WETH": 2., "USDC": 5., "ETH": 1.}
+            assert transactions[0]["data"].startswith("0x82ad56cb")  # aggregate3
+
+        # the async runtime never builds the sync transports
+        with mock.patch("citydao.snapshot.GraphQLTransport", side_effect=AssertionError), \
+                mock.patch.object(ProviderRegistry, "get", side_effect=AssertionError):
+            bot = AsyncTelegramBot("token", chat_id="-1")
+        sent = []
+        n_loads = []
+
+        async def fake_api_call(method, **params):
+            sent.append((params["chat_id"], params["text"]))
+
+        async def slow_proposals():
+            n_loads.append(1)
+            await asyncio.sleep(0.1)
+            return "proposals"
+
+        bot.api_call = fake_api_call
+        bot.get_message_sources = lambda: {"proposals": slow_proposals}
+
+        async def handle_updates():
+            for chat_id in [1, 2, 3]:
+                message = {"chat": {"id": chat_id}, "text": "/proposals@CityDAOBot"}
+                bot.handle_update({"update_id": chat_id, "message": message})
+            bot.handle_update({"update_id": 4, "message": {"chat": {"id": 4}, "text": "/spotify"}})
+            bot.handle_update({"update_id": 5, "message": {"chat": {"id": 5}, "text": "hello"}})
+            # updates are handled without waiting on the replies
+            assert len(sent) == 0
+            await asyncio.gather(*bot.tasks)
+            # concurrent commands shared one load
+            assert len(n_loads) == 1
+
+            client = TestClient(TestServer(bot.create_webhook_app("/telegram", secret_token="secret")))
+            await client.start_server()
+            try:
+                update = {"update_id": 6, "message": {"chat": {"id": 6}, "text": "/proposals"}}
+                response = await client.post("/telegram", json=update)
+                assert response.status == 403
+                headers = {"X-Telegram-Bot-Api-Secret-Token": "secret"}
+                response = await client.post("/telegram", json=update, headers=headers)
+                assert response.status == 200
+                await asyncio.gather(*bot.tasks)
+            finally:
+                await client.close()
+
+        asyncio.run(handle_updates())
+        assert sorted(sent) == [
+            (1, "proposals"), (2, "proposals"), (3, "proposals"),
+            (4, "spotify is not configured on this bot"), (6, "proposals")
+        ]
+
+
+    def test_broadcast_queue(self):
+        # chunks fit the limit, never end on an escape and keep code blocks balanced
+        text = escape_markdown_v2("1.5 ETH! " * 2000) + "\n```\n" + "code\n" * 2000 + "```"
+        chunks = split_markdown_v2(text)
+        assert len(chunks) > 2 and all(len(chunk) <= 4096 for chunk in chunks)
+        assert all(not chunk.endswith("\\") and chunk.count("```") % 2 == 0 for chunk in chunks)
+        assert split_markdown_v2("x" * 4095 + "\\." + "y") == ["x" * 4095, "\\.y"]
+
+        sent = []
+        failures = {
+            "2": [RetryAfter(0)],
+            "3": [Unauthorized("Forbidden: bot was blocked by the user")],
+            "-4": [ChatMigrated(-40)]
+        }
+
+        class FakeBot(object):
+            def send_message(self, chat_id, text, parse_mode):
+                if failures.get(str(chat_id)):
+                    raise failures[str(chat_id)].pop(0)
+                sent.append((str(chat_id), text, time.monotonic()))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            subscriptions = SubscriptionStore(os.path.join(tmp_dir, "subscriptions.db"))
+            for chat_id in ["2", "3", "-4", "5", "6"]:
+                assert subscriptions.add(chat_id)
+            assert not subscriptions.add("2")
+
+            with mock.patch("citydao.bot.Updater"):
+                bot = TelegramBot(
+                    "123:token", chat_id="1", subscriptions=subscriptions,
+                    send_queue=SendQueue(FakeBot(), global_rate=10., chat_rate=10., group_rate=10.),
+                    discover_tokens=True
+                )
+            assert bot.treasury.discover
+            started_at = time.monotonic()
+            deliveries = bot.broadcast("a" * 4000 + "\n" + "b" * 4000 + "\n" + "c" * 4000)
+            elapsed = time.monotonic() - started_at
+
+            # 15 messages to 5 chats at 10 messages per second, burst of 10
+            assert [delivery.ok for delivery in deliveries] == [True, True, False, True, True, True]
+            assert len(sent) == 15 and elapsed > 0.4
+            for chat_id in ["1", "2", "-40", "5", "6"]:
+                messages = [(text[0], at) for sent_chat_id, text, at in sent if sent_chat_id == chat_id]
+                assert [text for text, _ in messages] == ["a", "b", "c"]
+                assert all(b - a > 0.08 for (_, a), (_, b) in zip(messages, messages[1:]))
+
+            # blocked chats are unsubscribed and migrated groups keep their subscription
+            assert SubscriptionStore(subscriptions.path).get_chat_ids() == ["2", "-40", "5", "6"]
+
+            # the broadcast is scheduled in the bot process that owns the store, which can be moved
+            with mock.patch.object(bot, "warm_message_cache"):
+                bot.run(report_time=datetime.strptime("00:01", "%H:%M").time())
+            bot.updater.job_queue.run_daily.assert_called_once()
+            assert bot.updater.job_queue.run_daily.call_args.args == (bot.daily_report_job,)
+            shared = os.path.join(tmp_dir, "shared.db")
+            with mock.patch.dict(os.environ, {"CITYDAO_SUBSCRIPTIONS_DB": shared}):
+                assert SubscriptionStore().path == shared
+
+
+    def test_provider_failover(self):
+        server = HTTPServer(("127.0.0.1", 0), FakeRPCHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+
+        provider = FailoverHTTPProvider([f"{url}/down", f"{url}/up"])
+        assert Web3(provider).eth.block_number == 16
+        assert not provider.endpoints[0].is_healthy() and provider.endpoints[1].is_healthy()
+
+        responses = provider.make_batch_request([("eth_blockNumber", []), ("eth_chainId", [])])
+        assert [response["result"] for response in responses] == ["0x10", "0x10"]
+
+
+        # other 4xx and endpoint errors in a 200 body fail over too
+        provider = FailoverHTTPProvider([f"{url}/forbidden", f"{url}/limited", f"{url}/up"])
+        assert Web3(provider).eth.block_number == 16
+        assert [endpoint.is_healthy() for endpoint in provider.endpoints] == [False, False, True]
+
+        # a batch answered with a single error object fails over, and is a clear error on the last endpoint
+        provider = FailoverHTTPProvider([f"{url}/nobatch", f"{url}/up"])
+        assert len(provider.make_batch_request([("eth_blockNumber", [])])) == 1
+        with self.assertRaisesRegex(ValueError, "rejected by every endpoint"):
+            FailoverHTTPProvider([f"{url}/nobatch"]).make_batch_request([("eth_blockNumber", [])])
+        server.shutdown()
+
+        with self.assertRaises(ValueError):
+            FailoverHTTPProvider([])
+        with mock.patch.dict(os.environ, {"CITYDAO_RPC_URLS": " , "}), self.assertRaises(ValueError):
+            ProviderRegistry.get_rpc_urls()
+
+        # contracts are cached per endpoint, short-lived Web3 instances are not kept alive by the cache
+        abi_path = os.path.join(os.path.dirname(os.path.abspath(citydao.utils.__file__)), "abi", "erc20.json")
+        token = "0xA0b86991c6218b36c1d19D4a2e9Eb0cE3606eB48"
+        contract = ContractFactory.get_contract(Web3(Web3.HTTPProvider(url)), token, abi_path)
+        assert ContractFactory.get_contract(Web3(Web3.HTTPProvider(url)), token, abi_path) is contract
+        ephemeral = Web3()
+        ContractFactory.get_contract(ephemeral, token, abi_path)
+        ephemeral = weakref.ref(ephemeral)
+        gc.collect()
+        assert ephemeral() is None
+
+
+    def test_report_pipeline(self):
+        hang = threading.Event()
+
+        def fail():
+            raise RuntimeError("down")
+
+        sources = [
+            ReportSource("slow", lambda: time.sleep(0.3) or "slow", timeout=5.),
+            ReportSource("fast", lambda: "fast", timeout=5.),
+            ReportSource("hung", lambda: hang.wait(), timeout=0.5),
+            ReportSource("broken", fail, timeout=5.),
+        ]
+        sent = []
+        started_at = time.monotonic()
+        sections = ReportPipeline(sources).run(lambda section: sent.append((section.name, section.message)))
+        hang.set()
+
+        # sources ran concurrently, sections kept their order
+        assert time.monotonic() - started_at < 1.5
+        assert sent == [("slow", "slow"), ("fast", "fast"), ("hung", None), ("broken", None)]
+        assert [section.missed_deadline for section in sections] == [False, False, True, False]
+        failures = ReportPipeline.format_failures(sections)
+        assert failures == "⏳ No response in time from: hung\n⚠️ Failed to fetch: broken"
+
+
+    def test_stale_while_revalidate_cache(self):
+        cache = StaleWhileRevalidateCache(ttl=0.2)
+        release = threading.Event()
+        n_loads = []
+
+        def loader():
+            n_loads.append(1)
+            release.wait()
+            return f"message {len(n_loads)}"
+
+        # concurrent misses share a single load
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("proposals", loader))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert results == ["message 1"] * 8 and len(n_loads) == 1
+
+        # stale values are served at once while one background refresh runs
+        time.sleep(0.25)
+        release.clear()
+        assert [cache.get("proposals", loader) for _ in range(5)] == ["message 1"] * 5
+        release.set()
+        time.sleep(0.05)
+        assert cache.get("proposals", loader) == "message 2" and len(n_loads) == 2
+
+
+    def test_calendar_sync(self):
+        today = datetime.now(tz=pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        def make_event(id, start, hours=1, status="confirmed"):
+            return {
+                "id": id, "status": status, "htmlLink": f"https://calendar/{id}", "summary": id,
+                "creator": {"email": "citizen@citydao.io"},
+                "start": {"dateTime": start.strftime("%Y-%m-%dT%H:%M:%SZ")},
+                "end": {"dateTime": (start + timedelta(hours=hours)).strftime("%Y-%m-%dT%H:%M:%SZ")},
+            }
+
+        pages = {
+            None: {"items": [make_event("a", today + timedelta(hours=9))], "nextPageToken": "p2"},
+            "p2": {"items": [make_event("b", today + timedelta(days=3))], "nextSyncToken": "t1"},
+            "t1": {
+                "items": [make_event("a", today, status="cancelled"), make_event("c", today + timedelta(hours=12))],
+                "nextSyncToken": "t2"
+            },
+        }
+        requests_ = []
+
+        class FakeEvents(object):
+            def list(self, **params):
+                requests_.append(params.get("pageToken") or params.get("syncToken"))
+                # full syncs are bounded, incremental ones can not be
+                assert ("timeMin" in params) == ("syncToken" not in params)
+                if "timeMin" in params:
+                    assert params["timeMin"] < (today - timedelta(days=6)).strftime("%Y-%m-%dT%H:%M:%SZ")
+                if params.get("syncToken") == "expired":
+                    raise HttpError(httplib2.Response({"status": 410}), b"")
+                return SimpleNamespace(execute=lambda: pages[params.get("pageToken") or params.get("syncToken")])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            calendar = CityDAOCalendar("key", store=CalendarEventStore(os.path.join(tmp_dir, "calendar.db")))
+            with mock.patch.object(CityDAOCalendar, "service", SimpleNamespace(events=FakeEvents)):
+                assert [event.summary for event in calendar.get_today_events()] == ["a"]
+                assert requests_ == [None, "p2"]
+
+                assert [event.summary for event in calendar.get_today_events()] == ["c"]
+                assert requests_[-1] == "t1"
+                assert calendar.store.get_sync_token(calendar.calendar_id) == "t2"
+
+                # an expired token falls back to a full sync
+                calendar.store.apply_changes(calendar.calendar_id, [], "expired")
+                calendar.sync()
+                assert requests_[-3:] == ["expired", None, "p2"]
+                events = calendar.get_events(today, today + timedelta(days=7), sync=False)
+                assert [event.summary for event in events] == ["a", "b"]
+
+        # each thread builds its own httplib2-backed service
+        CityDAOCalendar._local.services = {}
+        with mock.patch("citydao.calendar.build", side_effect=lambda *args, **kwargs: object()):
+            store = CalendarEventStore(os.path.join(self.cache_dir.name, "calendar.db"))
+            calendar = CityDAOCalendar("key", store=store)
+            services = []
+            thread = threading.Thread(target=lambda: services.append(calendar.service))
+            thread.start()
+            thread.join()
+            assert calendar.service is calendar.service and calendar.service is not services[0]
+        CityDAOCalendar._local.services = {}
 
 
     def test_calendar(self):
         calendar = CityDAOCalendar(os.getenv("GOOGLE_APIKEY"))
-        events = calendar.get_today_events()
+        calendar.get_today_events()
+
+
+    def test_spotify_token_and_etag(self):
+        episodes = {"items": [{
+            "id": "x", "name": "Episode", "external_urls": {"spotify": "https://open.spotify.com/episode/x"},
+            "release_date": "2022-08-01", "audio_preview_url": None, "description": "", "duration_ms": 60000
+        }]}
+        calls = []
+
+        class FakeResponse(object):
+            def __init__(self, status_code, payload=None, headers=None):
+                self.status_code = status_code
+                self.payload = payload
+                self.headers = headers or {}
+
+            def json(self):
+                return self.payload
+
+            def raise_for_status(self):
+                if self.status_code >= 400:
+                    raise requests.HTTPError(self.status_code)
+
+        class FakeSession(object):
+            def post(self, url, headers=None, data=None):
+                calls.append("token")
+                return FakeResponse(200, {"access_token": f"token{len(calls)}", "expires_in": 3600})
+
+            def get(self, url, headers=None):
+                calls.append(headers.get("If-None-Match"))
+                if headers.get("If-None-Match") == '"v1"':
+                    return FakeResponse(304)
+                return FakeResponse(200, episodes, {"ETag": '"v1"'})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            catalog = EpisodeCatalog("show", os.path.join(tmp_dir, "spotify.db"))
+            spotify = CityDAOSpotify("id", "secret", background_refresh=False, catalog=catalog)
+            spotify.session = spotify.token_manager.session = FakeSession()
+            assert spotify.get_latest_episodes()[0].name == "Episode"
+            assert spotify.get_latest_episodes()[0].name == "Episode"
+            # one token for both requests, the second one is answered with a 304
+            assert calls == ["token", None, '"v1"']
+
+            spotify.token_manager.expires_at = time.time() + 30
+            spotify.get_latest_episodes()
+            assert calls[3] == "token"
+
+            # etags outlive the process, a new client starts with a conditional request
+            calls.clear()
+            catalog = EpisodeCatalog("show", catalog.path)
+            spotify = CityDAOSpotify("id", "secret", background_refresh=False, catalog=catalog)
+            spotify.session = spotify.token_manager.session = FakeSession()
+            assert spotify.get_latest_episodes()[0].name == "Episode"
+            assert calls == ["token", '"v1"']
+
+
+    def test_spotify_catalog(self):
+        items = [
+            {
+                "id": f"e{i}", "name": f"Episode {i}",
+                "external_urls": {"spotify": f"https://open.spotify.com/episode/e{i}"},
+                "release_date": (datetime(2022, 1, 1) + timedelta(days=i // 2)).strftime("%Y-%m-%d"),
+                "audio_preview_url": None, "description": "", "duration_ms": 60000
+            }
+            for i in range(25)
+        ]
+        requested = []
+
+        def fake_get_json(url):
+            requested.append(url)
+            offset = int(url.split("offset=")[1]) if "offset=" in url else 0
+            page = sorted(items, key=lambda item: item["id"][1:].zfill(3), reverse=True)[offset:offset + 10]
+            has_next = offset + 10 < len(items)
+            next_url = f"https://api.spotify.com/episodes?offset={offset + 10}" if has_next else None
+            return {"items": page, "next": next_url}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "spotify.db")
+            spotify = CityDAOSpotify("id", "secret", background_refresh=False, catalog=EpisodeCatalog("show", path))
+            spotify.get_json = fake_get_json
+            assert len(list(spotify.iter_episodes(page_size=10))) == 25
+            assert spotify.sync_catalog() == 25
+
+            # only the first page is read once the catalog is up to date
+            requested.clear()
+            items += [{**items[-1], "id": "e25", "name": "Episode 25", "release_date": "2022-01-14"}]
+            assert spotify.sync_catalog() == 1
+            assert len(requested) == 1
+
+            catalog = EpisodeCatalog("show", path)
+            assert [episode.id for episode in catalog.get_latest(3)] == ["e25", "e24", "e23"]
+            episodes = catalog.get_between(datetime(2022, 1, 2), datetime(2022, 1, 2))
+            assert [episode.id for episode in episodes] == ["e3", "e2"]
+            assert catalog.find_by_name("episode 7").id == "e7"
+            assert len(catalog.search("episode 1")) == 11
 
 
     def test_spotify(self):
@@ -47,7 +1049,7 @@ class CityDAOTester(unittest.TestCase):
             client_id=os.getenv("SPOTIFY_CLIENT_ID"),
             client_credentials=os.getenv("SPOTIFY_CLIENT_CREDENTIALS")
         )
-        episodes = spotify.get_latest_episodes()
+        spotify.get_latest_episodes()
 
 
 if __name__ == "__main__":